@@ -0,0 +1,113 @@
+'''
+HTTP/1.1 gun micro-benchmark: requests per second and per CPU second
+of the gun against a local stand-in server that answers every request
+with a canned response. The server runs in its own process. Run from
+the repository root:
+
+    python benchmarks/http_bench.py [requests]
+'''
+import asyncio
+import multiprocessing as mp
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bfg.guns.http import HttpGun  # noqa: E402
+from bfg.worker import Task  # noqa: E402
+
+
+RESPONSE = (
+    b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n'
+    b'Content-Length: 13\r\n\r\nHello, world!')
+# (connections, pipeline depth)
+SETTINGS = [(1, 1), (10, 1), (100, 1), (10, 8), (10, 32)]
+REQUESTS = 100000
+
+
+class StandInServer(asyncio.Protocol):
+    ''' Answers every request, pipelined ones too '''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.tail = b''
+
+    def data_received(self, data):
+        data = self.tail + data
+        requests = data.count(b'\r\n\r\n')
+        self.tail = data[data.rfind(b'\r\n\r\n') + 4:] if requests else data
+        if requests:
+            self.transport.write(RESPONSE * requests)
+
+
+def serve(ports):
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        loop.create_server(StandInServer, '127.0.0.1', 0))
+    ports.put(server.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+
+class Counter(object):
+    ''' Counts samples instead of sending them anywhere '''
+
+    def __init__(self):
+        self.samples = 0
+        self.errors = 0
+
+    def put(self, sample):
+        self.samples += 1
+        self.errors += sample.error
+
+
+async def shoot(gun, requests, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(task):
+        try:
+            await gun.async_shoot(task)
+        finally:
+            slots.release()
+
+    await gun.async_setup()
+    shots = []
+    for number in range(requests):
+        await slots.acquire()
+        shots.append(asyncio.ensure_future(one(
+            Task(time.monotonic_ns(), 'bench', 'bench', '/'))))
+    await asyncio.wait(shots)
+    await gun.async_teardown()
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else REQUESTS
+    ports = mp.Queue()
+    server = mp.Process(target=serve, args=(ports,), daemon=True)
+    server.start()
+    port = ports.get()
+    print("%12s %9s %10s %12s %8s" % (
+        'connections', 'pipeline', 'req/s', 'req/cpu s', 'errors'))
+    for connections, pipeline in SETTINGS:
+        gun = HttpGun({
+            'target': '127.0.0.1:%d' % port,
+            'pool_size': connections,
+            'pipeline': pipeline,
+        })
+        gun.results = Counter()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        started, cpu_started = time.perf_counter(), time.process_time()
+        loop.run_until_complete(
+            shoot(gun, requests, connections * pipeline))
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+        loop.close()
+        print("%12d %9d %10d %12d %8d" % (
+            connections, pipeline, requests / wall, requests / cpu,
+            gun.results.errors))
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
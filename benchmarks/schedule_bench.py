@@ -0,0 +1,52 @@
+'''
+Schedule generation micro-benchmark: per-element generators vs vectorized
+chunks. Run from the repository root:
+
+    python benchmarks/schedule_bench.py
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bfg.schedule import create, US  # noqa: E402
+
+
+SCHEDULES = [
+    ['const(20000, 60s)'],
+    ['line(1, 40000, 60s)'],
+    ['line(1, 10000, 30s)', 'const(10000, 30s)', 'step(10000, 20000, 2000, 5s)'],
+]
+CHUNK_SIZE = 4096
+
+
+def measure(consume):
+    started = time.perf_counter()
+    count = consume()
+    return count, time.perf_counter() - started
+
+
+def per_element(plan):
+    return sum(1 for _ in plan)
+
+
+def chunked(plan):
+    return sum(len(chunk) for chunk in plan.chunks(CHUNK_SIZE))
+
+
+def main():
+    print("%-70s %12s %12s %8s" % (
+        'schedule', 'iter, ts/s', 'chunks, ts/s', 'speedup'))
+    for schedule in SCHEDULES:
+        plan = create(schedule, resolution=US)
+        count, iter_time = measure(lambda: per_element(plan))
+        chunked_count, chunks_time = measure(lambda: chunked(plan))
+        assert count == chunked_count
+        print("%-70s %12d %12d %7.1fx" % (
+            ', '.join(schedule),
+            count / iter_time, count / chunks_time, iter_time / chunks_time))
+
+
+if __name__ == '__main__':
+    main()
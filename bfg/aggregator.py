@@ -5,54 +5,472 @@ Data aggregation facilities.
 import threading as th
 import queue
 import multiprocessing as mp
+import signal
+import os
 from .module_exceptions import ConfigurationError
 from .util import FactoryBase
-from .guns.base import Sample
+from .guns.base import Sample, PHASES
+from .histogram import Histogram
+from .columns import ResultBlock
+from .raw import create_writer
+from .storage import SeriesStorage
 from .util import q_to_dict
+from collections import namedtuple, deque
 import asyncio
 import time
 from dateutil import tz
 import numpy as np
-import pandas as pd
 import arrow
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+QUANTILES = [0, .25, .5, .75, .9, .99, 1]
+ENGINES = ('histogram', 'pandas')
+
+'''
+Aggregate is what workers send instead of samples when they aggregate
+samples themselves: statistics of samples with the same bfg, marker,
+scenario and action for one second
+'''
+Aggregate = namedtuple('Aggregate', 'ts,bfg,marker,scenario,action,stats')
+TAGS = ('bfg', 'marker', 'scenario', 'action')
+OTHER = 'other'
+
+
+class SampleStats(object):
+    '''
+    Mergeable statistics of samples: rt and delay histograms,
+    number of errors and response codes.
+
+    Optionally, a histogram of intended latency (rt + delay: the time
+    from the moment a request was planned to the moment it completed,
+    which does not hide stalls of the target the way rt does) and the
+    number of tasks that were started more than late_threshold µs later
+    than planned.
+
+    Request phases (see PHASES) are counted in histograms that are made
+    when a phase is first measured
+    '''
+
+    def __init__(self, intended_latency=False, late_threshold=None):
+        self.rt = Histogram()
+        self.delay = Histogram()
+        self.intended = Histogram() if intended_latency else None
+        self.late_threshold = late_threshold
+        self.late = 0
+        self.errors = 0
+        self.codes = {}
+        self.phases = {}
+
+    @property
+    def count(self):
+        return self.rt.count
+
+    def record_block(self, block, rows=None):
+        '''
+        Add a block of samples in columns, or only some rows of it
+        '''
+        if rows is None:
+            rows = block.rows
+        self._record(rows['rt'], rows['delay'])
+        self.errors += int(rows['error'].sum())
+        codes, counts = np.unique(rows['code'], return_counts=True)
+        for code, count in zip(codes.tolist(), counts.tolist()):
+            code = block.values[code]
+            self.codes[code] = self.codes.get(code, 0) + count
+        for phase in PHASES:
+            values = rows[phase]
+            values = values[values != ResultBlock.NOT_MEASURED]
+            if len(values):
+                self._phase(phase).record(values)
+
+    def record(self, samples):
+        '''
+        Add a list of samples
+        '''
+        self._record(
+            np.fromiter(
+                (sample.rt for sample in samples), np.int64, len(samples)),
+            np.fromiter(
+                (sample.delay for sample in samples), np.int64, len(samples)))
+        for sample in samples:
+            if sample.error:
+                self.errors += 1
+            self.codes[sample.code] = self.codes.get(sample.code, 0) + 1
+        phases = zip(*(sample[-len(PHASES):] for sample in samples))
+        for phase, values in zip(PHASES, phases):
+            values = [value for value in values if value is not None]
+            if values:
+                self._phase(phase).record(values)
+
+    def _phase(self, phase):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = Histogram()
+        return histogram
+
+    def _record(self, rt, delay):
+        self.rt.record(rt)
+        self.delay.record(delay)
+        if self.intended is not None:
+            self.intended.record(rt + delay)
+        if self.late_threshold is not None:
+            self.late += int(np.count_nonzero(delay > self.late_threshold))
+
+    def merge(self, other):
+        '''
+        Add statistics of other samples
+        '''
+        self.rt.merge(other.rt)
+        self.delay.merge(other.delay)
+        if self.intended is not None and other.intended is not None:
+            self.intended.merge(other.intended)
+        self.late += other.late
+        self.errors += other.errors
+        for code, count in other.codes.items():
+            self.codes[code] = self.codes.get(code, 0) + count
+        for phase, histogram in other.phases.items():
+            self._phase(phase).merge(histogram)
+        return self
+
+
+class Breakdown(object):
+    '''
+    Statistics of samples for one second, by bfg, marker, scenario and
+    action. Only max_markers most frequent markers are counted apart,
+    the rest are counted as 'other' marker, so the cost of a second does
+    not depend on the number of distinct markers in ammo
+    '''
+
+    def __init__(
+            self, max_markers=100, intended_latency=False,
+            late_threshold=None):
+        self.max_markers = max_markers
+        self.intended_latency = intended_latency
+        self.late_threshold = late_threshold
+        self.groups = {}
+
+    def _stats(self):
+        return SampleStats(self.intended_latency, self.late_threshold)
+
+    def _group(self, key):
+        stats = self.groups.get(key)
+        if stats is None:
+            stats = self.groups[key] = self._stats()
+        return stats
+
+    def _markers(self, samples, blocks, aggregates):
+        '''
+        Markers that are counted apart
+        '''
+        counts = {}
+        for sample in samples:
+            counts[sample.marker] = counts.get(sample.marker, 0) + 1
+        for block in blocks:
+            ids, id_counts = np.unique(
+                block.rows['marker'], return_counts=True)
+            for marker, count in zip(ids.tolist(), id_counts.tolist()):
+                marker = block.values[marker]
+                counts[marker] = counts.get(marker, 0) + count
+        for aggregate in aggregates:
+            counts[aggregate.marker] = \
+                counts.get(aggregate.marker, 0) + aggregate.stats.count
+        if len(counts) <= self.max_markers:
+            return set(counts)
+        return set(sorted(
+            counts, key=counts.get, reverse=True)[:self.max_markers])
+
+    def record(self, samples, blocks, aggregates):
+        '''
+        Add samples, blocks of samples and aggregates from workers
+        '''
+        markers = self._markers(samples, blocks, aggregates)
+        groups = {}
+        for sample in samples:
+            groups.setdefault((
+                sample.bfg,
+                sample.marker if sample.marker in markers else OTHER,
+                sample.scenario, sample.action), []).append(sample)
+        for key, key_samples in groups.items():
+            self._group(key).record(key_samples)
+        for block in blocks:
+            rows = block.rows
+            # value ids of the block, and one more for the other markers
+            values = block.values + [OTHER]
+            base = len(values)
+            folded = np.array(
+                [value not in markers for value in block.values] + [False])
+            marker_ids = rows['marker'].astype(np.int64)
+            marker_ids[folded[marker_ids]] = base - 1
+            keys, inverse = np.unique(
+                np.stack([
+                    rows['bfg'], marker_ids, rows['scenario'], rows['action'],
+                ], axis=1),
+                axis=0, return_inverse=True)
+            # some numpy versions return the inverse in the shape of keys
+            inverse = inverse.ravel()
+            order = np.argsort(inverse, kind='stable')
+            bounds = np.cumsum(np.bincount(inverse))[:-1]
+            for key, numbers in zip(keys.tolist(), np.split(order, bounds)):
+                self._group(
+                    tuple(values[number] for number in key)
+                ).record_block(block, rows[numbers])
+        for aggregate in aggregates:
+            self._group((
+                aggregate.bfg,
+                aggregate.marker if aggregate.marker in markers else OTHER,
+                aggregate.scenario, aggregate.action,
+            )).merge(aggregate.stats)
+
+    def overall(self):
+        overall = self._stats()
+        for stats in self.groups.values():
+            overall.merge(stats)
+        return overall
+
+    def by_tag(self, tag):
+        '''
+        Statistics for every value of a tag
+        '''
+        index = TAGS.index(tag)
+        result = {}
+        for key, stats in self.groups.items():
+            value = key[index]
+            if value not in result:
+                result[value] = self._stats()
+            result[value].merge(stats)
+        return result
+
+
+class WorkerAggregator(object):
+    '''
+    Aggregates samples inside a worker process and sends aggregates to
+    the results queue once in an interval, so the traffic between
+    processes does not depend on RPS. It has a put() method, so a gun
+    can use it instead of the queue. Raw samples are optionally written
+    to a file by the worker itself. intended_latency and late_threshold
+    are passed to SampleStats. Samples may be put from several threads.
+    A flusher thread sends aggregates on time even when no samples come,
+    so the last second before a pause in the load is not held back
+    '''
+
+    def __init__(
+            self, results_queue, interval=1, raw_filename=None,
+            intended_latency=False, late_threshold=None):
+        self.results_queue = results_queue
+        self.intended_latency = intended_latency
+        self.late_threshold = late_threshold
+        self.interval = interval
+        self.raw_writer = create_writer(raw_filename) if raw_filename else None
+        self.lock = th.Lock()
+        self.samples = {}
+        self.flushed = time.monotonic()
+        self.closed = th.Event()
+        self.flusher = None
+        if interval > 0:
+            self.flusher = th.Thread(
+                target=self._flush_periodically, daemon=True)
+            self.flusher.start()
+
+    def put(self, sample):
+        with self.lock:
+            self.samples.setdefault(
+                (sample.ts, sample.bfg, sample.marker, sample.scenario,
+                 sample.action), []
+            ).append(sample)
+            if time.monotonic() - self.flushed >= self.interval:
+                self._flush()
+
+    def flush(self):
+        '''
+        Send everything that was collected
+        '''
+        with self.lock:
+            self._flush()
+
+    def _flush_periodically(self):
+        delay = self.interval
+        while not self.closed.wait(delay):
+            with self.lock:
+                delay = self.flushed + self.interval - time.monotonic()
+                if delay <= 0:
+                    self._flush()
+                    delay = self.interval
+
+    def _flush(self):
+        self.flushed = time.monotonic()
+        if not self.samples:
+            return
+        samples, self.samples = self.samples, {}
+        aggregates = []
+        for key, key_samples in samples.items():
+            stats = SampleStats(self.intended_latency, self.late_threshold)
+            stats.record(key_samples)
+            aggregates.append(Aggregate(*key, stats=stats))
+            if self.raw_writer:
+                self.raw_writer.write(key_samples)
+        self.results_queue.put(aggregates)
+
+    def close(self):
+        self.closed.set()
+        if self.flusher:
+            self.flusher.join()
+        self.flush()
+        if self.raw_writer:
+            self.raw_writer.close()
+
+
+class SecondsRing(object):
+    '''
+    Pending results by second: a ring of buckets from the oldest second
+    that was not published yet to the newest one. Adding to a bucket and
+    taking the oldest one are O(1). Results for a second that was already
+    taken are late: add() does not accept them
+
+    >>> ring = SecondsRing()
+    >>> ring.add(11, 'b'), ring.add(10, 'a'), ring.add(13, 'd')
+    (True, True, True)
+    >>> len(ring)
+    4
+    >>> ring.pop(), ring.pop(), ring.pop()
+    ((10, ['a']), (11, ['b']), (12, []))
+    >>> ring.add(11, 'late')
+    False
+    '''
+
+    def __init__(self):
+        self.buckets = deque()
+        self.first = None
+        self.taken = None
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def add(self, ts, item):
+        '''
+        Add an item to the bucket of a second. Return False if the second
+        was already taken
+        '''
+        if self.taken is not None and ts <= self.taken:
+            return False
+        if not self.buckets:
+            self.first = ts
+        elif ts < self.first:
+            self.buckets.extendleft([] for _ in range(self.first - ts))
+            self.first = ts
+        index = ts - self.first
+        if index >= len(self.buckets):
+            self.buckets.extend(
+                [] for _ in range(index - len(self.buckets) + 1))
+        self.buckets[index].append(item)
+        return True
+
+    def pop(self):
+        '''
+        Take the oldest second and its items
+        '''
+        ts = self.first
+        self.taken = ts
+        self.first += 1
+        return ts, self.buckets.popleft()
+
+
+class QueueDrainer(object):
+    '''
+    Reads a multiprocessing queue in a dedicated thread. The thread
+    blocks on the queue until something arrives, then takes everything
+    that is there (up to max_batch items) and hands the batch over to
+    the event loop, where consume(batch) is called. When stopped, it
+    drains the queue to the end, hands over the last batch and then
+    calls on_stopped() in the event loop.
+
+    Queue depth is measured after every batch: depth is the last value,
+    max_depth is the highest one since it was last reset
+    '''
+    MAX_WAIT = 0.1
+
+    def __init__(
+            self, results_queue, event_loop, consume, on_stopped,
+            max_batch=10000):
+        self.results_queue = results_queue
+        self.event_loop = event_loop
+        self.consume = consume
+        self.on_stopped = on_stopped
+        self.max_batch = max_batch
+        self.depth = 0
+        self.max_depth = 0
+        self.batches = 0
+        self.items = 0
+        self._stop = th.Event()
+        self.thread = th.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _batch(self, first):
+        batch = [first]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.results_queue.get_nowait())
+            except queue.Empty:
+                break
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            self.depth = self.results_queue.qsize()
+        except NotImplementedError:
+            self.depth = 0
+        self.max_depth = max(self.max_depth, self.depth)
+        self.event_loop.call_soon_threadsafe(self.consume, batch)
+
+    def _drain(self):
+        logger.info("Results reader started")
+        while True:
+            try:
+                self._batch(self.results_queue.get(timeout=self.MAX_WAIT))
+            except queue.Empty:
+                if self._stop.is_set():
+                    break
+        logger.info(
+            "Results reader stopped: %d items in %d batches",
+            self.items, self.batches)
+        self.event_loop.call_soon_threadsafe(self.on_stopped)
+
 
 class ResultsSink(object):
-    ''' Just collects samples, does not aggregate '''
+    '''
+    Just collects samples, does not aggregate. Only samples of the last
+    keep_seconds seconds are kept
+    '''
 
-    def __init__(self, event_loop):
+    def __init__(self, event_loop, keep_seconds=60):
         self.event_loop = event_loop
+        self.keep_seconds = keep_seconds
         self.results = {}
         self.results_queue = mp.Queue()
-        self._stop = False
         self.stopped = False
-        self.event_loop.create_task(self._reader())
+        self.reader = QueueDrainer(
+            self.results_queue, self.event_loop,
+            self._consume, self._reader_stopped)
 
     async def stop(self):
         '''
-        Signal the reading coroutine to stop and wait for it
+        Signal the reader to stop and wait for it
         '''
-        self._stop = True
+        self.reader.stop()
         while not self.stopped:
             await asyncio.sleep(1)
 
-    async def _reader(self):
-        '''
-        Read from results queue asyncronously and put samples into
-        results dict
-        '''
-        logger.info("Results reader started")
-        while not self._stop:
-            try:
-                sample = self.results_queue.get_nowait()
-                self.results.setdefault(sample.ts, []).append(sample)
-            except queue.Empty:
-                await asyncio.sleep(1)
-        logger.info("Results reader stopped")
+    def _consume(self, samples):
+        for sample in samples:
+            self.results.setdefault(sample.ts, []).append(sample)
+        while len(self.results) > self.keep_seconds:
+            del self.results[min(self.results)]
+
+    def _reader_stopped(self):
         self.stopped = True
 
 
@@ -60,25 +478,75 @@ class CachingAggregator(object):
     '''
     Caching aggregator that can also notify its listeners
     and write raw samples to a file. Listeners should have
-    a publish(timestamp, aggregated_data) method
+    a publish(timestamp, aggregated_data) method.
+
+    Besides overall statistics, the histogram engine publishes
+    statistics for every bfg, marker, scenario and action, in 'tags'.
+    Only max_markers most frequent markers of a second are shown apart,
+    the rest are shown as 'other'.
+
+    A second is published when there are cache_depth newer seconds in
+    the buffer. Samples that come later than that, but not later than
+    lateness_window seconds after publication, are merged into the
+    published data and listeners are sent a correction: their
+    correct(timestamp, aggregated_data) method is called if they have
+    one. Corrections are only made by the histogram engine.
+
+    With intended_latency, the quantiles of intended latency (rt + delay)
+    are published in 'intended'. With late_threshold (µs), the number
+    of tasks started more than late_threshold later than planned is
+    published in 'late'. Quantiles of request phases that guns measure
+    (see PHASES) are published in 'phases'.
+
+    Overall statistics of published seconds are kept in bounded memory
+    in aggregated_results (see SeriesStorage) and appended to
+    series_filename if it is set.
+
+    Statistics are computed by one of the engines: 'histogram' (default)
+    streams samples into mergeable histograms, 'pandas' builds a data
+    frame every second. Both publish the same overall statistics
+    (quantiles are exact with pandas). The pandas engine publishes no
+    'tags', makes no corrections (late samples are counted as lost) and
+    skips aggregates made by workers
     '''
+    QUEUE_DEPTH_WARNING = 10000
 
     def __init__(
             self, event_loop,
             cache_depth=5, listeners=[],
-            raw_filename='result.samples'):
-        self.raw_file = open(raw_filename, 'w')
-        self.first_write = True
+            raw_filename='result.samples', engine='histogram',
+            lateness_window=10, raw_format='tsv', raw_compression='gzip',
+            max_markers=100, results_queue=None, series_filename=None,
+            recent_seconds=3600, downsample_interval=60,
+            downsampled_intervals=1440, intended_latency=False,
+            late_threshold=None):
+        if engine not in ENGINES:
+            raise ConfigurationError(
+                "Unknown aggregation engine: %s" % engine)
+        self.engine = engine
+        self.raw_writer = create_writer(
+            raw_filename, raw_format, raw_compression) if raw_filename else None
         self.cache_depth = cache_depth
+        self.lateness_window = lateness_window
+        self.max_markers = max_markers
+        self.intended_latency = intended_latency
+        self.late_threshold = late_threshold
         self.event_loop = event_loop
-        self.results = {}
-        self.aggregated_results = {}
-        self.results_queue = mp.Queue()
-        self._stop = False
+        self.results = SecondsRing()
+        self.late_results = {}
+        self.lost = 0
+        # statistics of published seconds that may be corrected yet
+        self.published_stats = deque()
+        self.aggregated_results = SeriesStorage(
+            QUANTILES, series_filename, recent_seconds,
+            downsample_interval, downsampled_intervals, PHASES)
+        self.results_queue = results_queue or mp.Queue()
         self.reader_stopped = False
         self.aggregator_stopped = False
         self.listeners = listeners
-        self.event_loop.create_task(self._reader())
+        self.reader = QueueDrainer(
+            self.results_queue, self.event_loop,
+            self._consume, self._reader_stopped)
         self.event_loop.create_task(self._aggregator())
 
     async def stop(self):
@@ -89,25 +557,32 @@ class CachingAggregator(object):
         in the buffer)
         '''
         self.cache_depth = 0  # empty the cache
-        self._stop = True
+        self.reader.stop()
         while not self.reader_stopped:
             await asyncio.sleep(1)
         while not self.aggregator_stopped:
             await asyncio.sleep(1)
 
-    async def _reader(self):
+    def _consume(self, items):
         '''
-        Read everything from the queue until it empty, then sleep
-        for half a second
+        Put a batch of samples, blocks and aggregates from the results
+        queue into the buffer
         '''
-        logger.info("Results reader started")
-        while not self._stop:
-            try:
-                sample = self.results_queue.get_nowait()
-                self.results.setdefault(sample.ts, []).append(sample)
-            except queue.Empty:
-                await asyncio.sleep(0.5)
-        logger.info("Results reader stopped")
+        for item in items:
+            if isinstance(item, Sample):
+                self._add(item.ts, item)
+            elif isinstance(item, ResultBlock):
+                for ts, block in item.split():
+                    self._add(ts, block)
+            else:
+                for aggregate in item:
+                    self._add(aggregate.ts, aggregate)
+
+    def _add(self, ts, item):
+        if not self.results.add(ts, item):
+            self.late_results.setdefault(ts, []).append(item)
+
+    def _reader_stopped(self):
         self.reader_stopped = True
 
     async def _aggregator(self):
@@ -118,23 +593,67 @@ class CachingAggregator(object):
 
         The aggregate() function will also write raw samples to a file
         '''
-        start_time = time.time()
+        start_time = time.monotonic()
         while not (self.reader_stopped and len(self.results) == 0):
-            work_time = time.time() - start_time
+            work_time = time.monotonic() - start_time
             logger.debug("Last aggregation took %02d µs", work_time * 1000000)
             delay = 1 - work_time
             if delay > 0:
                 await asyncio.sleep(delay)
-            start_time = time.time()
+            start_time = time.monotonic()
+            self._report_queue_depth()
             for _ in range(len(self.results) - self.cache_depth):
-                smallest_key = min(self.results.keys())
-                ts, aggr = self.aggregate(
-                    smallest_key, self.results.pop(smallest_key))
-                if aggr:
+                ts, samples = self.results.pop()
+                if samples:
+                    ts, aggr = self.aggregate(ts, samples)
                     self.publish(ts, aggr)
+            self._correct_late()
+        if self.lost:
+            logger.warning(
+                "%d late results were lost. Try increasing aggregator "
+                "cache_depth or lateness_window", self.lost)
+        if self.raw_writer:
+            self.raw_writer.close()
+        self.aggregated_results.close()
         logger.info("Results aggregator stopped")
         self.aggregator_stopped = True
 
+    def _report_queue_depth(self):
+        '''
+        Log the highest results queue depth since the last report
+        '''
+        max_depth, self.reader.max_depth = \
+            self.reader.max_depth, self.reader.depth
+        if max_depth > self.QUEUE_DEPTH_WARNING:
+            logger.warning(
+                "Results queue depth is up to %d, aggregator can not keep up",
+                max_depth)
+        else:
+            logger.debug("Results queue depth is up to %d", max_depth)
+
+    def _correct_late(self):
+        '''
+        Merge late results into published seconds and send corrections.
+        Forget published seconds that are out of the lateness window
+        '''
+        if self.published_stats:
+            newest = self.published_stats[-1][0]
+            while self.published_stats[0][0] < newest - self.lateness_window:
+                self.published_stats.popleft()
+        late_results, self.late_results = self.late_results, {}
+        stats = dict(self.published_stats)
+        for ts, samples in sorted(late_results.items()):
+            if ts not in stats:
+                self.lost += sum(
+                    len(sample) if isinstance(sample, ResultBlock)
+                    else sample.stats.count if isinstance(sample, Aggregate)
+                    else 1
+                    for sample in samples)
+                continue
+            logger.debug("%d late results for %s", len(samples), ts)
+            ts, aggr = self.aggregate(ts, samples, stats[ts])
+            self.correct(ts, aggr)
+
     def publish(self, ts, aggr):
         '''
         Send aggregated data to the listeners
@@ -143,57 +662,270 @@ class CachingAggregator(object):
         self.aggregated_results[ts] = aggr
         [l.publish(ts, aggr) for l in self.listeners]
 
+    def correct(self, ts, aggr):
+        '''
+        Send corrected aggregated data for a published second to the
+        listeners that accept corrections
+        '''
+        logger.debug("Correcting aggregated data for %s:\n%s", ts, aggr)
+        self.aggregated_results[ts] = aggr
+        [l.correct(ts, aggr) for l in self.listeners if hasattr(l, 'correct')]
+
     def _stat_for_df(self, df):
         '''
         Collect stat for a dataframe
         '''
-        return {
+        codes = {}
+        for code, count in df.code.value_counts(dropna=False).items():
+            # codes are floats in a frame where some of them are None
+            if code is None or code != code:
+                code = None
+            elif isinstance(code, float) and code.is_integer():
+                code = int(code)
+            codes[str(code)] = codes.get(str(code), 0) + int(count)
+        stat = {
             "samples": len(df),
+            "errors": int(df.error.sum()),
+            "codes": codes,
             "delay": {
                 "avg": df.delay.mean(),
-                "quantiles": q_to_dict(df.delay.quantile(
-                    [0, .25, .5, .75, .9, .99, 1])),
+                "quantiles": q_to_dict(df.delay.quantile(QUANTILES)),
             },
             "rt": {
                 "avg": df.rt.mean(),
-                "quantiles": q_to_dict(df.rt.quantile(
-                    [0, .25, .5, .75, .9, .99, 1])),
+                "quantiles": q_to_dict(df.rt.quantile(QUANTILES)),
             }
         }
+        if self.intended_latency:
+            intended = df.rt + df.delay
+            stat["intended"] = {
+                "avg": intended.mean(),
+                "quantiles": q_to_dict(intended.quantile(QUANTILES)),
+            }
+        if self.late_threshold is not None:
+            stat["late"] = int((df.delay > self.late_threshold).sum())
+        phases = {}
+        for phase in PHASES:
+            values = df[phase].dropna().astype(float)
+            if len(values):
+                phases[phase] = {
+                    "samples": len(values),
+                    "avg": values.mean(),
+                    "quantiles": q_to_dict(values.quantile(QUANTILES)),
+                }
+        if phases:
+            stat["phases"] = phases
+        return stat
 
-    def aggregate(self, ts, samples):
+    def _stat_for_stats(self, stats):
         '''
-        Convert samples to dataframe, save raw samples to a file,
-        compute some statistics and return aggregated data
+        Collect stat for samples statistics
         '''
-        if ts in self.aggregated_results:
-            logger.warning(
-                "%s already aggregated. Some data points lost."
-                "Try increasing aggregator cachesize")
-            return ts, None
-        df = pd.DataFrame(samples, columns=Sample._fields)
-        df.to_csv(self.raw_file, sep='\t', index=False, header=self.first_write)
-        self.first_write = False  # write headers only in the beginning
+        stat = {
+            "samples": stats.count,
+            "errors": stats.errors,
+            "codes": {str(code): count for code, count in stats.codes.items()},
+            "delay": {
+                "avg": stats.delay.mean,
+                "quantiles": stats.delay.quantiles(QUANTILES),
+            },
+            "rt": {
+                "avg": stats.rt.mean,
+                "quantiles": stats.rt.quantiles(QUANTILES),
+            }
+        }
+        if stats.intended is not None:
+            stat["intended"] = {
+                "avg": stats.intended.mean,
+                "quantiles": stats.intended.quantiles(QUANTILES),
+            }
+        if stats.late_threshold is not None:
+            stat["late"] = stats.late
+        if stats.phases:
+            stat["phases"] = {
+                phase: {
+                    "samples": stats.phases[phase].count,
+                    "avg": stats.phases[phase].mean,
+                    "quantiles": stats.phases[phase].quantiles(QUANTILES),
+                }
+                for phase in PHASES if phase in stats.phases}
+        return stat
 
+    def aggregate(self, ts, samples, stats=None):
+        '''
+        Save raw samples to a file, compute some statistics
+        and return aggregated data. Samples may be mixed with
+        aggregates made by workers. If stats of already published
+        samples are passed, new samples are added to them
+        '''
+        aggregates = [
+            sample for sample in samples if isinstance(sample, Aggregate)]
+        blocks = [
+            sample for sample in samples if isinstance(sample, ResultBlock)]
+        if aggregates or blocks:
+            samples = [
+                sample for sample in samples if isinstance(sample, Sample)]
+        if self.raw_writer:
+            self.raw_writer.write(samples + blocks)
+        if self.engine == 'pandas':
+            import pandas as pd
+            stat = self._stat_for_df(pd.DataFrame(
+                samples + [sample for block in blocks for sample in block],
+                columns=Sample._fields))
+            return ts, {
+                "rps": stat["samples"],
+                "overall": stat,
+            }
+        if stats is None:
+            stats = Breakdown(
+                self.max_markers, self.intended_latency, self.late_threshold)
+            self.published_stats.append((ts, stats))
+        stats.record(samples, blocks, aggregates)
+        stat = self._stat_for_stats(stats.overall())
         aggr = {
-            "rps": len(df),
-            "overall": self._stat_for_df(df),
+            "rps": stat["samples"],
+            "overall": stat,
+            "tags": {
+                tag: {
+                    value: self._stat_for_stats(tag_stats)
+                    for value, tag_stats in stats.by_tag(tag).items()}
+                for tag in TAGS},
         }
         return ts, aggr
 
 
 class LoggingListener(object):
-    def publish(self, ts, data):
-        rt_stats = data.get('overall').get('rt')
+    def publish(self, ts, data, corrected=False):
+        overall = data.get('overall')
+        rt_stats = overall.get('rt')
+        extra = ""
+        if 'intended' in overall:
+            extra += ", intended 99% < {:.3f} ms".format(
+                overall['intended']['quantiles']['99'] / 1000)
+        if 'late' in overall:
+            extra += ", {} late".format(overall['late'])
         logger.info(
-            "{ts} {rps} RPS, mean RT: {rt_avg:.3f} ms, 99% < {rt_q99:.3f} ms".format(
+            "{ts}{corrected} {rps} RPS, mean RT: {rt_avg:.3f} ms, 99% < {rt_q99:.3f} ms{extra}".format(
                 ts=arrow.get(ts).to(tz.gettz()).format('HH:mm:ss'),
+                corrected=" (corrected)" if corrected else "",
                 rps=data.get('rps'),
                 rt_avg=rt_stats.get('avg') / 1000,
-                rt_q99=rt_stats.get('quantiles').get('99') / 1000
+                rt_q99=rt_stats.get('quantiles').get('99') / 1000,
+                extra=extra,
             )
         )
 
+    def correct(self, ts, data):
+        self.publish(ts, data, corrected=True)
+
+
+class SummaryListener(object):
+    '''
+    Sends overall statistics of published and corrected seconds to
+    a queue. Used by the aggregator that runs in its own process
+    '''
+
+    def __init__(self, summaries):
+        self.summaries = summaries
+
+    def publish(self, ts, data, corrected=False):
+        self.summaries.put(
+            (ts, {"rps": data["rps"], "overall": data["overall"]}, corrected))
+
+    def correct(self, ts, data):
+        self.publish(ts, data, corrected=True)
+
+
+class AggregatorProcess(object):
+    '''
+    Runs a caching aggregator in a dedicated process, so aggregation
+    and raw samples writing do not take time from the feeders in the
+    parent event loop. Workers send results to the aggregator process
+    directly. Only summaries of aggregated seconds (rps and overall
+    statistics) come back, and they are passed to the listeners here.
+
+    Takes the same options as CachingAggregator
+    '''
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, event_loop, listeners=[], **options):
+        self.engine = options.get('engine', 'histogram')
+        self.intended_latency = options.get('intended_latency', False)
+        self.late_threshold = options.get('late_threshold')
+        if self.engine not in ENGINES:
+            raise ConfigurationError(
+                "Unknown aggregation engine: %s" % self.engine)
+        self.event_loop = event_loop
+        self.listeners = listeners
+        self.options = options
+        self.aggregated_results = SeriesStorage(
+            QUANTILES, None,
+            options.get('recent_seconds', 3600),
+            options.get('downsample_interval', 60),
+            options.get('downsampled_intervals', 1440), PHASES)
+        self.results_queue = mp.Queue()
+        self.summaries = mp.Queue()
+        self.quit = mp.Event()
+        self.parent = os.getpid()
+        self.process = mp.Process(target=self._run, name='aggregator')
+        self.process.daemon = True
+        self.process.start()
+        self.reader_stopped = False
+        self.reader = QueueDrainer(
+            self.summaries, self.event_loop,
+            self._consume, self._reader_stopped)
+
+    async def stop(self):
+        '''
+        Tell the aggregator process to aggregate what is left and wait
+        for it to exit, then for the last summaries
+        '''
+        self.quit.set()
+        while self.process.is_alive():
+            await asyncio.sleep(self.POLL_INTERVAL)
+        if self.process.exitcode:
+            logger.error(
+                "Aggregator process exited with code %s",
+                self.process.exitcode)
+        self.reader.stop()
+        while not self.reader_stopped:
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    def _consume(self, summaries):
+        for ts, data, corrected in summaries:
+            self.aggregated_results[ts] = data
+            for listener in self.listeners:
+                if corrected and hasattr(listener, 'correct'):
+                    listener.correct(ts, data)
+                elif not corrected:
+                    listener.publish(ts, data)
+
+    def _reader_stopped(self):
+        self.reader_stopped = True
+
+    def _run(self):
+        '''
+        The aggregator process. It is stopped by the parent, so
+        it ignores interrupts and finishes its job
+        '''
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        logger.info("Started aggregator process")
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._aggregate(loop))
+        finally:
+            loop.close()
+
+    async def _aggregate(self, loop):
+        aggregator = CachingAggregator(
+            loop, listeners=[SummaryListener(self.summaries)],
+            results_queue=self.results_queue, **self.options)
+        # quit if the parent has gone without saying so
+        while not self.quit.is_set() and os.getppid() == self.parent:
+            await asyncio.sleep(self.POLL_INTERVAL)
+        await aggregator.stop()
+
 
 class AggregatorFactory(FactoryBase):
     ''' Factory that produces aggregators '''
@@ -202,13 +934,48 @@ class AggregatorFactory(FactoryBase):
 
     def __init__(self, component_factory):
         super().__init__(component_factory)
-        self.results = CachingAggregator(
-            self.event_loop,
-            listeners=[LoggingListener()])
+        self.aggregators = {}
 
     def get(self, key):
         if key in self.factory_config:
-            return self.results
+            if key not in self.aggregators:
+                aggregator_config = self.factory_config.get(key) or {}
+                late_threshold = aggregator_config.get('late_threshold')
+                aggregator_class = AggregatorProcess if \
+                    aggregator_config.get('process', False) \
+                    else CachingAggregator
+                self.aggregators[key] = aggregator_class(
+                    self.event_loop,
+                    listeners=[LoggingListener()],
+                    raw_filename=aggregator_config.get(
+                        'raw_file', 'result.samples'),
+                    engine=aggregator_config.get('engine', 'histogram'),
+                    cache_depth=aggregator_config.get('cache_depth', 5),
+                    lateness_window=aggregator_config.get(
+                        'lateness_window', 10),
+                    raw_format=aggregator_config.get('raw_format', 'tsv'),
+                    raw_compression=aggregator_config.get(
+                        'raw_compression', 'gzip'),
+                    max_markers=aggregator_config.get('max_markers', 100),
+                    series_filename=aggregator_config.get(
+                        'series_file', 'result.series'),
+                    recent_seconds=aggregator_config.get(
+                        'recent_seconds', 3600),
+                    downsample_interval=aggregator_config.get(
+                        'downsample_interval', 60),
+                    downsampled_intervals=aggregator_config.get(
+                        'downsampled_intervals', 1440),
+                    intended_latency=aggregator_config.get(
+                        'intended_latency', False),
+                    late_threshold=late_threshold and late_threshold * 1000)
+            return self.aggregators[key]
         else:
             raise ConfigurationError(
-                "Configuration for %s schedule not found" % key)
+                "Configuration for %s aggregator not found" % key)
+
+    async def stop(self):
+        '''
+        Stop all the aggregators that were created
+        '''
+        for aggregator in self.aggregators.values():
+            await aggregator.stop()
@@ -1,7 +1,14 @@
 ''' Ammo producers '''
 from .util import get_opener, FactoryBase
-from .module_exceptions import ConfigurationError
-from .guns.http2 import Http2Ammo
+from .module_exceptions import ConfigurationError, AmmoFileError
+from collections import namedtuple
+from functools import lru_cache
+from itertools import count
+import numpy as np
+import struct
+import json
+import mmap
+import os
 import logging
 
 
@@ -10,26 +17,240 @@ logger = logging.getLogger(__name__)
 
 class LineReader(object):
 
-    ''' One line -- one missile '''
+    '''
+    One line -- one missile.
+
+    Random access to missiles is done through a memory mapped file and an
+    index of line offsets. The index is built once and cached on disk next
+    to the ammo file, so even huge files are opened in constant time.
+    Compressed files are loaded into memory instead. Call open() before
+    workers are forked: they get the mapped file and index from the
+    parent instead of indexing the file each on its own
+    '''
+    INDEX_MAGIC = b'BFGIDX01'
+    # magic, ammo file size, ammo file mtime (ns), number of lines
+    INDEX_HEADER = struct.Struct('<8sqqq')
+    SCAN_BLOCK = 64 * 1024 * 1024
 
     def __init__(self, filename, **kwargs):
         self.filename = filename
+        self.index_filename = filename + '.idx'
+        self.missiles = None
+        self.mmap = None
+        self.offsets = None
+
+    @staticmethod
+    def _parse(line):
+        parts = line.rstrip('\r\n').split(maxsplit=1)
+        if len(parts) == 2:
+            return (parts[1], parts[0])
+        elif len(parts) == 1:
+            return ("", parts[0])
+        else:
+            raise RuntimeError("Unreachable branch")
 
     def __iter__(self):
         logger.info("LineReader. Using '%s' as ammo source", self.filename)
-        with get_opener(self.filename)(self.filename, 'r') as ammo_file:
+        with get_opener(self.filename)(self.filename, 'rt') as ammo_file:
             while True:
                 for line in ammo_file:
-                    parts = line.rstrip('\r\n').split(maxsplit=1)
-                    if len(parts) == 2:
-                        yield (parts[1], parts[0])
-                    elif len(parts) == 1:
-                        yield ("", parts[0])
-                    else:
-                        raise RuntimeError("Unreachable branch")
+                    yield self._parse(line)
                 logger.debug("EOF. Restarting from the beginning")
                 ammo_file.seek(0)
 
+    def open(self):
+        '''
+        Map ammo file into memory and get its line index, or load
+        compressed file into memory. Missiles are read from the file
+        only after this is done, so it is done on first access if it
+        has not been done yet
+        '''
+        if self.filename.endswith('.gz'):
+            logger.info("LineReader. Loading '%s' into memory", self.filename)
+            with get_opener(self.filename)(self.filename, 'rt') as ammo_file:
+                self.missiles = [self._parse(line) for line in ammo_file]
+            if not self.missiles:
+                raise AmmoFileError("Ammo file is empty: %s" % self.filename)
+            return
+        with open(self.filename, 'rb') as ammo_file:
+            stat = os.fstat(ammo_file.fileno())
+            if not stat.st_size:
+                raise AmmoFileError("Ammo file is empty: %s" % self.filename)
+            self.mmap = mmap.mmap(
+                ammo_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = self._read_index(stat)
+        if self.offsets is None:
+            self.offsets = self._build_index(stat)
+
+    def _read_index(self, stat):
+        '''
+        Map the cached line index if it is there and is up to date
+        '''
+        try:
+            with open(self.index_filename, 'rb') as index_file:
+                header = index_file.read(self.INDEX_HEADER.size)
+        except OSError:
+            return None
+        if len(header) != self.INDEX_HEADER.size:
+            return None
+        magic, size, mtime, count = self.INDEX_HEADER.unpack(header)
+        if (magic, size, mtime) != (
+                self.INDEX_MAGIC, stat.st_size, stat.st_mtime_ns):
+            logger.info("Line index for '%s' is stale", self.filename)
+            return None
+        logger.info(
+            "LineReader. Using line index '%s', %d missiles",
+            self.index_filename, count)
+        return np.memmap(
+            self.index_filename, dtype='<i8', mode='r',
+            offset=self.INDEX_HEADER.size, shape=(count + 1,))
+
+    def _build_index(self, stat):
+        '''
+        Find line offsets in the mapped file and cache them on disk. The
+        cached index is mapped then, if it could not be saved, offsets are
+        kept in memory
+        '''
+        logger.info("LineReader. Indexing '%s'", self.filename)
+        size = len(self.mmap)
+        ends = [np.zeros(1, dtype='<i8')]
+        for start in range(0, size, self.SCAN_BLOCK):
+            block = np.frombuffer(
+                self.mmap, dtype=np.uint8,
+                count=min(self.SCAN_BLOCK, size - start), offset=start)
+            ends.append(np.flatnonzero(block == ord('\n')) + start + 1)
+        offsets = np.concatenate(ends).astype('<i8')
+        if offsets[-1] != size:
+            offsets = np.append(offsets, size)
+        count = len(offsets) - 1
+        logger.info("LineReader. %d missiles in '%s'", count, self.filename)
+        # workers may index the same file at the same time
+        tmp_filename = '%s.%d.tmp' % (self.index_filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as index_file:
+                index_file.write(self.INDEX_HEADER.pack(
+                    self.INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, count))
+                index_file.write(offsets.tobytes())
+            os.replace(tmp_filename, self.index_filename)
+        except OSError as e:
+            logger.warning(
+                "Could not save line index for '%s': %s", self.filename, e)
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
+            return offsets
+        return self._read_index(stat)
+
+    def __len__(self):
+        '''
+        Number of missiles in the file
+        '''
+        if self.mmap is None and self.missiles is None:
+            self.open()
+        if self.missiles is not None:
+            return len(self.missiles)
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        '''
+        Get n-th missile of the endless stream this reader produces
+        '''
+        if self.mmap is None and self.missiles is None:
+            self.open()
+        if self.missiles is not None:
+            return self.missiles[n % len(self.missiles)]
+        n %= len(self.offsets) - 1
+        return self._parse(
+            self.mmap[self.offsets[n]:self.offsets[n + 1]].decode('utf-8'))
+
+
+HttpRequest = namedtuple('HttpRequest', 'method,uri,headers,body,wire')
+HttpRequest.__doc__ = '''
+An HTTP request encoded for sending. Method, URI, header names and values
+and body are bytes; header names are lowercase, as HTTP/2 needs them.
+wire is the whole HTTP/1.1 request, ready to be written to a socket
+'''
+# headers that make no sense for a request stored in ammo
+HOP_BY_HOP_HEADERS = (b'connection', b'keep-alive', b'transfer-encoding')
+
+
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+
+def compile_request(method, uri, headers=None, body=None):
+    '''
+    Encode an HTTP request once, so that guns do not do it on every shot
+
+    >>> request = compile_request(
+    ...     'POST', '/form', {'Host': 'example.com'}, 'a=1')
+    >>> request.headers
+    {b'host': b'example.com', b'content-length': b'3'}
+    >>> request.wire
+    b'POST /form HTTP/1.1\\r\\nHost: example.com\\r\\ncontent-length: 3\\r\\n\\r\\na=1'
+    '''
+    method, uri = _to_bytes(method).upper(), _to_bytes(uri)
+    body = _to_bytes(body) if body else None
+    names = []
+    values = []
+    for name, value in (headers or {}).items():
+        name, value = _to_bytes(name).strip(), _to_bytes(value).strip()
+        if name.lower() not in HOP_BY_HOP_HEADERS:
+            names.append(name)
+            values.append(value)
+    if body and b'content-length' not in (name.lower() for name in names):
+        names.append(b'content-length')
+        values.append(str(len(body)).encode('ascii'))
+    wire = b''.join(
+        [b'%s %s HTTP/1.1\r\n' % (method, uri)] +
+        [b'%s: %s\r\n' % header for header in zip(names, values)] +
+        [b'\r\n', body or b''])
+    return HttpRequest(
+        method, uri,
+        {name.lower(): value for name, value in zip(names, values)},
+        body, wire)
+
+
+class HttpReader(LineReader):
+
+    '''
+    One line -- one HTTP request in JSON:
+
+        {"method": "POST", "uri": "/form", "headers": {"Host": "example.com"},
+         "body": "a=1", "marker": "form"}
+
+    Only uri is mandatory. Missiles are (marker, HttpRequest) pairs.
+    Requests are compiled when they are used, and up to CACHE_SIZE
+    recently used ones are kept compiled in every process, so memory does
+    not grow with the number of lines
+    '''
+    CACHE_SIZE = 4096
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self._request = lru_cache(maxsize=self.CACHE_SIZE)(
+            super().__getitem__)
+
+    @staticmethod
+    def _parse(line):
+        try:
+            request = json.loads(line)
+            return (
+                request.get('marker', ''),
+                compile_request(
+                    request.get('method', 'GET'), request['uri'],
+                    request.get('headers'), request.get('body')))
+        except (ValueError, KeyError, AttributeError) as e:
+            raise AmmoFileError("Bad HTTP request in ammo: %s (%s)" % (
+                line.strip(), e))
+
+    def __iter__(self):
+        logger.info("HttpReader. Using '%s' as ammo source", self.filename)
+        for n in count():
+            yield self[n]
+
+    def __getitem__(self, n):
+        return self._request(n % len(self))
+
 
 class Group(object):
 
@@ -37,13 +258,21 @@ class Group(object):
 
     def __init__(self, iterable, group_size):
         self.group_size = group_size
-        self.iterable = iter(iterable)
+        self.iterable = iterable
 
     def __iter__(self):
+        missiles = iter(self.iterable)
         while True:
             yield (
                 "multi-%s" % self.group_size,
-                [next(self.iterable) for _ in range(self.group_size)])
+                [next(missiles) for _ in range(self.group_size)])
+
+    def __getitem__(self, n):
+        first = n * self.group_size
+        return (
+            "multi-%s" % self.group_size,
+            [self.iterable[i]
+             for i in range(first, first + self.group_size)])
 
 
 class Http2AmmoProducer(object):
@@ -51,12 +280,32 @@ class Http2AmmoProducer(object):
     ''' Create HTTP/2 missiles from data '''
 
     def __init__(self, iterable):
-        self.iterable = iter(iterable)
+        self.iterable = iterable
 
     def __iter__(self):
-        while True:
-            ammo = next(self.iterable)
-            yield Http2Ammo("GET", ammo, {}, None)
+        for ammo in self.iterable:
+            yield compile_request("GET", ammo)
+
+
+def create(ammo_config):
+    '''
+    Create an ammo reader as defined in ammo config. The ammo file is
+    opened (and indexed, if needed) right away, so that it is done in
+    the main process and not in every worker
+    '''
+    readers = {
+        'line': LineReader,
+        'http': HttpReader,
+    }
+    ammo_format = ammo_config.get("format", "line")
+    if ammo_format not in readers:
+        raise ConfigurationError("Unknown ammo format: %s" % ammo_format)
+    ammo_reader = readers[ammo_format](ammo_config.get("file"))
+    ammo_reader.open()
+    batch_size = ammo_config.get("batch", 1)
+    if batch_size > 1:
+        ammo_reader = Group(ammo_reader, batch_size)
+    return ammo_reader
 
 
 class AmmoFactory(FactoryBase):
@@ -67,12 +316,7 @@ class AmmoFactory(FactoryBase):
         Return a _new_ reader every time
         '''
         if key in self.factory_config:
-            ammo_config = self.factory_config.get(key)
-            ammo_reader = LineReader(self.factory_config.get(key).get("file"))
-            batch_size = ammo_config.get("batch", 1)
-            if batch_size > 1:
-                ammo_reader = Group(ammo_reader, batch_size)
-            return ammo_reader
+            return create(self.factory_config.get(key))
         else:
             raise ConfigurationError(
                 "Configuration for %s ammo not found" % key)
@@ -9,6 +9,9 @@ import pytoml
 import json
 import sys
 from .loadtest import LoadTest
+from .plan import compile_plans
+from .raw import convert_to_tsv
+from .module_exceptions import CliArgumentError
 
 
 LOG = logging.getLogger(__name__)
@@ -43,33 +46,62 @@ def init_logging(debug=False, filename='bfg.log'):
     logging.getLogger().addHandler(dbg_handler)
 
 
-def main():
-    ''' Run test '''
-    config_filename = "load.yaml"
-    if len(sys.argv) > 1:
-        config_filename = sys.argv[1]
-
+def load_config(config_filename):
+    ''' Read config file, detect its format by extension '''
     filename_components = config_filename.split('.')
-    if len(filename_components) > 1:
-        extension = filename_components[-1]
-
-        with open(config_filename, 'rb') as fin:
-            if extension == 'toml':
-                config = pytoml.load(fin)
-            elif extension in ['yaml', 'yml']:
-                config = yaml.load(fin)
-            elif extension == 'json':
-                config = json.load(fin)
-            else:
-                print("Config file has unsupported format: %s" % extension)
-    else:
-        print(
+    if len(filename_components) < 2:
+        raise CliArgumentError(
             "Config file should have one of the following extensions:"
             " .toml, .json, .yaml")
+    extension = filename_components[-1]
+    with open(config_filename, 'rb') as fin:
+        if extension == 'toml':
+            return pytoml.load(fin)
+        elif extension in ['yaml', 'yml']:
+            return yaml.load(fin)
+        elif extension == 'json':
+            return json.load(fin)
+        else:
+            raise CliArgumentError(
+                "Config file has unsupported format: %s" % extension)
+
+
+def main():
+    '''
+    Run test:
+        bfg [config]
+
+    or compile load plans for BFGs that use plan cache:
+        bfg compile [config] [bfg names]
+
+    or convert binary raw samples to tab separated text:
+        bfg convert [raw samples file] [tsv file]
+    '''
+    args = sys.argv[1:]
+    command = 'run'
+    if args and args[0] in ('compile', 'convert'):
+        command = args.pop(0)
+    if command == 'convert':
+        if not args:
+            print("Usage: bfg convert [raw samples file] [tsv file]")
+            return 1
+        raw_filename = args[0]
+        tsv_filename = args[1] if len(args) > 1 else raw_filename + '.tsv'
+        count = convert_to_tsv(raw_filename, tsv_filename)
+        print("%d samples written to %s" % (count, tsv_filename))
+        return 0
+    config_filename = args.pop(0) if args else "load.yaml"
+    try:
+        config = load_config(config_filename)
+    except CliArgumentError as e:
+        print(e)
         return 1
     init_logging()
-    lt = LoadTest(config)
-    lt.run_test()
+    if command == 'compile':
+        compile_plans(config, args)
+    else:
+        lt = LoadTest(config)
+        lt.run_test()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,282 @@
+'''
+Columnar transport for samples.
+
+Workers write measurements into preallocated column arrays and send
+them to the aggregator as blocks, so neither a sample object nor its
+pickle is made per measurement.
+'''
+from .guns.base import Sample, PHASES
+import threading as th
+import numpy as np
+import time
+
+
+class ResultBlock(object):
+    '''
+    A block of samples in columns. String fields (bfg, marker, code,
+    scenario and action) are stored as ids in the block's own table of
+    values, ext is stored only for the samples that have it. Phases that
+    were not measured are NOT_MEASURED
+    '''
+    COLUMNS = np.dtype([
+        ('ts', np.int64),
+        ('rt', np.int64),
+        ('delay', np.int64),
+        ('error', np.bool_),
+        ('code', np.int32),
+        ('bfg', np.int32),
+        ('marker', np.int32),
+        ('scenario', np.int32),
+        ('action', np.int32),
+    ] + [(phase, np.int64) for phase in PHASES])
+    NOT_MEASURED = -1
+
+    def __init__(self, rows, values, ext):
+        self.rows = rows
+        self.values = values
+        self.ext = ext
+
+    INTERNED = ('code', 'bfg', 'marker', 'scenario', 'action')
+
+    @classmethod
+    def from_samples(cls, samples):
+        '''
+        Make a block of a list of samples
+        '''
+        rows = cls.empty(len(samples))
+        if not samples:
+            return cls(rows, [], {})
+        fields = list(zip(*samples))
+        ts, bfg, marker, rt, error, code, delay, scenario, action, ext = \
+            fields[:10]
+        rows['ts'], rows['rt'], rows['delay'], rows['error'] = \
+            ts, rt, delay, error
+        for phase, column in zip(PHASES, fields[10:]):
+            if any(value is not None for value in column):
+                rows[phase] = [
+                    cls.NOT_MEASURED if value is None else value
+                    for value in column]
+        ids = {}
+        for name, column in zip(
+                cls.INTERNED, (code, bfg, marker, scenario, action)):
+            for value in dict.fromkeys(column):
+                ids.setdefault(value, len(ids))
+            rows[name] = [ids[value] for value in column]
+        return cls(
+            rows, list(ids),
+            {number: value for number, value in enumerate(ext) if value})
+
+    @classmethod
+    def empty(cls, size):
+        '''
+        Rows with no phases measured
+        '''
+        rows = np.zeros(size, dtype=cls.COLUMNS)
+        for phase in PHASES:
+            rows[phase] = cls.NOT_MEASURED
+        return rows
+
+    @classmethod
+    def upgrade(cls, rows):
+        '''
+        Convert rows with other columns (written by an older version)
+        to the current columns
+        '''
+        if rows.dtype == cls.COLUMNS:
+            return rows
+        upgraded = cls.empty(len(rows))
+        for name in rows.dtype.names:
+            if name in cls.COLUMNS.names:
+                upgraded[name] = rows[name]
+        return upgraded
+
+    @classmethod
+    def concatenate(cls, blocks):
+        '''
+        Join blocks into one with a common table of values
+        '''
+        if len(blocks) == 1:
+            return blocks[0]
+        ids = {}
+        parts = []
+        ext = {}
+        offset = 0
+        for block in blocks:
+            mapping = np.array([
+                ids.setdefault(value, len(ids)) for value in block.values],
+                dtype=np.int32)
+            rows = block.rows.copy()
+            if len(mapping):
+                for name in cls.INTERNED:
+                    rows[name] = mapping[rows[name]]
+            parts.append(rows)
+            ext.update(
+                (offset + number, value) for number, value in block.ext.items())
+            offset += len(rows)
+        return cls(
+            np.concatenate(parts) if parts
+            else np.zeros(0, dtype=cls.COLUMNS),
+            list(ids), ext)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        '''
+        Samples from the block, one by one
+        '''
+        values = self.values
+        for number, row in enumerate(self.rows.tolist()):
+            ts, rt, delay, error, code, bfg, marker, scenario, action = \
+                row[:9]
+            yield Sample(
+                ts, values[bfg], values[marker], rt, error, values[code],
+                delay, values[scenario], values[action],
+                self.ext.get(number, {}),
+                *(None if value == self.NOT_MEASURED else value
+                  for value in row[9:]))
+
+    def split(self):
+        '''
+        Split the block into blocks for every second
+        '''
+        seconds = np.unique(self.rows['ts']).tolist()
+        if len(seconds) == 1:
+            return [(seconds[0], self)]
+        blocks = []
+        for second in seconds:
+            numbers = np.flatnonzero(self.rows['ts'] == second)
+            ext = {}
+            if self.ext:
+                ext = {
+                    new: self.ext[old]
+                    for new, old in enumerate(numbers.tolist())
+                    if old in self.ext}
+            blocks.append((
+                second, ResultBlock(self.rows[numbers], self.values, ext)))
+        return blocks
+
+
+class ColumnarBuffer(object):
+    '''
+    Per-worker buffer of samples in preallocated columns. A block is sent
+    to the results queue when the buffer is full or when flush_interval
+    seconds have passed since the previous one. A flusher thread sends it
+    on time even when no samples come, e.g. during a pause in the load.
+    Use it instead of the results queue: it also
+    accepts samples with put(). GunBase.measure() adds stopwatches with
+    record()
+    '''
+
+    def __init__(self, results_queue, size=4096, flush_interval=0.1):
+        self.results_queue = results_queue
+        self.size = size
+        self.flush_interval = flush_interval
+        self.lock = th.Lock()
+        self._reset()
+        self.flushed = time.monotonic()
+        self.closed = th.Event()
+        self.flusher = None
+        if flush_interval > 0:
+            self.flusher = th.Thread(
+                target=self._flush_periodically, daemon=True)
+            self.flusher.start()
+
+    def _reset(self):
+        self.rows = ResultBlock.empty(self.size)
+        self.ts, self.rt, self.delay, self.error, self.code, self.bfg, \
+            self.marker, self.scenario, self.action = (
+                self.rows[name] for name in ResultBlock.COLUMNS.names[:9])
+        self.phases = [self.rows[phase] for phase in PHASES]
+        self.ids = {}
+        self.ext = {}
+        self.count = 0
+
+    def _id(self, value):
+        '''
+        Intern a value in the block's table
+        '''
+        number = self.ids.get(value)
+        if number is None:
+            number = self.ids[value] = len(self.ids)
+        return number
+
+    def append(
+            self, ts, bfg, marker, rt, error, code, delay,
+            scenario, action, ext, *phases):
+        '''
+        Add a sample field by field, in the order of Sample fields
+        '''
+        with self.lock:
+            self._append(
+                ts, bfg, marker, rt, error, code, delay, scenario, action, ext,
+                *phases)
+            if self.count == self.size or \
+                    time.monotonic() - self.flushed >= self.flush_interval:
+                self._flush()
+
+    def _append(
+            self, ts, bfg, marker, rt, error, code, delay,
+            scenario, action, ext, *phases):
+        number = self.count
+        self.ts[number] = ts
+        self.rt[number] = rt
+        self.delay[number] = delay
+        self.error[number] = error
+        self.code[number] = self._id(code)
+        self.bfg[number] = self._id(bfg)
+        self.marker[number] = self._id(marker)
+        self.scenario[number] = self._id(scenario)
+        self.action[number] = self._id(action)
+        if ext:
+            self.ext[number] = ext
+        for column, value in zip(self.phases, phases):
+            if value is not None:
+                column[number] = value
+        self.count += 1
+
+    def put(self, sample):
+        self.append(*sample)
+
+    def record(self, sw):
+        '''
+        Add a measurement of a stopwatch without making a sample
+        '''
+        sw.record(self)
+
+    def _flush_periodically(self):
+        delay = self.flush_interval
+        while not self.closed.wait(delay):
+            with self.lock:
+                delay = self.flushed + self.flush_interval - time.monotonic()
+                if delay <= 0:
+                    self._flush()
+                    delay = self.flush_interval
+
+    def _flush(self):
+        self.flushed = time.monotonic()
+        if not self.count:
+            return
+        self.results_queue.put(self._block())
+
+    def _block(self):
+        '''
+        Take what is in the buffer as a block
+        '''
+        # ids are given in the order values are added to the table
+        block = ResultBlock(self.rows[:self.count], list(self.ids), self.ext)
+        self._reset()
+        return block
+
+    def flush(self):
+        '''
+        Send what is in the buffer
+        '''
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.closed.set()
+        if self.flusher:
+            self.flusher.join()
+        self.flush()
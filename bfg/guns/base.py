@@ -3,8 +3,10 @@ Measuring context. It also will send the results automatically
 '''
 
 from contextlib import contextmanager
+import asyncio
 import time
 from collections import namedtuple
+from ..timer import wall_time
 
 import logging
 logger = logging.getLogger(__name__)
@@ -30,36 +32,46 @@ Fields:
             'wait', or whatever. 'overall' action is reserved as a marker
             that this sample is for a whole scenario.
     ext: a dict of extended info. Some put {'error': "My Error Message"} in it
+    dns, connect, tls, ttfb, body: durations of the request phases, if the
+           gun measures them: name resolution, TCP connect, TLS handshake,
+           time from sending the request to the response headers, and
+           reading the response body. None if not measured
 '''
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'body')
 Sample = namedtuple(
-    'Sample', 'ts,bfg,marker,rt,error,code,delay,scenario,action,ext')
+    'Sample',
+    'ts,bfg,marker,rt,error,code,delay,scenario,action,ext,' +
+    ','.join(PHASES),
+    defaults=(None,) * len(PHASES))
 
 
 class StopWatch(object):
     '''
     Sample builder that automatically makes some assumptions about field values
     For example, start time is set to the time this object was created. Note
-    that StopWatch internal times are in seconds and Sample fields are in
-    milliseconds
+    that StopWatch internal times are monotonic clock nanoseconds (as well
+    as task.ts, the planned start time) and Sample fields are in
+    microseconds, except for ts that is wall clock second
     '''
     def __init__(self, task):
         self.task = task
-        self.start_time = time.time()
+        self.start_time = time.monotonic_ns()
         self.end_time = self.start_time
         self.error = False
         self.code = None
         self.scenario = None
         self.action = None
         self.ext = {}
+        self.phases = {}
         self.stopped = False
 
     def start(self):
-        self.start_time = time.time()
+        self.start_time = time.monotonic_ns()
 
     def stop(self):
         if not self.stopped:
             self.stopped = True
-            self.end_time = time.time()
+            self.end_time = time.monotonic_ns()
 
     def set_error(self, code=None):
         if code:
@@ -69,19 +81,56 @@ class StopWatch(object):
     def set_code(self, code):
         self.code = code
 
+    def set_phase(self, phase, duration):
+        '''
+        Set duration of a request phase (one of PHASES), in nanoseconds
+        '''
+        self.phases[phase] = duration // 1000
+
+    @contextmanager
+    def phase(self, phase):
+        '''
+        Measure a request phase
+        '''
+        start = time.monotonic_ns()
+        try:
+            yield
+        finally:
+            self.set_phase(phase, time.monotonic_ns() - start)
+
     def as_sample(self):
-        overall = int((self.end_time - self.start_time) * 1e6)
+        overall = (self.end_time - self.start_time) // 1000
         return Sample(
-            int(self.start_time),
+            int(wall_time(self.start_time)),
             self.task.bfg,
             self.task.marker,
             overall,
             self.error,
             self.code,
-            int((self.start_time - self.task.ts) * 1e6),
+            (self.start_time - self.task.ts) // 1000,
             self.scenario,
             self.action,
             self.ext,
+            *(self.phases.get(phase) for phase in PHASES)
+        )
+
+    def record(self, columns):
+        '''
+        Append the measurement to a columnar buffer without making
+        a sample. Fields are the same as in as_sample()
+        '''
+        columns.append(
+            int(wall_time(self.start_time)),
+            self.task.bfg,
+            self.task.marker,
+            (self.end_time - self.start_time) // 1000,
+            self.error,
+            self.code,
+            (self.start_time - self.task.ts) // 1000,
+            self.scenario,
+            self.action,
+            self.ext,
+            *(self.phases.get(phase) for phase in PHASES)
         )
 
 
@@ -108,7 +157,12 @@ class GunBase(object):
             raise e
         finally:
             sw.stop()
-            self.results.put(sw.as_sample())
+            # a columnar buffer takes measurements without samples
+            record = getattr(self.results, 'record', None)
+            if record is not None:
+                record(sw)
+            else:
+                self.results.put(sw.as_sample())
 
     def setup(self):
         pass
@@ -119,3 +173,17 @@ class GunBase(object):
 
     def teardown(self):
         pass
+
+    async def async_setup(self):
+        self.setup()
+
+    async def async_shoot(self, task):
+        '''
+        Coroutine version of shoot() used by async workers. Guns that are
+        able to hold many requests in flight should override it. By default
+        blocking shoot() is run in the event loop's executor
+        '''
+        await asyncio.get_event_loop().run_in_executor(None, self.shoot, task)
+
+    async def async_teardown(self):
+        self.teardown()
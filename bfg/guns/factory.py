@@ -2,6 +2,7 @@
 Gun factory. Returns a gun of requested type
 '''
 from .http2 import HttpMultiGun
+from .http import HttpGun
 from .ultimate import UltimateGun
 from ..util import FactoryBase
 from ..module_exceptions import ConfigurationError
@@ -17,6 +18,7 @@ class GunFactory(FactoryBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.guns = {
+            'http': HttpGun,
             'http2': HttpMultiGun,
             'ultimate': UltimateGun,
         }
@@ -0,0 +1,427 @@
+'''
+Gun for HTTP/1.1
+'''
+import asyncio
+import socket
+import time
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+from .base import GunBase
+from .tls import SessionContext
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+class NotProcessed(ConnectionClosed):
+    '''
+    The connection was closed before the server began to respond to
+    the request, so the request can be sent again
+    '''
+    pass
+
+
+class HttpConnection(object):
+    '''
+    A keep-alive HTTP/1.1 connection. Requests are written as they come
+    and responses are read in the same order by a reader task, so up to
+    `pipeline` requests may be in flight at once. If anything goes wrong,
+    the connection is closed and the request whose response was being
+    read fails. Requests queued behind it, and all requests if the
+    server closes the connection between responses, fail with
+    NotProcessed. Requests made in one event loop iteration are written
+    with one call.
+
+    Name resolution, TCP connect and TLS handshake are done one by one,
+    their durations (ns) are kept in timings. The TLS session is given
+    to the context to resume once the first response has come
+    '''
+
+    def __init__(self, host, port, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.reader = None
+        self.writer = None
+        self.pending = deque()
+        self.output = []
+        # requests that are in flight or waiting for the connection
+        self.load = 0
+        self.closed = False
+        self.connecting = None
+        self.timings = {}
+        self.ssl_object = None
+        self.reader_task = None
+
+    async def connect(self):
+        '''
+        Connect, if it has not been done yet
+        '''
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(self._connect())
+        await asyncio.shield(self.connecting)
+
+    async def _connect(self):
+        loop = asyncio.get_event_loop()
+        started = time.monotonic_ns()
+        family, kind, proto, _, address = (await loop.getaddrinfo(
+            self.host, self.port, type=socket.SOCK_STREAM))[0]
+        resolved = time.monotonic_ns()
+        sock = socket.socket(family, kind, proto)
+        try:
+            sock.setblocking(False)
+            await loop.sock_connect(sock, address)
+        except BaseException:
+            sock.close()
+            raise
+        self.reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(self.reader)
+        transport, _ = await loop.create_connection(
+            lambda: protocol, sock=sock)
+        connected = time.monotonic_ns()
+        self.timings = {
+            'dns': resolved - started, 'connect': connected - resolved}
+        if self.ssl_context:
+            try:
+                transport = await loop.start_tls(
+                    transport, protocol, self.ssl_context,
+                    server_hostname=self.host)
+            except BaseException:
+                transport.close()
+                raise
+            self.timings['tls'] = time.monotonic_ns() - connected
+            self.ssl_object = transport.get_extra_info('ssl_object')
+        self.writer = asyncio.StreamWriter(
+            transport, protocol, self.reader, loop)
+        self.reader_task = asyncio.ensure_future(self._read())
+
+    async def request(self, wire, head=False, timeout=None):
+        '''
+        Send a request and wait for the response. Returns the response
+        status and durations (ns) of waiting for the response headers
+        (ttfb) and of reading the body
+        '''
+        if self.closed:
+            raise NotProcessed("Connection is closed")
+        loop = asyncio.get_event_loop()
+        response = loop.create_future()
+        self.pending.append((response, head))
+        if not self.output:
+            loop.call_soon(self._flush)
+        self.output.append(wire)
+        sent = time.monotonic_ns()
+        timer = None
+        if timeout is not None:
+            timer = loop.call_later(timeout, self._expire, response)
+        try:
+            status, headers_read, body_read = await response
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return status, {
+            'ttfb': headers_read - sent, 'body': body_read - headers_read}
+
+    def _flush(self):
+        if not self.closed:
+            self.writer.write(b''.join(self.output))
+        self.output = []
+
+    @staticmethod
+    def _expire(response):
+        if not response.done():
+            response.set_exception(asyncio.TimeoutError())
+
+    async def _read(self):
+        try:
+            while True:
+                status, headers_read, keep_alive = await self._response()
+                response, _ = self.pending.popleft()
+                if not response.done():
+                    response.set_result(
+                        (status, headers_read, time.monotonic_ns()))
+                if self.ssl_object is not None:
+                    self.ssl_context.remember(self.ssl_object)
+                    self.ssl_object = None
+                if not keep_alive:
+                    self.reader_task = None
+                    self.close()
+                    return
+        except asyncio.CancelledError:
+            self.reader_task = None
+            self.close()
+        except Exception as e:
+            self.reader_task = None
+            self.close(e)
+
+    async def _response(self):
+        '''
+        Read a response. Only the status line and the headers that
+        framing depends on are parsed, the body is skipped. Interim 1xx
+        responses are skipped too
+        '''
+        reader = self.reader
+        interim = False
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError as e:
+                if not e.partial and not interim:
+                    raise NotProcessed("Connection closed by server")
+                raise
+            headers_read = time.monotonic_ns()
+            if not self.pending:
+                raise ConnectionClosed("Response without a request")
+            status = int(head[9:12])
+            # interim responses (100 Continue, 103 Early Hints) come before
+            # the final one, 101 Switching Protocols is final
+            if not 100 <= status < 200 or status == 101:
+                break
+            interim = True
+        status_end = head.index(b'\r\n')
+        keep_alive = not head.startswith(b'HTTP/1.0')
+        length = None
+        chunked = False
+        for line in head[status_end + 2:-4].split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            if name == b'content-length':
+                length = int(value)
+            elif name == b'transfer-encoding':
+                chunked = b'chunked' in value.lower()
+            elif name == b'connection':
+                value = value.strip().lower()
+                if value == b'close':
+                    keep_alive = False
+                elif value == b'keep-alive':
+                    keep_alive = True
+        if self.pending[0][1] or status < 200 or status in (204, 304):
+            return status, headers_read, keep_alive
+        if chunked:
+            while True:
+                size = int(
+                    (await reader.readuntil(b'\r\n')).split(b';', 1)[0], 16)
+                if not size:
+                    # trailers end with an empty line
+                    while await reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    break
+                await reader.readexactly(size + 2)
+        elif length is not None:
+            await reader.readexactly(length)
+        else:
+            await reader.read()
+            keep_alive = False
+        return status, headers_read, keep_alive
+
+    def close(self, error=None):
+        '''
+        Close the connection. The first request in flight fails with
+        error, if there is one, the rest fail with NotProcessed
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+        elif self.connecting is not None:
+            self.connecting.cancel()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        not_processed = NotProcessed("Connection closed before response")
+        error = error or not_processed
+        while self.pending:
+            response, _ = self.pending.popleft()
+            if not response.done():
+                response.set_exception(error)
+            error = not_processed
+
+
+class ConnectionPool(object):
+    '''
+    Up to `size` connections to one host, each carrying up to `pipeline`
+    requests at once. A request goes to an idle connection first, then
+    to a new one, then to the least loaded one. When all of them are
+    full, it waits. A request that the server has not processed (see
+    NotProcessed) is sent again, up to `pipeline` times
+    '''
+
+    def __init__(self, host, port, ssl_context=None, size=10, pipeline=1):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.size = size
+        self.pipeline = pipeline
+        self.connections = []
+        self.slots = None
+
+    async def request(self, wire, head=False, timeout=None):
+        '''
+        Send a request and wait for the response. Returns the status
+        and durations of request phases, connection phases included if
+        the request has made the connection. Timeout is for connecting
+        and for the response, each
+        '''
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.size * self.pipeline)
+        async with self.slots:
+            retries = self.pipeline
+            while True:
+                try:
+                    return await self._request(wire, head, timeout)
+                except NotProcessed as e:
+                    if not retries:
+                        raise
+                    retries -= 1
+                    logger.debug("Sending a request again: %s", e)
+
+    async def _request(self, wire, head, timeout):
+        connection = self._connection()
+        connection.load += 1
+        try:
+            made = connection.connecting is None
+            if connection.writer is None:
+                await asyncio.wait_for(connection.connect(), timeout)
+            status, timings = await connection.request(wire, head, timeout)
+            if made:
+                timings.update(connection.timings)
+            return status, timings
+        except (Exception, asyncio.CancelledError):
+            # the connection state is unknown after a failure or timeout
+            connection.close()
+            raise
+        finally:
+            connection.load -= 1
+            if connection.closed and connection in self.connections:
+                self.connections.remove(connection)
+
+    def _connection(self):
+        connections = [
+            connection for connection in self.connections
+            if not connection.closed]
+        self.connections = connections
+        idle = [
+            connection for connection in connections if not connection.load]
+        if idle:
+            return idle[0]
+        if len(connections) < self.size:
+            connection = HttpConnection(
+                self.host, self.port, self.ssl_context)
+            connections.append(connection)
+            return connection
+        return min(connections, key=lambda connection: connection.load)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+
+class HttpGun(GunBase):
+    '''
+    HTTP/1.1 gun. task.data is a request: either an URI to GET or an
+    HttpRequest compiled by ammo reader, which is sent as is (a Host
+    header is added if there is none). Every worker keeps a pool of
+    keep-alive connections to the target. A sample is measured for every
+    request, its code is the response status, and its phases are set:
+    ttfb and body for every request, dns, connect and tls for requests
+    that made a new connection. Requests that fail to get a response
+    are errors, with the reason in ext. Requests that the server closed
+    the connection before (see NotProcessed) are sent again, and if
+    they are still not processed, their samples have 'not_processed'
+    action instead of an error. TLS sessions are handled as
+    tls_sessions option says, see SessionContext
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        target = self.get_option('target')
+        if '//' not in target:
+            target = '//' + target
+        address = urlsplit(target)
+        use_ssl = self.get_option('ssl', address.scheme == 'https')
+        self.host = address.hostname
+        self.port = address.port or (443 if use_ssl else 80)
+        self.host_header = b'Host: %s\r\n' % address.netloc.encode('idna')
+        self.pool_size = self.get_option('pool_size', 10)
+        self.pipeline = self.get_option('pipeline', 1)
+        self.timeout = self.get_option('timeout', 10)
+        self.ssl_context = None
+        if use_ssl:
+            self.ssl_context = SessionContext(
+                self.get_option('tls_sessions', 'resume'))
+            if self.ssl_context.mode == 'shared':
+                self.ssl_context.prime(self.host, self.port, self.timeout)
+        self.pool = None
+        self.loop = None
+        logger.info(
+            "Initialized http gun with target %s:%s, %d connections, "
+            "pipeline depth %d", self.host, self.port, self.pool_size,
+            self.pipeline)
+
+    def _pool(self):
+        return ConnectionPool(
+            self.host, self.port, self.ssl_context,
+            self.pool_size, self.pipeline)
+
+    def setup(self):
+        '''
+        Sync workers shoot in a private event loop
+        '''
+        self.loop = asyncio.new_event_loop()
+        self.pool = self._pool()
+
+    def teardown(self):
+        self.pool.close()
+        # let the cancelled readers finish
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    async def async_setup(self):
+        self.pool = self._pool()
+
+    async def async_teardown(self):
+        self.pool.close()
+
+    def shoot(self, task):
+        self.loop.run_until_complete(self.async_shoot(task))
+
+    def _wire(self, request):
+        if isinstance(request, str):
+            return b'GET %s HTTP/1.1\r\n%s\r\n' % (
+                request.encode('utf-8'), self.host_header), False
+        wire = request.wire
+        if b'host' not in request.headers:
+            line_end = wire.index(b'\r\n') + 2
+            wire = wire[:line_end] + self.host_header + wire[line_end:]
+        return wire, request.method == b'HEAD'
+
+    async def async_shoot(self, task):
+        wire, head = self._wire(task.data)
+        with self.measure(task) as sw:
+            sw.action = "request"
+            try:
+                status, timings = await self.pool.request(
+                    wire, head, self.timeout)
+            except NotProcessed as e:
+                # not an error of the target: the request was not shot
+                sw.stop()
+                sw.action = "not_processed"
+                sw.ext['error'] = str(e)
+                logger.debug("Request was not processed: %s", e)
+            except (OSError, ConnectionClosed, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError, asyncio.TimeoutError,
+                    ValueError) as e:
+                sw.stop()
+                sw.set_error()
+                sw.ext['error'] = str(e) or e.__class__.__name__
+                logger.debug("Request failed: %s", e)
+            else:
+                sw.stop()
+                sw.set_code(status)
+                for phase, duration in timings.items():
+                    sw.set_phase(phase, duration)
@@ -2,25 +2,169 @@
 Guns for HTTP/2
 '''
 import logging
-from collections import namedtuple
-from hyper import HTTP20Connection, tls
+import threading as th
+import time
 import ssl
-from hyper.http20.exceptions import ConnectionError
+from hyper import HTTP20Connection, tls
+from hyper.common.util import to_host_port_tuple
+from hyper.http20.exceptions import HTTP20Error, StreamResetError
+from h2.exceptions import H2Error, TooManyStreamsError
 from .base import GunBase
-
-Http2Ammo = namedtuple("Http2Ammo", "method,uri,headers,body")
+from .tls import SessionContext
 
 
 logger = logging.getLogger(__name__)
 
 
+# PooledConnection relies on private attributes of hyper 0.7.0 (it is
+# pinned in setup.py): HTTP20Connection._sock is the socket wrapper,
+# which hyper sets to None when the server says GOAWAY, _sock._sck is
+# the ssl socket in it and _conn is the h2 connection state machine.
+# Check them when upgrading hyper.
+
+# errors after which a connection can not be used any more
+CONNECTION_ERRORS = (HTTP20Error, H2Error, OSError, KeyError)
+
+
+class PooledConnection(object):
+    '''
+    An HTTP/2 connection that knows how many streams are open on it and
+    can be re-established after it has failed or has been closed by the
+    server. generation is incremented on every connect and failure, so
+    a connection is not closed because of a failure of streams that were
+    opened before it was re-established. The TLS session of a connection
+    is given to the context to resume once a response has come
+    '''
+
+    def __init__(self, address, ssl_context):
+        self.conn = HTTP20Connection(
+            address, secure=True, ssl_context=ssl_context)
+        self.ssl_context = ssl_context
+        self.lock = th.RLock()
+        self.streams = 0
+        self.connected = False
+        self.fresh = False
+        self.connects = 0
+        self.generation = 0
+
+    @property
+    def alive(self):
+        # hyper private attribute: the socket is dropped on GOAWAY
+        return self.connected and self.conn._sock is not None
+
+    def max_streams(self, limit):
+        '''
+        The server's MAX_CONCURRENT_STREAMS, but not more than limit
+        '''
+        if not self.alive:
+            return limit
+        try:
+            # hyper private attribute: the h2 connection, under its lock
+            with self.conn._conn as h2_conn:
+                return min(
+                    limit, h2_conn.remote_settings.max_concurrent_streams)
+        except AttributeError:
+            return limit
+
+    def connect(self):
+        '''
+        Connect if not connected. Returns False if it was connected
+        '''
+        if self.alive:
+            return False
+        self.generation += 1
+        self.conn.connect()
+        self.connected = True
+        self.fresh = True
+        self.connects += 1
+        return True
+
+    def remember_session(self):
+        with self.lock:
+            if not self.fresh or not self.alive:
+                return
+            self.fresh = False
+            # hyper private attribute: the ssl socket of the connection
+            self.ssl_context.remember(self.conn._sock._sck)
+
+    def fail(self, generation):
+        '''
+        Close the connection after a failure, it will be re-established
+        by the next request
+        '''
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.generation += 1
+            self.connected = False
+        try:
+            self.conn.close()
+        except Exception as e:
+            logger.debug("Error closing a failed connection: %s", e)
+
+
+class ConnectionPool(object):
+    '''
+    Up to size HTTP/2 connections to one address. Requests from many
+    threads are multiplexed across them: a stream is opened on the least
+    loaded connection that has fewer streams than the server allows
+    (and than max_streams). When all of them are full, it waits
+    '''
+
+    def __init__(self, address, ssl_context, size=1, max_streams=100):
+        self.max_streams = max_streams
+        self.connections = [
+            PooledConnection(address, ssl_context) for _ in range(size)]
+        self.condition = th.Condition()
+
+    def acquire(self, wait=True):
+        '''
+        Take a stream slot on a connection. Without wait, the least loaded
+        connection is taken even if it is full: a task that already holds
+        slots must not wait for others, or tasks may wait for each other
+        '''
+        with self.condition:
+            while True:
+                free = [
+                    connection for connection in self.connections
+                    if connection.streams <
+                    connection.max_streams(self.max_streams)]
+                if free or not wait:
+                    connection = min(
+                        free or self.connections,
+                        key=lambda connection: connection.streams)
+                    connection.streams += 1
+                    return connection
+                self.condition.wait()
+
+    def release(self, connection):
+        with self.condition:
+            connection.streams -= 1
+            self.condition.notify()
+
+    def close(self):
+        for connection in self.connections:
+            connection.fail(connection.generation)
+
+
 class HttpMultiGun(GunBase):
     '''
-    Multi request gun. Only GET. Expects an array of (marker, request)
-    tuples in task.data. A stream is opened for every request first and
+    Multi request gun. Expects an array of (marker, request) tuples in
+    task.data, or a single request. A request is either an URI to GET or
+    an HttpRequest compiled by ammo reader, which is sent without any
+    encoding. A stream is opened for every request first and
     responses are readed after all streams have been opened. A sample is
     measured for every action and for overall time for a whole batch.
     The sample for overall time is marked with 'overall' in action field.
+
+    Every worker keeps a pool of pool_size connections, and streams of
+    concurrent tasks (from an async worker) are multiplexed across them.
+    A connection that fails is re-established by the next request that
+    gets it; connecting is measured as a 'connect' or 'reconnect' action
+    (with connect phase set; hyper connects and does TLS handshake in one
+    call, so it includes the handshake). Responses have ttfb and body
+    phases set. TLS sessions are handled as tls_sessions option says,
+    see SessionContext
     '''
     SECTION = 'http_gun'
 
@@ -28,46 +172,139 @@ class HttpMultiGun(GunBase):
         super().__init__(*args, **kwargs)
         self.base_address = self.get_option('target')
         logger.info("Initialized http2 gun with target '%s'", self.base_address)
-        context = tls.init_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        self.conn = HTTP20Connection(self.base_address, secure=True, ssl_context=context)
+        context = SessionContext(self.get_option('tls_sessions', 'resume'))
+        context.set_alpn_protocols(tls.SUPPORTED_NPN_PROTOCOLS)
+        # required by the spec
+        context.options |= ssl.OP_NO_COMPRESSION
+        if context.mode == 'shared':
+            context.prime(*to_host_port_tuple(
+                self.base_address, default_port=443))
+        self.pool = ConnectionPool(
+            self.base_address, context,
+            self.get_option('pool_size', 1),
+            self.get_option('max_streams', 100))
+
+    def teardown(self):
+        self.pool.close()
 
     def shoot(self, task):
         logger.debug("Task: %s", task)
         scenario = task.marker
+        missiles = task.data
+        if not isinstance(missiles, list):
+            missiles = [(task.marker, missiles)]
         subtasks = [
             task._replace(data=missile[1], marker=missile[0])
-            for missile in task.data
+            for missile in missiles
         ]
         streams = []
         with self.measure(task) as overall_sw:
-            for subtask in subtasks:
-                with self.measure(subtask) as sw:
-                    logger.debug("Request GET %s", subtask.data)
-                    streams.append(
-                        (subtask, self.conn.request('GET', subtask.data)))
-                    sw.stop()
-                    sw.scenario = scenario
-                    sw.action = "request"
-            for (subtask, stream) in streams:
-                with self.measure(subtask) as sw:
-                    logger.debug("Response for %s from %s ", subtask.data, stream)
+            try:
+                for subtask in subtasks:
+                    connection = self.pool.acquire(wait=not streams)
                     try:
-                        resp = self.conn.get_response(stream)
-                    except (ConnectionError, KeyError) as e:
-                        sw.stop()
-                        # TODO: try to add a meaningful code here
-                        sw.set_error(1)
-                        overall_sw.set_error(1)
-                        sw.ext["error"] = str(e)
-                        overall_sw.ext.setdefault('error', []).append(str(e))
-                        logger.warning("Error getting response: %s", str(e))
+                        stream = self._open(
+                            subtask, scenario, connection, overall_sw)
+                    except BaseException:
+                        # the slot is not in streams yet
+                        self.pool.release(connection)
+                        raise
+                    if stream is None:
+                        self.pool.release(connection)
                     else:
-                        sw.stop()
-                        sw.set_code(str(resp.status))
-                    sw.scenario = scenario
-                    sw.action = "response"
+                        streams.append((subtask, connection) + stream)
+                while streams:
+                    subtask, connection, generation, stream, sent = \
+                        streams.pop(0)
+                    try:
+                        self._response(
+                            subtask, scenario, connection, generation,
+                            stream, sent, overall_sw)
+                    finally:
+                        self.pool.release(connection)
+            finally:
+                for _, connection, _, _, _ in streams:
+                    self.pool.release(connection)
             overall_sw.stop()
             overall_sw.scenario = scenario
             overall_sw.action = "overall"
+
+    def _open(self, subtask, scenario, connection, overall_sw):
+        '''
+        Connect if needed and open a stream for a subtask. Returns
+        the connection generation, the stream id and the time it was
+        opened, or None if failed
+        '''
+        with connection.lock:
+            if not connection.alive:
+                with self.measure(subtask) as sw:
+                    sw.scenario = scenario
+                    sw.action = "reconnect" if connection.connects \
+                        else "connect"
+                    try:
+                        with sw.phase('connect'):
+                            connection.connect()
+                    except CONNECTION_ERRORS as e:
+                        sw.stop()
+                        self._error(sw, overall_sw, e)
+                        connection.fail(connection.generation)
+                        return None
+            generation = connection.generation
+        with self.measure(subtask) as sw:
+            sw.scenario = scenario
+            sw.action = "request"
+            logger.debug("Request %s", subtask.data)
+            try:
+                stream = self._request(connection.conn, subtask.data)
+                sent = time.monotonic_ns()
+            except CONNECTION_ERRORS as e:
+                sw.stop()
+                self._error(sw, overall_sw, e)
+                if not isinstance(e, TooManyStreamsError):
+                    connection.fail(generation)
+                return None
+        return generation, stream, sent
+
+    def _response(
+            self, subtask, scenario, connection, generation, stream, sent,
+            overall_sw):
+        '''
+        Read a response for a stream. A failed stream fails its
+        connection, unless it was reset alone
+        '''
+        with self.measure(subtask) as sw:
+            logger.debug("Response for %s from %s ", subtask.data, stream)
+            try:
+                resp = connection.conn.get_response(stream)
+                sw.set_phase('ttfb', time.monotonic_ns() - sent)
+                with sw.phase('body'):
+                    resp.read()
+            except CONNECTION_ERRORS as e:
+                sw.stop()
+                self._error(sw, overall_sw, e)
+                if not isinstance(e, StreamResetError):
+                    connection.fail(generation)
+            else:
+                sw.stop()
+                sw.set_code(str(resp.status))
+                connection.remember_session()
+            sw.scenario = scenario
+            sw.action = "response"
+
+    @staticmethod
+    def _error(sw, overall_sw, e):
+        # TODO: try to add a meaningful code here
+        sw.set_error(1)
+        overall_sw.set_error(1)
+        sw.ext["error"] = str(e)
+        overall_sw.ext.setdefault('error', []).append(str(e))
+        logger.warning("Error: %s", str(e))
+
+    def _request(self, conn, request):
+        '''
+        Open a stream for a request and return its id
+        '''
+        if isinstance(request, str):
+            return conn.request('GET', request)
+        return conn.request(
+            request.method, request.uri, request.body, request.headers)
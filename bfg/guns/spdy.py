@@ -5,17 +5,26 @@ import logging
 import select
 import ssl
 import socket
+import asyncio
+import threading as th
+from collections import deque
 import spdylay
 from .base import GunBase, StopWatch
+from .tls import SessionContext
 
 logger = logging.getLogger(__name__)
 
 
 class SpdyTaskHandler(object):
-    def __init__(self, task, scenario, results):
+    '''
+    Measures one stream. finished is called when the stream is over
+    '''
+
+    def __init__(self, task, scenario, results, finished):
         self.task = task
         self.scenario = scenario
         self.results = results
+        self.finished = finished
         self.stream_id = None
         self.sw = None
         self.is_finished = False
@@ -30,12 +39,21 @@ class SpdyTaskHandler(object):
         self.sw.action = 'request'
 
     def on_error(self, error_code=None):
-        assert(self.sw is not None)
+        if self.is_finished:
+            return
+        if self.sw is None:
+            # failed before the request was sent
+            self.sw = StopWatch(self.task)
+            self.sw.scenario = self.scenario
+            self.sw.action = 'request'
 
         self.sw.stop()
         self.sw.set_error(error_code)
+        self.results.put(self.sw.as_sample())
+        self.sw = None
         self.is_failed = True
         self.is_finished = True
+        self.finished()
 
     def on_request_sent(self):
         assert(self.sw is not None)
@@ -82,15 +100,59 @@ class SpdyTaskHandler(object):
 
         self.sw = None
         self.is_finished = True
+        self.finished()
+
+
+class SpdyTask(object):
+    '''
+    Streams of one task. The overall sample is sent and done is called
+    when all of them have finished
+    '''
+
+    def __init__(self, task, results, done):
+        self.results = results
+        self.done = done
+        self.overall_sw = StopWatch(task)
+        self.overall_sw.scenario = task.marker
+        self.overall_sw.action = 'overall'
+        self.handlers = [
+            SpdyTaskHandler(
+                task._replace(data=missile[1], marker=missile[0]),
+                task.marker, results, self._finished)
+            for missile in task.data
+        ]
+        self.left = len(self.handlers)
+        if not self.left:
+            self._finished()
+
+    def _finished(self):
+        self.left -= 1
+        if self.left > 0:
+            return
+        self.overall_sw.stop()
+        if any(handler.is_failed for handler in self.handlers):
+            self.overall_sw.set_error()
+        self.results.put(self.overall_sw.as_sample())
+        self.done()
 
 
 class SpdyMultiGun(GunBase):
     '''
     Multi request gun. Only GET. Expects an array of (marker, request)
-    tuples in task.data. A stream is opened for every request first and
-    responses are readed after all streams have been opened. A sample is
-    measured for every action and for overall time for a whole batch.
-    The sample for overall time is marked with 'overall' in action field.
+    tuples in task.data. A stream is opened for every request and a
+    sample is measured for every action and for overall time for a whole
+    batch. The sample for overall time is marked with 'overall' in
+    action field.
+
+    Every worker keeps one SPDY session open across tasks. The session
+    is served by a background I/O thread: tasks are handed over to it
+    and new streams are opened while streams of earlier tasks are still
+    in flight, so an async worker keeps as many tasks on one connection
+    as its concurrency allows (a sync worker still waits for every
+    task). Data is read into a reusable buffer of buffer_size bytes and
+    frames are written in batches of up to about as much. If the
+    connection fails, its streams fail and the next task reconnects. TLS
+    sessions are handled as tls_sessions option says, see SessionContext.
 
     Based on UrlFetcher from python-spdylay.
     '''
@@ -106,20 +168,51 @@ class SpdyMultiGun(GunBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.base_address = self.get_option('target')
+        self.buffer = bytearray(self.get_option('buffer_size', 262144))
         logger.info("Initialized spdy gun with target '%s'", self.base_address)
 
-        self.ctx = None
+        # sessions belong to the context, so it is kept across connections
+        self.ctx = SessionContext(self.get_option('tls_sessions', 'resume'))
+        self.ctx.options |= ssl.OP_ALL | ssl.OP_NO_COMPRESSION
+        self.ctx.set_npn_protocols(spdylay.get_npn_protocols())
+        if self.ctx.mode == 'shared':
+            self.ctx.prime(self.base_address, 443)
+
         self.sock = None
         self.session = None
+        self.fresh = False
+        self.output = bytearray()
+        # tasks handed over to the I/O thread
+        self.submitted = deque()
+        # streams of the current session that have not finished yet
+        self.handlers = set()
+        self.wakeup = None
+        self.io_thread = None
+        self.closing = False
+
+    def setup(self):
+        '''
+        Start the I/O thread. It is done in the worker process, after fork
+        '''
+        self.closing = False
+        self.wakeup = socket.socketpair()
+        for end in self.wakeup:
+            end.setblocking(False)
+        self.io_thread = th.Thread(
+            target=self._io, name='spdy-io', daemon=True)
+        self.io_thread.start()
+
+    def teardown(self):
+        self.closing = True
+        self._wake()
+        self.io_thread.join()
+        for end in self.wakeup:
+            end.close()
 
     def connect(self):
-        self.ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        self.ctx.options = (
-            ssl.OP_ALL | ssl.OP_NO_SSLv2 | ssl.OP_NO_COMPRESSION)
-        self.ctx.set_npn_protocols(spdylay.get_npn_protocols())
-
         self.sock = socket.create_connection((self.base_address, 443))
-        self.sock = self.ctx.wrap_socket(self.sock)
+        self.sock = self.ctx.wrap_socket(
+            self.sock, server_hostname=self.base_address)
 
         version = spdylay.npn_get_version(self.sock.selected_npn_protocol())
         if version == 0:
@@ -129,6 +222,7 @@ class SpdyMultiGun(GunBase):
             self.SPDY_VERSIONS.get(version, 'unknown'))
 
         self.sock.setblocking(False)
+        self.fresh = True
         self.session = spdylay.Session(
             spdylay.CLIENT,
             version,
@@ -147,7 +241,9 @@ class SpdyMultiGun(GunBase):
         )
 
     def send_cb(self, session, data):
-        return self.sock.send(data)
+        # frames are collected and written by the I/O loop in batches
+        self.output += data
+        return len(data)
 
     def before_ctrl_send_cb(self, session, frame):
         if frame.frame_type == spdylay.SYN_STREAM:
@@ -171,68 +267,146 @@ class SpdyMultiGun(GunBase):
 
     def on_stream_close_cb(self, session, stream_id, status_code):
         handler = session.get_stream_user_data(stream_id)
+        self.handlers.discard(handler)
         if status_code == spdylay.OK:
             handler.on_response_end()
+            if self.fresh:
+                self.fresh = False
+                self.ctx.remember(self.sock)
         else:
             handler.on_error(status_code)
 
     def shoot(self, task):
-        if self.session is None:
-            self.connect()
-
+        finished = th.Event()
+        self._submit(task, finished.set)
+        finished.wait()
+
+    async def async_shoot(self, task):
+        loop = asyncio.get_event_loop()
+        finished = loop.create_future()
+        self._submit(
+            task, lambda: loop.call_soon_threadsafe(self._done, finished))
+        await finished
+
+    async def async_teardown(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.teardown)
+
+    @staticmethod
+    def _done(future):
+        if not future.done():
+            future.set_result(None)
+
+    def _submit(self, task, done):
+        '''
+        Hand a task over to the I/O thread. done is called from that
+        thread when all the task's streams have finished
+        '''
         logger.debug("Task: %s", task)
-        scenario = task.marker
-        subtasks = [
-            task._replace(data=missile[1], marker=missile[0])
-            for missile in task.data
-        ]
-        handlers = []
-        with self.measure(task) as overall_sw:
-            for subtask in subtasks:
-                logger.debug("Request GET %s", subtask.data)
-                handler = SpdyTaskHandler(subtask, scenario, self.results)
+        self.submitted.append(SpdyTask(task, self.results, done))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.wakeup[1].send(b'\0')
+        except BlockingIOError:
+            # there is a wakeup pending already
+            pass
+
+    def _io(self):
+        '''
+        I/O loop. The session is used from this thread only
+        '''
+        while not self.closing:
+            try:
+                self._open_streams()
+                self._exchange()
+            except Exception as e:
+                logger.warning("SPDY session failed: %s", e)
+                self._drop()
+        self._drop()
+        while self.submitted:
+            for handler in self.submitted.popleft().handlers:
+                handler.on_error()
+
+    def _open_streams(self):
+        while self.submitted:
+            spdy_task = self.submitted.popleft()
+            # they fail with the session from now on
+            self.handlers.update(spdy_task.handlers)
+            if self.session is None:
+                self.connect()
+            for handler in spdy_task.handlers:
+                logger.debug("Request GET %s", handler.task.data)
                 self.session.submit_request(
                     0, [
                         (':method', 'GET'),
                         (':scheme', 'https'),
-                        (':path', subtask.data),
+                        (':path', handler.task.data),
                         (':version', 'HTTP/1.1'),
                         (':host', self.base_address),
                         ('accept', '*/*'),
                         ('user-agent', 'bfg-spdy')],
                     stream_user_data=handler)
-                handlers.append(handler)
-
-            while ((self.session.want_read() or
-                    self.session.want_write()) and not
-                    all(h.is_finished for h in handlers)):
-                want_read = want_write = False
-                try:
-                    data = self.sock.recv(4096)
-                    if data:
-                        self.session.recv(data)
-                    else:
-                        break
-                except ssl.SSLWantReadError:
-                    want_read = True
-                except ssl.SSLWantWriteError:
-                    want_write = True
-                try:
-                    self.session.send()
-                except ssl.SSLWantReadError:
-                    want_read = True
-                except ssl.SSLWantWriteError:
-                    want_write = True
-
-                if want_read or want_write:
-                    select.select([self.sock] if want_read else [],
-                                  [self.sock] if want_write else [],
-                                  [])
-
-            overall_sw.stop()
-            overall_sw.scenario = scenario
-            overall_sw.action = "overall"
-
-            failed = [h for h in handlers if h.is_failed]
-            if failed:
-                overall_sw.set_error()
+
+    def _exchange(self):
+        '''
+        Write what the session has to send, wait for the socket or for
+        new tasks and read everything that has come
+        '''
+        if self.session is None:
+            select.select([self.wakeup[0]], [], [])
+            self._drain_wakeup()
+            return
+        if not (self.session.want_read() or self.session.want_write() or
+                self.output):
+            raise EOFError("Session is over")
+        if len(self.output) < len(self.buffer):
+            self.session.send()
+        self._write()
+        readable, _, _ = select.select(
+            [self.wakeup[0], self.sock], [self.sock] if self.output else [],
+            [])
+        if self.wakeup[0] in readable:
+            self._drain_wakeup()
+        if self.sock in readable:
+            self._read()
+
+    def _read(self):
+        view = memoryview(self.buffer)
+        while True:
+            try:
+                count = self.sock.recv_into(view)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+            if not count:
+                raise EOFError("Connection closed by server")
+            # spdylay takes bytes only
+            self.session.recv(bytes(view[:count]))
+
+    def _write(self):
+        while self.output:
+            try:
+                count = self.sock.send(self.output)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+            del self.output[:count]
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup[0].recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _drop(self):
+        '''
+        Close the session, streams that are in flight fail
+        '''
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.session = None
+        self.output = bytearray()
+        handlers, self.handlers = self.handlers, set()
+        for handler in handlers:
+            handler.on_error()
@@ -0,0 +1,111 @@
+'''
+TLS client context that resumes sessions
+'''
+import logging
+import select
+import socket
+import ssl
+import time
+from ..module_exceptions import ConfigurationError
+
+
+logger = logging.getLogger(__name__)
+
+
+# how guns handshake: full handshake for every connection, resume sessions
+# made by the worker itself or resume a session made before workers fork
+MODES = ('full', 'resume', 'shared')
+
+
+class SessionContext(ssl.SSLContext):
+    '''
+    Client TLS context that does not verify certificates. Unless mode is
+    'full', it resumes TLS sessions: once a session for a server name is
+    remembered, every new connection to that server offers it, so the
+    server may skip the full handshake. Sessions belong to the context,
+    and a context made before workers are forked is copied into every
+    worker with its sessions, so in 'shared' mode the gun primes it
+    with a session in the main process
+    '''
+
+    def __new__(cls, mode='resume'):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, mode='resume'):
+        if mode not in MODES:
+            raise ConfigurationError(
+                "Unknown TLS session mode '%s', expected one of: %s" % (
+                    mode, ', '.join(MODES)))
+        self.mode = mode
+        self.sessions = {}
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+
+    def _session(self, server_hostname):
+        if self.mode == 'full':
+            return None
+        return self.sessions.get(server_hostname)
+
+    def wrap_socket(
+            self, sock, server_side=False, do_handshake_on_connect=True,
+            suppress_ragged_eofs=True, server_hostname=None, session=None):
+        return super().wrap_socket(
+            sock, server_side, do_handshake_on_connect,
+            suppress_ragged_eofs, server_hostname,
+            session or self._session(server_hostname))
+
+    def wrap_bio(
+            self, incoming, outgoing, server_side=False,
+            server_hostname=None, session=None):
+        return super().wrap_bio(
+            incoming, outgoing, server_side, server_hostname,
+            session or self._session(server_hostname))
+
+    @staticmethod
+    def _resumable(ssl_object):
+        # TLS 1.3 session tickets come after the handshake
+        session = ssl_object.session
+        return session is not None and (
+            session.has_ticket or ssl_object.version() != 'TLSv1.3')
+
+    def remember(self, ssl_object):
+        '''
+        Resume the session of an SSL socket or object in the next
+        connections to its server. Call it after some data has been read
+        '''
+        if self.mode == 'full' or not self._resumable(ssl_object):
+            return
+        if ssl_object.session_reused:
+            logger.debug("TLS session resumed")
+        self.sessions[ssl_object.server_hostname] = ssl_object.session
+
+    def prime(self, host, port, timeout=10):
+        '''
+        Connect to the server and remember its session. Errors are only
+        logged: workers will make sessions themselves then
+        '''
+        deadline = time.monotonic() + timeout
+        try:
+            with socket.create_connection((host, port), timeout) as sock:
+                with self.wrap_socket(
+                        sock, server_hostname=host) as ssl_sock:
+                    ssl_sock.setblocking(False)
+                    while not self._resumable(ssl_sock):
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            break
+                        select.select([ssl_sock], [], [], left)
+                        try:
+                            if not ssl_sock.recv(16384):
+                                break
+                        except ssl.SSLWantReadError:
+                            pass
+                    self.remember(ssl_sock)
+        except OSError as e:
+            logger.warning(
+                "Failed to make a TLS session with %s:%s: %s", host, port, e)
+            return
+        if host in self.sessions:
+            logger.info("Made a TLS session with %s:%s", host, port)
+        else:
+            logger.warning("%s:%s gave no TLS session to resume", host, port)
@@ -2,6 +2,7 @@
 Ultimate gun
 '''
 import imp
+import asyncio
 from .base import GunBase, Sample
 from queue import Full
 import time
@@ -17,7 +18,9 @@ class UltimateGun(GunBase):
     Scenario gun imports SCENARIOS from a user-provided python module. Then
     it uses task.scenario field to decide which scenario to activate
 
-    User should use self.measure context to collect samples
+    User should use self.measure context to collect samples. Scenarios
+    may also be coroutines, they are awaited when the gun is driven by
+    an async worker
     '''
 
     def __init__(self, *args, **kwargs):
@@ -52,11 +55,14 @@ class UltimateGun(GunBase):
         if callable(getattr(self.load_test, "teardown", None)):
             self.load_test.teardown()
 
-    def shoot(self, task):
+    def _get_scenario(self, task):
         marker = task.marker.rsplit("#", 1)[0]  # support enum_ammo
         if not marker:
             marker = "default"
-        scenario = getattr(self.load_test, marker, None)
+        return marker, getattr(self.load_test, marker, None)
+
+    def shoot(self, task):
+        marker, scenario = self._get_scenario(task)
         if callable(scenario):
             try:
                 scenario(task)
@@ -66,3 +72,33 @@ class UltimateGun(GunBase):
                     marker, e, exc_info=True)
         else:
             logger.warning("Scenario not found: %s", marker)
+
+    async def async_setup(self):
+        setup = getattr(self.load_test, "setup", None)
+        if asyncio.iscoroutinefunction(setup):
+            await setup(self.init_param)
+        else:
+            self.setup()
+
+    async def async_shoot(self, task):
+        '''
+        Scenarios defined with 'async def' are awaited in the worker's
+        event loop, plain ones are run in its executor
+        '''
+        marker, scenario = self._get_scenario(task)
+        if asyncio.iscoroutinefunction(scenario):
+            try:
+                await scenario(task)
+            except Exception as e:
+                logger.warning(
+                    "Scenario %s failed with %s",
+                    marker, e, exc_info=True)
+        else:
+            await super().async_shoot(task)
+
+    async def async_teardown(self):
+        teardown = getattr(self.load_test, "teardown", None)
+        if asyncio.iscoroutinefunction(teardown):
+            await teardown()
+        else:
+            self.teardown()
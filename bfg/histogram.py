@@ -0,0 +1,129 @@
+'''
+Streaming histograms for response times and other measurements
+'''
+import numpy as np
+
+
+class Histogram(object):
+    '''
+    Log-linear histogram of non-negative integers (HDR histogram style).
+    Values below 2**precision are counted exactly, greater values fall
+    into buckets that are no wider than 2**(1 - precision) of a value.
+    Memory does not depend on the number of values recorded, and
+    histograms can be merged: across seconds, workers or test runs.
+    Minimum, maximum and mean are exact.
+
+    >>> h = Histogram()
+    >>> h.record(np.arange(1, 1001))
+    >>> h.count, h.mean
+    (1000, 500.5)
+    >>> h.quantiles([0, .5, .9, 1])
+    {'0': 1, '50': 502, '90': 900, '100': 1000}
+    >>> other = Histogram()
+    >>> other.record(5000)
+    >>> h.merge(other).quantiles([.99, 1])
+    {'99': 988, '100': 5000}
+    '''
+
+    def __init__(self, precision=7):
+        self.precision = precision
+        self.half = 1 << (precision - 1)
+        self.counts = np.zeros(2 * self.half, dtype=np.int64)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _indices(self, values):
+        '''
+        Bucket index for every value: the value itself for small values,
+        (exponent, mantissa) packed into an integer for larger ones
+        '''
+        _, exponents = np.frexp(values)
+        shifts = np.maximum(exponents - self.precision, 0)
+        return (shifts << (self.precision - 1)) + (values >> shifts)
+
+    def _value(self, index):
+        '''
+        The middle of a bucket
+        '''
+        shift = max(index // self.half - 1, 0)
+        return ((index - (shift << (self.precision - 1))) << shift) + \
+            ((1 << shift) >> 1)
+
+    def record(self, values):
+        '''
+        Count a value or an array of values
+        '''
+        values = np.asarray(values, dtype=np.int64).ravel()
+        if not len(values):
+            return
+        low, high = int(values.min()), int(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.count += len(values)
+        self.total += int(values.sum())
+        self._add(np.bincount(self._indices(np.maximum(values, 0))))
+
+    def _add(self, counts):
+        if len(counts) > len(self.counts):
+            self.counts = np.concatenate((
+                self.counts,
+                np.zeros(len(counts) - len(self.counts), dtype=np.int64)))
+        self.counts[:len(counts)] += counts
+
+    def merge(self, other):
+        '''
+        Add values counted by another histogram of the same precision
+        '''
+        if other.precision != self.precision:
+            raise ValueError(
+                "Can not merge histograms with different precision")
+        if other.count:
+            self._add(other.counts)
+            self.count += other.count
+            self.total += other.total
+            self.min = other.min if self.min is None else min(
+                self.min, other.min)
+            self.max = other.max if self.max is None else max(
+                self.max, other.max)
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q):
+        '''
+        Value that q of all the values are less than or equal to
+        '''
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        rank = max(int(np.ceil(q * self.count)), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(max(self._value(index), self.min), self.max)
+
+    def quantiles(self, qs):
+        '''
+        Several quantiles as a dict with percents for keys
+        '''
+        return {str(int(q * 100)): self.quantile(q) for q in qs}
+
+    def __getstate__(self):
+        '''
+        Most buckets are empty, so only nonzero ones are pickled
+        '''
+        state = dict(self.__dict__)
+        indices = np.flatnonzero(self.counts)
+        state['counts'] = (len(self.counts), indices, self.counts[indices])
+        return state
+
+    def __setstate__(self, state):
+        size, indices, counts = state.pop('counts')
+        self.__dict__.update(state)
+        self.counts = np.zeros(size, dtype=np.int64)
+        self.counts[indices] = counts
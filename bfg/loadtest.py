@@ -44,7 +44,7 @@ class LoadTest(object):
         while any(worker.running() for worker in workers):
             await asyncio.sleep(1)
         logger.info("All workers finished")
+        [worker.close() for worker in workers]
 
-        # Stop aggregator
-        rs = cf.get_factory('aggregator', 'lunapark')
-        await rs.stop()
+        # Stop aggregators
+        await cf.factories['aggregator'].stop()
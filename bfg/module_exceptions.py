@@ -20,3 +20,9 @@ class StpdFileError(Exception):
     '''
     Raised when failed to read stpd file properly.
     '''
+
+
+class PlanFileError(Exception):
+    '''
+    Raised when failed to read or write compiled load plan properly.
+    '''
@@ -0,0 +1,186 @@
+'''
+Compiled load plans.
+
+A load plan is compiled to a binary file once and then reused by every
+run with the same schedule and ammo configuration. The file has a small
+header followed by an int64 array of timestamps and, optionally, by an
+int64 array of ammo indices (which missile each task takes). Workers map
+the file into memory, so neither startup time nor the parent's CPU depend
+on test length.
+'''
+from .module_exceptions import PlanFileError
+from . import schedule as sch
+from . import ammo as amm
+import numpy as np
+import hashlib
+import struct
+import json
+import os
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+MAGIC = b'BFGPLAN1'
+# magic, resolution, duration (ms), tasks count, has ammo index
+HEADER = struct.Struct('<8sqqqq')
+CHUNK_SIZE = 65536
+
+
+def plan_key(schedule_config, ammo_config, resolution):
+    '''
+    Hash of everything that the plan depends on. Ammo file size and
+    modification time are included because ammo indices depend on the
+    number of missiles in it
+    '''
+    ammo_file = ammo_config.get('file')
+    ammo_stat = None
+    if ammo_file and os.path.exists(ammo_file):
+        stat = os.stat(ammo_file)
+        ammo_stat = [stat.st_size, stat.st_mtime]
+    return hashlib.sha1(json.dumps({
+        'schedule': schedule_config,
+        'ammo': ammo_config,
+        'ammo_stat': ammo_stat,
+        'resolution': resolution,
+    }, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def compile_plan(schedule, path, ammo=None):
+    '''
+    Write schedule timestamps to a plan file. If ammo knows its length,
+    also write an index of a missile for every task
+    '''
+    count = len(schedule)
+    try:
+        ammo_count = len(ammo) if ammo is not None else 0
+    except TypeError:
+        ammo_count = 0
+    logger.info("Compiling load plan of %d tasks to %s", count, path)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as plan_file:
+            plan_file.write(HEADER.pack(
+                MAGIC, schedule.resolution, schedule.get_duration(),
+                count, int(bool(ammo_count))))
+            written = 0
+            for chunk in schedule.chunks(CHUNK_SIZE):
+                plan_file.write(chunk.astype('<i8').tobytes())
+                written += len(chunk)
+            if written != count:
+                raise PlanFileError(
+                    "Schedule produced %d tasks instead of %d" % (
+                        written, count))
+            if ammo_count:
+                for start in range(0, count, CHUNK_SIZE):
+                    numbers = np.arange(
+                        start, min(start + CHUNK_SIZE, count), dtype='<i8')
+                    plan_file.write((numbers % ammo_count).tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        # do not leave a partial plan in the cache
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class CompiledPlan(object):
+    '''
+    A load plan read from a file. It can be used instead of a schedule.
+    The file is mapped into memory on first access, so when workers plan
+    their own tasks, the parent does not map it at all
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as plan_file:
+            header = plan_file.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise PlanFileError("Plan file is truncated: %s" % path)
+        magic, self.resolution, self.duration, self.count, has_ammo_index = \
+            HEADER.unpack(header)
+        if magic != MAGIC:
+            raise PlanFileError("Not a plan file: %s" % path)
+        self.has_ammo_index = bool(has_ammo_index)
+        self._timestamps = None
+        self._ammo_index = None
+
+    @property
+    def timestamps(self):
+        if self._timestamps is None:
+            self._timestamps = np.memmap(
+                self.path, dtype='<i8', mode='r',
+                offset=HEADER.size, shape=(self.count,))
+        return self._timestamps
+
+    @property
+    def ammo_index(self):
+        if self._ammo_index is None and self.has_ammo_index:
+            self._ammo_index = np.memmap(
+                self.path, dtype='<i8', mode='r',
+                offset=HEADER.size + self.count * 8, shape=(self.count,))
+        return self._ammo_index
+
+    def __len__(self):
+        return self.count
+
+    def get_duration(self):
+        '''Return plan duration in milliseconds'''
+        return self.duration
+
+    def __iter__(self):
+        return self.stride(0, 1)
+
+    def stride(self, offset, step):
+        '''Every step-th timestamp starting from offset'''
+        for chunk in self.chunks(CHUNK_SIZE, offset, step):
+            yield from chunk.tolist()
+
+    def chunks(self, size, offset=0, step=1):
+        '''
+        Every step-th timestamp starting from offset, in arrays of up to
+        size elements. Arrays are views of the mapped file
+        '''
+        timestamps = self.timestamps[offset::step]
+        for start in range(0, len(timestamps), size):
+            yield timestamps[start:start + size]
+
+
+def cached_plan(cache_dir, schedule_config, ammo_config, resolution=sch.US):
+    '''
+    Get a compiled plan from the cache directory, compile it first
+    if it is not there yet
+    '''
+    path = os.path.join(
+        cache_dir,
+        plan_key(schedule_config, ammo_config, resolution) + '.plan')
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        compile_plan(
+            sch.create(schedule_config, resolution),
+            path, amm.create(ammo_config))
+    logger.info("Using compiled load plan %s", path)
+    return CompiledPlan(path)
+
+
+def compile_plans(config, names=None):
+    '''
+    Compile load plans ahead of time for BFGs from config that use plan
+    cache. If names are specified, only for those BFGs
+    '''
+    compiled = []
+    for name, bfg_config in config.get('bfg', {}).items():
+        if names and name not in names:
+            continue
+        cache_dir = bfg_config.get('plan_cache')
+        if not cache_dir:
+            logger.warning("BFG %s does not use plan cache, skipping", name)
+            continue
+        plan = cached_plan(
+            cache_dir,
+            config.get('schedule').get(bfg_config.get('schedule')),
+            config.get('ammo').get(bfg_config.get('ammo')))
+        logger.info("BFG %s: %d tasks in %s", name, len(plan), plan.path)
+        compiled.append(plan)
+    return compiled
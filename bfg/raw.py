@@ -0,0 +1,237 @@
+'''
+Raw samples writers and reader.
+
+Raw samples are written from a background thread, so neither formatting
+nor disk writes block the event loop. There are two formats:
+
+tsv -- a header line with Sample fields and a line for every sample.
+
+binary -- columnar chunks. The file starts with a magic string and
+a JSON header with Sample fields, column types and compression. Every
+chunk is a payload length followed by the (optionally compressed)
+payload: number of rows, length of the chunk's JSON metadata (the table
+of bfg, marker, code, scenario and action values that columns refer to
+and ext of samples that have it), the metadata and the rows themselves
+as a numpy record array.
+'''
+from .module_exceptions import ConfigurationError
+from .guns.base import Sample
+from .columns import ResultBlock
+import threading as th
+import queue
+import struct
+import json
+import zlib
+import numpy as np
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+MAGIC = b'BFGRAW01'
+LENGTH = struct.Struct('<I')
+CHUNK_HEADER = struct.Struct('<II')
+
+
+def write_tsv(raw_file, samples, header=False):
+    '''
+    Write raw samples to a file, tab separated
+    '''
+    if header:
+        raw_file.write('\t'.join(Sample._fields) + '\n')
+    raw_file.write(''.join(
+        '\t'.join('' if field is None else str(field) for field in sample)
+        + '\n' for sample in samples))
+
+
+def _codec(compression):
+    '''
+    Compress and decompress functions for a compression name
+    '''
+    if compression in (None, 'none'):
+        return (lambda data: data), (lambda data: data)
+    if compression == 'gzip':
+        return (lambda data: zlib.compress(data, 1)), zlib.decompress
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ConfigurationError(
+                "zstd compression needs zstandard module installed")
+        return (
+            zstandard.ZstdCompressor(level=1).compress,
+            zstandard.ZstdDecompressor().decompress)
+    raise ConfigurationError("Unknown compression: %s" % compression)
+
+
+class RawWriter(object):
+    '''
+    Writes raw samples from a background thread. write() takes a list of
+    samples and blocks of samples and returns immediately unless there
+    are max_pending lists waiting to be written already: then it waits,
+    so memory stays bounded
+    '''
+
+    def __init__(self, filename, max_pending=16):
+        self.filename = filename
+        self.pending = queue.Queue(max_pending)
+        self.thread = th.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def write(self, samples):
+        if samples:
+            self.pending.put(samples)
+
+    def close(self):
+        '''
+        Write everything that is pending and close the file
+        '''
+        self.pending.put(None)
+        self.thread.join()
+
+    def _writer(self):
+        logger.info("Writing raw samples to %s", self.filename)
+        with self._open() as raw_file:
+            while True:
+                samples = self.pending.get()
+                if samples is None:
+                    break
+                try:
+                    self._write(raw_file, samples)
+                except Exception:
+                    logger.exception(
+                        "Failed to write raw samples to %s", self.filename)
+
+    def _open(self):
+        raise NotImplementedError()
+
+    def _write(self, raw_file, samples):
+        raise NotImplementedError()
+
+
+class TsvWriter(RawWriter):
+    ''' Tab separated text, a line for a sample '''
+
+    def __init__(self, filename, **kwargs):
+        self.first_write = True
+        super().__init__(filename, **kwargs)
+
+    def _open(self):
+        return open(self.filename, 'w')
+
+    def _write(self, raw_file, samples):
+        for item in samples:
+            write_tsv(
+                raw_file,
+                item if isinstance(item, ResultBlock) else [item],
+                self.first_write)
+            self.first_write = False  # write headers only in the beginning
+
+
+class BinaryWriter(RawWriter):
+    ''' Compact binary columnar format, a chunk for every write() '''
+
+    def __init__(self, filename, compression='gzip', **kwargs):
+        self.compression = compression or 'none'
+        self.compress, _ = _codec(self.compression)
+        super().__init__(filename, **kwargs)
+
+    def _open(self):
+        raw_file = open(self.filename, 'wb')
+        header = json.dumps({
+            'fields': Sample._fields,
+            'columns': ResultBlock.COLUMNS.descr,
+            'compression': self.compression,
+        }).encode('utf-8')
+        raw_file.write(MAGIC + LENGTH.pack(len(header)) + header)
+        return raw_file
+
+    def _write(self, raw_file, samples):
+        blocks = [item for item in samples if isinstance(item, ResultBlock)]
+        samples = [item for item in samples if isinstance(item, Sample)]
+        if samples:
+            blocks.append(ResultBlock.from_samples(samples))
+        block = ResultBlock.concatenate(blocks)
+        meta = json.dumps(
+            {'values': block.values, 'ext': block.ext},
+            default=str).encode('utf-8')
+        payload = self.compress(
+            CHUNK_HEADER.pack(len(block), len(meta)) + meta +
+            block.rows.tobytes())
+        raw_file.write(LENGTH.pack(len(payload)) + payload)
+
+
+def create_writer(filename, raw_format='tsv', compression=None):
+    '''
+    Create a raw samples writer for a format
+    '''
+    if raw_format == 'tsv':
+        return TsvWriter(filename)
+    if raw_format == 'binary':
+        return BinaryWriter(filename, compression)
+    raise ConfigurationError("Unknown raw samples format: %s" % raw_format)
+
+
+class RawReader(object):
+    '''
+    Reads a binary raw samples file chunk by chunk. Iterate over it to
+    get blocks of samples in columns, or use samples() to get samples.
+    Files written before some columns were added are read too: the
+    columns they miss are filled with defaults
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as raw_file:
+            self.header = self._header(raw_file)
+        _, self.decompress = _codec(self.header['compression'])
+
+    def _header(self, raw_file):
+        if raw_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a raw samples file: %s" % self.filename)
+        length, = LENGTH.unpack(raw_file.read(LENGTH.size))
+        return json.loads(raw_file.read(length).decode('utf-8'))
+
+    def __iter__(self):
+        columns = np.dtype([tuple(column) for column in self.header['columns']])
+        with open(self.filename, 'rb') as raw_file:
+            self._header(raw_file)
+            while True:
+                length = raw_file.read(LENGTH.size)
+                if len(length) < LENGTH.size:
+                    return
+                length, = LENGTH.unpack(length)
+                payload = raw_file.read(length)
+                if len(payload) < length:
+                    logger.warning(
+                        "Raw samples file %s is truncated", self.filename)
+                    return
+                payload = self.decompress(payload)
+                rows, meta_length = CHUNK_HEADER.unpack_from(payload)
+                start = CHUNK_HEADER.size
+                meta = json.loads(
+                    payload[start:start + meta_length].decode('utf-8'))
+                yield ResultBlock(
+                    ResultBlock.upgrade(np.frombuffer(
+                        payload, dtype=columns, count=rows,
+                        offset=start + meta_length)),
+                    meta['values'],
+                    {int(number): ext for number, ext in meta['ext'].items()})
+
+    def samples(self):
+        for block in self:
+            yield from block
+
+
+def convert_to_tsv(filename, tsv_filename):
+    '''
+    Convert a binary raw samples file to tab separated text
+    '''
+    count = 0
+    with open(tsv_filename, 'w') as tsv_file:
+        tsv_file.write('\t'.join(Sample._fields) + '\n')
+        for block in RawReader(filename):
+            write_tsv(tsv_file, block)
+            count += len(block)
+    return count
@@ -5,29 +5,54 @@ import re
 from .util import parse_duration, solve_quadratic, FactoryBase
 from .module_exceptions import ConfigurationError
 from itertools import chain, groupby
+import numpy as np
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+# schedule resolutions: timestamp units per second
+MS = 1000
+US = 1000000
+NS = 1000000000
+
 
 class Const(object):
 
     '''
-    Load plan with constant load
+    Load plan with constant load. Duration is in milliseconds, timestamps
+    are in 1/resolution of a second
     '''
 
-    def __init__(self, rps, duration):
+    def __init__(self, rps, duration, resolution=MS):
         self.rps = float(rps)
         self.duration = duration
+        self.resolution = resolution
 
     def __iter__(self):
+        return self.stride(0, 1)
+
+    def stride(self, offset, step):
+        '''Every step-th timestamp starting from offset'''
         if self.rps == 0:
             return iter([])
-        interval = 1000.0 / self.rps
+        interval = float(self.resolution) / self.rps
         return (
             int(i * interval)
-            for i in range(0, int(self.rps * self.duration / 1000)))
+            for i in range(offset, self.__len__(), step))
+
+    def chunks(self, size, offset=0, step=1):
+        '''
+        Every step-th timestamp starting from offset, in numpy arrays
+        of up to size elements
+        '''
+        if self.rps == 0:
+            return
+        interval = float(self.resolution) / self.rps
+        count = self.__len__()
+        for start in range(offset, count, size * step):
+            numbers = np.arange(start, min(start + size * step, count), step)
+            yield (numbers * interval).astype(np.int64)
 
     def rps_at(self, t):
         '''Return rps for second t'''
@@ -42,7 +67,7 @@ class Const(object):
 
     def __len__(self):
         '''Return total ammo count'''
-        return self.duration / 1000 * self.rps
+        return int(self.rps * self.duration / 1000)
 
     def get_rps_list(self):
         return [(int(self.rps), self.duration / 1000)]
@@ -53,9 +78,13 @@ class Const(object):
 
 class Line(object):
 
-    '''Load plan with linear load'''
+    '''
+    Load plan with linear load. Duration is in milliseconds, timestamps
+    are in 1/resolution of a second
+    '''
 
-    def __init__(self, minrps, maxrps, duration):
+    def __init__(self, minrps, maxrps, duration, resolution=MS):
+        self.resolution = resolution
         self.minrps = float(minrps)
         self.maxrps = float(maxrps)
         self.duration = duration / 1000.0
@@ -63,11 +92,34 @@ class Line(object):
         self.k = (self.maxrps - self.minrps) / self.duration
 
     def ts(self, n):
-            _, root2 = solve_quadratic(self.k / 2.0, self.b, -n)
-            return int(root2 * 1000)
+        if self.k == 0:
+            # constant rate, there is no quadratic to solve
+            return int(n / self.b * self.resolution)
+        _, root2 = solve_quadratic(self.k / 2.0, self.b, -n)
+        return int(root2 * self.resolution)
 
     def __iter__(self):
-        return (self.ts(n) for n in range(0, self.__len__()))
+        return self.stride(0, 1)
+
+    def stride(self, offset, step):
+        '''Every step-th timestamp starting from offset'''
+        return (self.ts(n) for n in range(offset, self.__len__(), step))
+
+    def chunks(self, size, offset=0, step=1):
+        '''
+        Every step-th timestamp starting from offset, in numpy arrays
+        of up to size elements. Same as ts(), but for many numbers at once
+        '''
+        a = self.k / 2.0
+        count = self.__len__()
+        for start in range(offset, count, size * step):
+            numbers = np.arange(start, min(start + size * step, count), step)
+            if a == 0:
+                root2 = numbers / self.b
+            else:
+                disc_root = np.sqrt((self.b * self.b) - 4 * a * -numbers)
+                root2 = (-self.b + disc_root) / (2 * a)
+            yield (root2 * self.resolution).astype(np.int64)
 
     def rps_at(self, t):
         '''Return rps for second t'''
@@ -111,13 +163,60 @@ class Composite(object):
 
     def __init__(self, steps):
         self.steps = steps
+        self.resolution = steps[0].resolution if steps else MS
+
+    def _offset(self, step):
+        '''Step duration in timestamp units'''
+        return step.get_duration() * self.resolution // MS
 
     def __iter__(self):
         base = 0
         for step in self.steps:
             for ts in step:
                 yield ts + base
-            base += step.get_duration()
+            base += self._offset(step)
+
+    def stride(self, offset, step):
+        '''
+        Every step-th timestamp starting from offset. Only the
+        timestamps requested are computed
+
+        >>> plan = create(['const(1, 3s)', 'line(1, 5, 2s)', 'const(2, 2s)'])
+        >>> all(
+        ...     list(plan)[offset::3] == list(plan.stride(offset, 3))
+        ...     for offset in range(3))
+        True
+        '''
+        base = 0
+        for part in self.steps:
+            for ts in part.stride(offset, step):
+                yield ts + base
+            offset = (offset - len(part)) % step
+            base += self._offset(part)
+
+    def chunks(self, size, offset=0, step=1):
+        '''
+        Every step-th timestamp starting from offset, in numpy arrays
+        of up to size elements. Chunks do not span steps' boundaries
+
+        >>> plan = create(['line(1, 5, 2s)', 'const(3, 2s)'], resolution=US)
+        >>> [chunk.tolist() for chunk in plan.chunks(4)]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [[0, 618033, 1000000, 1302775], [1561552, 1791287],
+         [2000000, 2333333, 2666666, 3000000], [3333333, 3666666]]
+        >>> plan = create(['step(1, 50, 3, 2s)', 'line(1, 500, 1m)'], US)
+        >>> all(
+        ...     list(plan.stride(offset, 7)) ==
+        ...     np.concatenate(list(plan.chunks(100, offset, 7))).tolist()
+        ...     for offset in range(7))
+        True
+        '''
+        base = 0
+        for part in self.steps:
+            for chunk in part.chunks(size, offset, step):
+                yield chunk + base
+            offset = (offset - len(part)) % step
+            base += self._offset(part)
 
     def get_duration(self):
         '''Return total duration'''
@@ -134,16 +233,16 @@ class Composite(object):
 
 class Stairway(Composite):
 
-    def __init__(self, minrps, maxrps, increment, duration):
+    def __init__(self, minrps, maxrps, increment, duration, resolution=MS):
         if maxrps < minrps:
             increment = -increment
         n_steps = int((maxrps - minrps) / increment)
         steps = [
-            Const(minrps + i * increment, duration)
+            Const(minrps + i * increment, duration, resolution)
             for i in range(0, n_steps + 1)
         ]
         if (n_steps + 1) * increment < maxrps:
-            steps.append(Const(maxrps, duration))
+            steps.append(Const(maxrps, duration, resolution))
         logger.info(steps)
         super(Stairway, self).__init__(steps)
 
@@ -151,28 +250,30 @@ class Stairway(Composite):
 class StepFactory(object):
 
     @staticmethod
-    def line(params):
+    def line(params, resolution=MS):
         template = re.compile(r'([0-9.]+),\s*([0-9.]+),\s*([0-9.]+[dhms]?)+\)')
         minrps, maxrps, duration = template.search(params).groups()
-        return Line(float(minrps), float(maxrps), parse_duration(duration))
+        return Line(
+            float(minrps), float(maxrps), parse_duration(duration),
+            resolution)
 
     @staticmethod
-    def const(params):
+    def const(params, resolution=MS):
         template = re.compile(r'([0-9.]+),\s*([0-9.]+[dhms]?)+\)')
         rps, duration = template.search(params).groups()
-        return Const(float(rps), parse_duration(duration))
+        return Const(float(rps), parse_duration(duration), resolution)
 
     @staticmethod
-    def stairway(params):
+    def stairway(params, resolution=MS):
         template = re.compile(
             r'([0-9.]+),\s*([0-9.]+),\s*([0-9.]+),\s*([0-9.]+[dhms]?)+\)')
         minrps, maxrps, increment, duration = template.search(params).groups()
         return Stairway(
             float(minrps), float(maxrps),
-            float(increment), parse_duration(duration))
+            float(increment), parse_duration(duration), resolution)
 
     @staticmethod
-    def produce(step_config):
+    def produce(step_config, resolution=MS):
         _plans = {
             'line': StepFactory.line,
             'const': StepFactory.const,
@@ -181,15 +282,16 @@ class StepFactory(object):
         load_type, params = step_config.split('(')
         load_type = load_type.strip()
         if load_type in _plans:
-            return _plans[load_type](params)
+            return _plans[load_type](params, resolution)
         else:
             raise NotImplementedError(
                 'No such load type implemented: "%s"' % load_type)
 
 
-def create(rps_schedule):
+def create(rps_schedule, resolution=MS):
     '''
     Create Load Plan as defined in schedule. Publish info about its duration.
+    Timestamps are in milliseconds unless another resolution is specified
 
     >>> from .util import take
 
@@ -223,13 +325,22 @@ def create(rps_schedule):
     >>> take(10, create(['const(1, 1)']))
     [0]
 
+    >>> take(5, create(['const(20000, 1s)'], resolution=US))
+    [0, 50, 100, 150, 200]
+
+    >>> take(4, create(['const(1, 2s)', 'const(3, 2s)'], resolution=US))
+    [0, 1000000, 2000000, 2333333]
+
+    >>> take(6, create(['line(1, 5, 2s)'], resolution=NS))
+    [0, 618033988, 1000000000, 1302775637, 1561552812, 1791287847]
+
     '''
     logger.info("Creating load plan %s", rps_schedule)
     if len(rps_schedule) > 1:
-        lp = Composite([StepFactory.produce(step_config)
+        lp = Composite([StepFactory.produce(step_config, resolution)
                        for step_config in rps_schedule])
     else:
-        lp = StepFactory.produce(rps_schedule[0])
+        lp = StepFactory.produce(rps_schedule[0], resolution)
     logger.info('Planned duration: %.2d sec', lp.get_duration() / 1000)
     return lp
 
@@ -239,7 +350,7 @@ class ScheduleFactory(FactoryBase):
 
     def get(self, key):
         if key in self.factory_config:
-            return create(self.factory_config.get(key))
+            return create(self.factory_config.get(key), resolution=US)
         else:
             raise ConfigurationError(
                 "Configuration for %s schedule not found" % key)
@@ -0,0 +1,236 @@
+'''
+Bounded storage of aggregated time series.
+
+Overall statistics of every aggregated second are kept as compact
+records. Recent seconds are kept in memory as they are, older ones are
+downsampled into coarser intervals, and the oldest intervals are
+forgotten, so memory use does not depend on test duration. Every record
+is also appended to a file, so the whole series can be read after the
+test (or while it runs) with read_series().
+
+The file starts with a magic string and a JSON header with the record
+type and quantiles, then records follow. A corrected second is appended
+once more: the last record of a second is the right one.
+'''
+import numpy as np
+import struct
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+MAGIC = b'BFGSER01'
+LENGTH = struct.Struct('<I')
+EMPTY = -1
+STATS = ('rt', 'delay', 'intended')
+
+
+def record_type(quantiles, phases=()):
+    '''
+    Record of a second or of a downsampled interval. Missing values
+    (no samples, or intended latency or a phase was not measured) are NaN.
+    <stat>_samples is the number of samples a statistic was measured for
+    '''
+    return np.dtype([
+        ('ts', np.int64),
+        ('seconds', np.int64),
+        ('samples', np.int64),
+        ('errors', np.int64),
+        ('late', np.int64),
+    ] + [
+        column for name in STATS + tuple(phases) for column in (
+            (name + '_samples', np.int64),
+            (name + '_avg', np.float64),
+            (name + '_quantiles', np.float64, (len(quantiles),)))
+    ])
+
+
+def _value(value):
+    return np.nan if value is None else value
+
+
+class SeriesStorage(object):
+    '''
+    Aggregated seconds, in bounded memory. Store aggregated data of a
+    second with storage[ts] = aggr, get it back with storage[ts] while
+    the second is recent. Data of the last `recent` seconds is kept as is,
+    older data is downsampled into intervals of `interval` seconds and
+    `coarse` such intervals are kept. Sample, error and late counts of an
+    interval are sums, averages are weighted by the samples they were
+    measured for and quantiles are the highest of its seconds. Statistics
+    of request phases are stored for the phases listed in `phases`.
+
+    >>> storage = SeriesStorage([.5, 1], recent=2, interval=10)
+    >>> for ts in range(100, 104):
+    ...     storage[ts] = {"rps": ts - 99, "overall": {
+    ...         "samples": ts - 99, "errors": 0,
+    ...         "rt": {"avg": ts, "quantiles": {"50": ts, "100": ts + 1}},
+    ...         "delay": {"avg": 0, "quantiles": {"50": 0, "100": 0}}}}
+    >>> storage[103]["rt"]
+    {'avg': 103.0, 'quantiles': {'50': 103.0, '100': 104.0}}
+    >>> 101 in storage
+    False
+    >>> coarse, recent = storage.series()
+    >>> coarse[['ts', 'seconds', 'samples', 'rt_avg']].tolist()
+    [(100, 2, 3, 100.66666666666667)]
+    >>> recent['ts'].tolist()
+    [102, 103]
+    '''
+
+    def __init__(
+            self, quantiles, filename=None,
+            recent=3600, interval=60, coarse=1440, phases=()):
+        self.quantiles = quantiles
+        self.keys = [str(int(q * 100)) for q in quantiles]
+        self.phases = tuple(phases)
+        self.stats = STATS + self.phases
+        self.dtype = record_type(quantiles, phases)
+        self.interval = interval
+        self.recent = self._ring(recent)
+        self.coarse = self._ring(coarse)
+        self.filename = filename
+        self.file = None
+        if filename:
+            self.file = open(filename, 'wb')
+            header = json.dumps({
+                'quantiles': quantiles,
+                'phases': self.phases,
+                'columns': self.dtype.descr,
+            }).encode('utf-8')
+            self.file.write(MAGIC + LENGTH.pack(len(header)) + header)
+            self.file.flush()
+
+    def _ring(self, size):
+        ring = np.zeros(size, dtype=self.dtype)
+        ring['ts'] = EMPTY
+        return ring
+
+    def _record(self, ts, aggr):
+        overall = aggr['overall']
+        record = np.zeros((), dtype=self.dtype)
+        record['ts'] = ts
+        record['seconds'] = 1
+        record['samples'] = overall['samples']
+        record['errors'] = overall.get('errors', 0)
+        record['late'] = overall.get('late', 0)
+        phases = overall.get('phases', {})
+        for name in self.stats:
+            stat = overall.get(name) or phases.get(name) or {}
+            avg = _value(stat.get('avg'))
+            record[name + '_samples'] = 0 if np.isnan(avg) else stat.get(
+                'samples', overall['samples'])
+            record[name + '_avg'] = avg
+            record[name + '_quantiles'] = [
+                _value(stat.get('quantiles', {}).get(key))
+                for key in self.keys]
+        return record
+
+    def __setitem__(self, ts, aggr):
+        record = self._record(ts, aggr)
+        if self.file:
+            self.file.write(record.tobytes())
+            self.file.flush()
+        slot = ts % len(self.recent)
+        stored = int(self.recent[slot]['ts'])
+        if stored > ts:
+            # too old to be kept apart, it has been downsampled already
+            return
+        if stored != EMPTY and stored != ts:
+            self._downsample(self.recent[slot])
+        self.recent[slot] = record
+
+    def _downsample(self, record):
+        start = int(record['ts']) // self.interval * self.interval
+        slot = start // self.interval % len(self.coarse)
+        stored = int(self.coarse[slot]['ts'])
+        if stored > start:
+            return
+        if stored != start:
+            self.coarse[slot] = record
+            self.coarse[slot]['ts'] = start
+            return
+        interval = self.coarse[slot]
+        for name in self.stats:
+            avg, samples = name + '_avg', name + '_samples'
+            # seconds where a statistic was not measured do not count
+            if not interval[samples]:
+                interval[avg] = record[avg]
+            elif record[samples]:
+                interval[avg] = (
+                    interval[avg] * interval[samples] +
+                    record[avg] * record[samples]) / (
+                    interval[samples] + record[samples])
+            interval[samples] += record[samples]
+            quantiles = name + '_quantiles'
+            interval[quantiles] = np.fmax(
+                interval[quantiles], record[quantiles])
+        interval['samples'] += record['samples']
+        interval['errors'] += record['errors']
+        interval['late'] += record['late']
+        interval['seconds'] += 1
+
+    def __contains__(self, ts):
+        return int(self.recent[ts % len(self.recent)]['ts']) == ts
+
+    def __getitem__(self, ts):
+        '''
+        Overall statistics of a recent second
+        '''
+        if ts not in self:
+            raise KeyError(ts)
+        record = self.recent[ts % len(self.recent)]
+        stat = {
+            "samples": int(record['samples']),
+            "errors": int(record['errors']),
+            "late": int(record['late']),
+        }
+        stat.update((name, self._stat(record, name)) for name in STATS)
+        if self.phases:
+            stat["phases"] = {
+                phase: self._stat(record, phase) for phase in self.phases}
+        return stat
+
+    def _stat(self, record, name):
+        return {
+            "avg": float(record[name + '_avg']),
+            "quantiles": dict(zip(
+                self.keys, record[name + '_quantiles'].tolist())),
+        }
+
+    def series(self):
+        '''
+        Downsampled intervals and recent seconds that are in memory,
+        each sorted by time
+        '''
+        return tuple(
+            np.sort(ring[ring['ts'] != EMPTY], order='ts')
+            for ring in (self.coarse, self.recent))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def read_series(filename, start=None, end=None):
+    '''
+    Read records of seconds from start to end (inclusive) from a series
+    file, the last record of a second wins
+    '''
+    with open(filename, 'rb') as series_file:
+        if series_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a series file: %s" % filename)
+        length, = LENGTH.unpack(series_file.read(LENGTH.size))
+        header = json.loads(series_file.read(length).decode('utf-8'))
+        offset = series_file.tell()
+    dtype = np.dtype([tuple(column) for column in header['columns']])
+    records = np.fromfile(filename, dtype=dtype, offset=offset)
+    if start is not None:
+        records = records[records['ts'] >= start]
+    if end is not None:
+        records = records[records['ts'] <= end]
+    # the last record of every second
+    _, last = np.unique(records['ts'][::-1], return_index=True)
+    return records[len(records) - 1 - last]
@@ -0,0 +1,93 @@
+'''
+Timing facilities: monotonic clock, precise waits, dispatch jitter stats.
+
+All scheduling and measurements are done with the monotonic clock in
+nanoseconds, so they are not affected by wall clock adjustments. Wall
+clock is only used to label samples with seconds.
+'''
+import asyncio
+import time
+
+
+# the offset is taken once, in the main process, so all the workers forked
+# from it label their samples consistently
+_WALL_OFFSET = time.time_ns() - time.monotonic_ns()
+LOOP_RESOLUTION = 1000000
+
+
+def wall_time(mono_ns):
+    '''
+    Convert monotonic clock value (ns) to wall clock seconds
+    '''
+    return (mono_ns + _WALL_OFFSET) / 1e9
+
+
+def wait_until(deadline_ns, spin_ns=0):
+    '''
+    Sleep until spin_ns before the deadline, then spin in a loop for
+    the rest of the time. Return how late we are, in nanoseconds
+    '''
+    remaining = deadline_ns - time.monotonic_ns()
+    if remaining > spin_ns:
+        time.sleep((remaining - spin_ns) / 1e9)
+    now = time.monotonic_ns()
+    while now < deadline_ns:
+        now = time.monotonic_ns()
+    return now - deadline_ns
+
+
+async def async_wait_until(deadline_ns, spin_ns=0):
+    '''
+    Same as wait_until, but without blocking the event loop. The loop
+    polls with millisecond resolution, so we sleep one more millisecond
+    less and then yield to other tasks until the deadline
+    '''
+    remaining = deadline_ns - time.monotonic_ns() - spin_ns - LOOP_RESOLUTION
+    if remaining > 0:
+        await asyncio.sleep(remaining / 1e9)
+    now = time.monotonic_ns()
+    while now < deadline_ns:
+        await asyncio.sleep(0)
+        now = time.monotonic_ns()
+    return now - deadline_ns
+
+
+class JitterHistogram(object):
+    '''
+    Histogram of dispatch jitter (how late a task was dispatched) with
+    power of two buckets in microseconds.
+
+    >>> h = JitterHistogram()
+    >>> for ns in (0, 3000, 5000, 70000, 100000):
+    ...     h.record(ns)
+    >>> h.quantile(.5)
+    8
+    >>> h.quantile(1)
+    128
+    '''
+    def __init__(self):
+        self.counts = [0] * 64
+        self.total = 0
+
+    def record(self, ns):
+        self.counts[max(0, ns // 1000).bit_length()] += 1
+        self.total += 1
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket where the q-quantile is, microseconds
+        '''
+        rank = q * self.total
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return 1 << bucket
+        return 0
+
+    def __str__(self):
+        return (
+            "50% < {0} us, 90% < {1} us, 99% < {2} us, "
+            "max < {3} us ({4} tasks)".format(
+                self.quantile(.5), self.quantile(.9), self.quantile(.99),
+                self.quantile(1), self.total))
@@ -0,0 +1,116 @@
+'''
+Task transports between the feeder and workers
+'''
+from multiprocessing import shared_memory
+import multiprocessing as mp
+import numpy as np
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class TaskRing(object):
+    '''
+    Ring buffer of fixed size task records in shared memory. A record is
+    a planned timestamp and an index of a missile in ammo, so tasks are
+    never pickled. There is one producer (the feeder) and many consumers
+    (workers). The producer does not lock at all: it writes records first
+    and then moves the write cursor. Consumers take records in batches
+    under a lock, so the lock is taken once per batch and not per task.
+
+    The ring should be created before workers are forked.
+    '''
+    RECORD = np.dtype([('ts', np.int64), ('ammo', np.int64)])
+    # write cursor, read cursor and closed flag live in different
+    # cache lines
+    WRITE, READ, CLOSED = 0, 8, 16
+    HEADER_SIZE = 24 * 8
+    MIN_WAIT = 0.0005
+    MAX_WAIT = 0.01
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(
+            create=True,
+            size=self.HEADER_SIZE + capacity * self.RECORD.itemsize)
+        self.header = np.ndarray(
+            (self.HEADER_SIZE // 8,), dtype=np.int64, buffer=self.shm.buf)
+        self.header[:] = 0
+        self.records = np.ndarray(
+            (capacity,), dtype=self.RECORD,
+            buffer=self.shm.buf, offset=self.HEADER_SIZE)
+        self.lock = mp.Lock()
+        logger.info(
+            "Created a task ring for %d tasks in %s", capacity, self.shm.name)
+
+    def __len__(self):
+        return int(self.header[self.WRITE] - self.header[self.READ])
+
+    def put(self, ts, ammo):
+        '''
+        Write as many records as there is room for and return their
+        number. Only one process is allowed to write
+        '''
+        write = int(self.header[self.WRITE])
+        count = min(
+            len(ts),
+            self.capacity - (write - int(self.header[self.READ])))
+        if count <= 0:
+            return 0
+        start = write % self.capacity
+        head = min(count, self.capacity - start)
+        self.records['ts'][start:start + head] = ts[:head]
+        self.records['ammo'][start:start + head] = ammo[:head]
+        if head < count:
+            self.records['ts'][:count - head] = ts[head:count]
+            self.records['ammo'][:count - head] = ammo[head:count]
+        self.header[self.WRITE] = write + count
+        return count
+
+    def close(self):
+        '''
+        Tell consumers that nothing will be written anymore
+        '''
+        self.header[self.CLOSED] = 1
+
+    def get(self, max_count, timeout):
+        '''
+        Take up to max_count records. Wait up to timeout seconds if the
+        ring is empty. Return an empty array if nothing was written
+        during that time and None if the ring is empty and closed
+        '''
+        deadline = time.monotonic() + timeout
+        wait = self.MIN_WAIT
+        while True:
+            closed = self.header[self.CLOSED]
+            with self.lock:
+                read = int(self.header[self.READ])
+                count = min(max_count, int(self.header[self.WRITE]) - read)
+                if count > 0:
+                    start = read % self.capacity
+                    head = min(count, self.capacity - start)
+                    batch = self.records[start:start + head]
+                    if head < count:
+                        batch = np.concatenate(
+                            (batch, self.records[:count - head]))
+                    else:
+                        batch = batch.copy()
+                    self.header[self.READ] = read + count
+                    return batch
+            if closed:
+                return None
+            if time.monotonic() > deadline:
+                return self.records[:0].copy()
+            time.sleep(wait)
+            wait = min(wait * 2, self.MAX_WAIT)
+
+    def destroy(self):
+        '''
+        Release the shared memory. Call it in the process that created
+        the ring when all workers have exited
+        '''
+        del self.header, self.records
+        self.shm.close()
+        self.shm.unlink()
@@ -2,11 +2,20 @@ import time
 import multiprocessing as mp
 import threading as th
 from queue import Empty, Full
-from .util import FactoryBase
+from .util import FactoryBase, take
 from .module_exceptions import ConfigurationError
+from .transport import TaskRing
+from .plan import cached_plan
+from .schedule import MS, NS
+from .timer import wait_until, async_wait_until, JitterHistogram
+from .aggregator import WorkerAggregator
+from .columns import ColumnarBuffer
 from collections import namedtuple
+from itertools import islice
+import numpy as np
 import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -24,37 +33,99 @@ class BFG(object):
     A BFG load generator that manages multiple workers as processes
     and feeds them with tasks
     '''
+    MIN_BACKOFF = 0.001
+    MAX_BACKOFF = 0.5
+    LEAD_REPORT_INTERVAL = 10
+    JITTER_REPORT_INTERVAL = 10
+
     def __init__(
-            self, gun, load_plan, results, name, instances, event_loop):
+            self, gun, schedule, ammo, results, name, instances, event_loop,
+            worker_type='sync', concurrency=1000,
+            chunk_size=100, chunk_window=100, feeder='parent',
+            transport='queue', ring_size=65536, spin_threshold=0.2,
+            results_mode='samples', worker_raw_file=None,
+            results_block_size=4096, results_block_interval=100,
+            intended_latency=False, late_threshold=None):
         self.name = name
         self.instances = instances
+        self.feeder = feeder
+        self.transport = transport
+        self.worker_type = worker_type
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        # schedule timestamps are in 1/resolution of a second
+        self.tick = NS // schedule.resolution
+        self.chunk_window = chunk_window * schedule.resolution // MS
+        self.spin_threshold = int(spin_threshold * 1000000)
+        self.feeder_lead = 0
+        self._lead_reported = 0
+        self.jitter = JitterHistogram()
+        self._jitter_reported = 0
+        self.results_mode = results_mode
+        self.worker_raw_file = worker_raw_file
+        self.results_block_size = results_block_size
+        self.results_block_interval = results_block_interval
+        self.intended_latency = intended_latency
+        self.late_threshold = late_threshold
         self.gun = gun
         self.gun.results = results
-        self.load_plan = load_plan
+        self.schedule = schedule
+        self.ammo = ammo
+        self.ammo_indexed = getattr(schedule, 'has_ammo_index', False)
+        # random access ammo is sent to workers by indices, not by value
+        self.ammo_random = hasattr(ammo, '__getitem__')
         self.event_loop = event_loop
         logger.info(
             '''
 Name: {name}
 Instances: {instances}
+Worker: {worker_type}
+Feeder: {feeder}
+Transport: {transport}
 Gun: {gun.__class__.__name__}
 '''.format(
             name=self.name,
             instances=self.instances,
+            worker_type=self.worker_type,
+            feeder=self.feeder,
+            transport=self.transport,
             gun=gun,
         ))
+        if self.worker_type not in ('sync', 'async'):
+            raise ConfigurationError(
+                "Unknown worker type for %s: %s" % (name, worker_type))
+        if self.feeder not in ('parent', 'worker'):
+            raise ConfigurationError(
+                "Unknown feeder for %s: %s" % (name, feeder))
+        if self.transport not in ('queue', 'shm'):
+            raise ConfigurationError(
+                "Unknown transport for %s: %s" % (name, transport))
+        if self.results_mode not in ('samples', 'columns', 'aggregates'):
+            raise ConfigurationError(
+                "Unknown results mode for %s: %s" % (name, results_mode))
         self.quit = mp.Event()
         self.task_queue = mp.Queue(1024)
+        self.ring = None
+        if self.transport == 'shm' and self.feeder == 'parent':
+            if not self.ammo_random:
+                raise ConfigurationError(
+                    "Ammo of %s does not support shared memory transport"
+                    % name)
+            self.ring = TaskRing(ring_size)
         self.pool = [
-            mp.Process(target=self._worker, name="%s-%s" % (self.name, i))
+            mp.Process(
+                target=self._worker, args=(i,),
+                name="%s-%s" % (self.name, i))
             for i in range(0, self.instances)]
         self.workers_finished = False
 
     def start(self):
-        self.start_time = time.time()
+        self.start_time = time.monotonic_ns()
         for process in self.pool:
             process.daemon = True
             process.start()
-        self.event_loop.create_task(self._feeder())
+        if self.feeder == 'parent':
+            self.event_loop.create_task(self._feeder())
 
     async def _wait(self):
         try:
@@ -79,7 +150,7 @@ Gun: {gun.__class__.__name__}
         will quit when this would become False
         '''
         #return not self.workers_finished
-        return len(mp.active_children())
+        return len([process for process in self.pool if process.is_alive()])
 
     def stop(self):
         '''
@@ -87,74 +158,322 @@ Gun: {gun.__class__.__name__}
         '''
         self.quit.set()
 
+    def close(self):
+        '''
+        Release transport resources. Call it when all workers have exited
+        '''
+        if self.ring is not None:
+            self.ring.destroy()
+            self.ring = None
+
+    def _plan_chunks(self, offset=0, step=1):
+        '''
+        Load plan in chunks: numpy arrays of timestamps along with arrays
+        of indices of their missiles in ammo: task numbers or, if a compiled
+        load plan has an ammo index, indices from it. A chunk has up to
+        chunk_size tasks and covers no more than chunk_window of the
+        schedule. If step is specified, only every step-th task starting
+        from offset is planned
+        '''
+        number = offset
+        for timestamps in self.schedule.chunks(self.chunk_size, offset, step):
+            start = 0
+            while start < len(timestamps):
+                end = max(start + 1, int(np.searchsorted(
+                    timestamps, timestamps[start] + self.chunk_window)))
+                numbers = np.arange(
+                    number + start * step, number + end * step, step)
+                if self.ammo_indexed:
+                    numbers = self.schedule.ammo_index[numbers]
+                yield timestamps[start:end], numbers
+                start = end
+            number += len(timestamps) * step
+
+    def _missiles(self, numbers, ammo):
+        '''
+        Missiles for a chunk: by their indices if ammo supports random
+        access, otherwise just the next ones from ammo iterator
+        '''
+        if self.ammo_random:
+            return [self.ammo[n] for n in numbers.tolist()]
+        return take(len(numbers), ammo)
+
+    def _tasks(self, timestamps, missiles):
+        '''
+        Unpack a chunk of timestamps and missiles into tasks
+        '''
+        return [
+            Task(ts, self.name, marker, data)
+            for ts, (marker, data) in zip(timestamps.tolist(), missiles)]
+
     async def _feeder(self):
         '''
-        A feeder coroutine
+        A feeder coroutine. Tasks are sent to workers in chunks made of
+        an array of timestamps and an array of ammo indices, so missiles
+        are never pickled. Ammo that does not support random access is
+        sent as a list of missiles
         '''
-        for task in self.load_plan:
-            task = task._replace(bfg=self.name)
+        ammo = iter(self.ammo)
+        for timestamps, numbers in self._plan_chunks():
             if self.quit.is_set():
                 logger.info(
                     "%s observed quit flag and not going to feed anymore",
                     self.name)
                 return
-            # try putting a task to a queue unless there is a quit flag
-            # or all workers have exited
-            while True:
-                try:
-                    self.task_queue.put_nowait(task)
-                    break
-                except Full:
-                    if self.quit.is_set() or self.workers_finished:
-                        return
-                    else:
-                        await asyncio.sleep(1)
+            if self.ring is not None:
+                sent = await self._write(timestamps, numbers)
+            else:
+                sent = await self._put((
+                    timestamps,
+                    numbers if self.ammo_random
+                    else self._missiles(numbers, ammo)))
+            if not sent:
+                return
+            self._update_lead(int(timestamps[-1]))
+        if self.ring is not None:
+            logger.info("%s have feeded all data. Closing the ring", self.name)
+            self.ring.close()
+            return
         workers_count = self.instances
         logger.info(
             "%s have feeded all data. Publishing %d poison pills",
             self.name, workers_count)
+        for _ in range(0, workers_count):
+            if not await self._put(None):
+                return
+
+    async def _put(self, chunk):
+        '''
+        Put a chunk of tasks to the queue unless there is a quit flag
+        or all workers have exited. Return False if there is no one to
+        feed anymore
+        '''
+        backoff = self.MIN_BACKOFF
         while True:
             try:
-                [self.task_queue.put_nowait(None) for _ in range(
-                    0, workers_count)]
-                break
+                self.task_queue.put_nowait(chunk)
+                return True
             except Full:
+                backoff = await self._backoff(backoff)
+                if not backoff:
+                    return False
+
+    async def _write(self, timestamps, numbers):
+        '''
+        Write a chunk of tasks to the ring, same as _put()
+        '''
+        backoff = self.MIN_BACKOFF
+        written = 0
+        while True:
+            written += self.ring.put(timestamps[written:], numbers[written:])
+            if written == len(timestamps):
+                return True
+            backoff = await self._backoff(backoff)
+            if not backoff:
+                return False
+
+    async def _backoff(self, backoff):
+        '''
+        Wait while workers free some room in the transport. Back off
+        exponentially, but never longer than a half of our lead, so that
+        workers would not starve. Return next backoff or None if there
+        is a quit flag or all workers have exited
+        '''
+        if self.quit.is_set() or self.workers_finished:
+            return None
+        await asyncio.sleep(backoff)
+        return max(self.MIN_BACKOFF, min(
+            backoff * 2, self.MAX_BACKOFF, self.feeder_lead / 2))
+
+    def _update_lead(self, ts):
+        '''
+        Remember how far ahead of schedule the feeder is, in seconds.
+        Negative lead means that workers are starving
+        '''
+        now = time.monotonic_ns()
+        self.feeder_lead = (self.start_time + ts * self.tick - now) / 1e9
+        if now - self._lead_reported > self.LEAD_REPORT_INTERVAL * 1e9:
+            self._lead_reported = now
+            if self.feeder_lead < 0:
                 logger.warning(
-                    "%s could not publish killer tasks."
-                    "task queue is full. Retry in 1s", self.name)
-                await asyncio.sleep(1)
+                    "%s feeder is %.3f s behind schedule",
+                    self.name, -self.feeder_lead)
+            else:
+                logger.info(
+                    "%s feeder is %.3f s ahead of schedule",
+                    self.name, self.feeder_lead)
 
-    def _worker(self):
+    def _worker(self, index):
         '''
         A worker that runs in a distinct process
         '''
+        logger.info("Started shooter process: %s", mp.current_process().name)
+        if self.results_mode == 'aggregates':
+            self.gun.results = WorkerAggregator(
+                self.gun.results,
+                raw_filename=self.worker_raw_file and '%s.%s' % (
+                    self.worker_raw_file, mp.current_process().name),
+                intended_latency=self.intended_latency,
+                late_threshold=self.late_threshold)
+        elif self.results_mode == 'columns':
+            self.gun.results = ColumnarBuffer(
+                self.gun.results, self.results_block_size,
+                self.results_block_interval / 1000)
+        chunks = self._chunks(index)
+        if self.worker_type == 'async':
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self._async_worker(chunks))
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            finally:
+                loop.close()
+        else:
+            self._sync_worker(chunks)
+        if self.results_mode != 'samples':
+            self.gun.results.close()
+        logger.info(
+            "%s dispatch jitter: %s", mp.current_process().name, self.jitter)
 
-        # TODO: implement asyncio eventloop here
+    def _chunks(self, index):
+        '''
+        Chunks of tasks for a worker. They are taken from the task queue
+        or, if workers feed themselves, made of the worker's own share of
+        the load plan: every n-th task, where n is the number of instances
+        '''
+        if self.feeder == 'worker':
+            ammo = islice(self.ammo, index, None, self.instances)
+            for timestamps, numbers in self._plan_chunks(
+                    index, self.instances):
+                yield self._tasks(timestamps, self._missiles(numbers, ammo))
+            logger.info(
+                "%s has taken all of its share of the load plan",
+                mp.current_process().name)
+        else:
+            while True:
+                chunk = self._get_chunk()
+                if chunk is None:
+                    return
+                yield chunk
 
-        logger.info("Started shooter process: %s", mp.current_process().name)
+    def _get_chunk(self):
+        '''
+        Get next chunk of tasks from the transport. Return None on a poison
+        pill or a quit flag, an empty list if there is nothing to get yet
+        '''
+        if self.ring is not None:
+            records = self.ring.get(self.chunk_size, timeout=1)
+            if records is None or (not len(records) and self.quit.is_set()):
+                logger.info(
+                    "Task ring is closed. Exiting %s",
+                    mp.current_process().name)
+                return None
+            return self._tasks(
+                records['ts'], self._missiles(records['ammo'], None))
+        try:
+            chunk = self.task_queue.get(timeout=1)
+        except Empty:
+            if self.quit.is_set():
+                logger.debug(
+                    "Empty queue and quit flag. Exiting %s",
+                    mp.current_process().name)
+                return None
+            return []
+        if chunk is None:
+            logger.info(
+                "Got poison pill. Exiting %s", mp.current_process().name)
+            return None
+        timestamps, missiles = chunk
+        if self.ammo_random:
+            missiles = self._missiles(missiles, None)
+        return self._tasks(timestamps, missiles)
+
+    def _sync_worker(self, chunks):
+        '''
+        Blocking worker: one task at a time
+        '''
         self.gun.setup()
-        while not self.quit.is_set():
-            try:
-                task = self.task_queue.get(timeout=1)
-                if not task:
-                    logger.info(
-                        "Got poison pill. Exiting %s",
-                        mp.current_process().name)
+        try:
+            for chunk in chunks:
+                if self.quit.is_set():
                     break
-                task = task._replace(ts=self.start_time + (task.ts / 1000.0))
-                delay = task.ts - time.time()
-                if delay > 0:
-                    time.sleep(delay)
-                self.gun.shoot(task)
-            except (KeyboardInterrupt, SystemExit):
+                for task in chunk:
+                    if self.quit.is_set():
+                        break
+                    task = self._planned(task)
+                    self._record_jitter(
+                        wait_until(task.ts, self.spin_threshold))
+                    self.gun.shoot(task)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        self.gun.teardown()
+
+    async def _async_worker(self, chunks):
+        '''
+        Asynchronous worker: every task is scheduled as a coroutine
+        at its planned time, so there may be many tasks in flight. The
+        number of tasks a worker holds (waiting or in flight) is limited
+        by self.concurrency. Blocking guns run in the default executor,
+        which gets a thread for every concurrency slot (and one to read
+        chunks), so they can hold as many tasks in flight too
+        '''
+        loop = asyncio.get_event_loop()
+        loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=self.concurrency + 1))
+        slots = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        await self.gun.async_setup()
+        while not self.quit.is_set():
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
                 break
-            except Empty:
+            for task in chunk:
                 if self.quit.is_set():
-                    logger.debug(
-                        "Empty queue and quit flag. Exiting %s",
-                        mp.current_process().name)
                     break
-        self.gun.teardown()
+                await slots.acquire()
+                shot = loop.create_task(self._async_shoot(task, slots))
+                pending.add(shot)
+                shot.add_done_callback(pending.discard)
+        if pending:
+            logger.info(
+                "%s is waiting for %d tasks in flight",
+                mp.current_process().name, len(pending))
+            await asyncio.wait(pending)
+        await self.gun.async_teardown()
+
+    def _planned(self, task):
+        '''
+        Convert task timestamp from schedule offset to monotonic clock
+        '''
+        return task._replace(ts=self.start_time + task.ts * self.tick)
+
+    def _record_jitter(self, jitter):
+        '''
+        Collect how late tasks are dispatched and report it periodically
+        '''
+        self.jitter.record(jitter)
+        now = time.monotonic_ns()
+        if now - self._jitter_reported > self.JITTER_REPORT_INTERVAL * 1e9:
+            self._jitter_reported = now
+            logger.debug(
+                "%s dispatch jitter: %s",
+                mp.current_process().name, self.jitter)
+
+    async def _async_shoot(self, task, slots):
+        '''
+        Wait for the planned time and shoot. Release a concurrency
+        slot after that
+        '''
+        try:
+            task = self._planned(task)
+            self._record_jitter(
+                await async_wait_until(task.ts, self.spin_threshold))
+            await self.gun.async_shoot(task)
+        except Exception:
+            logger.warning("Task %s failed", task, exc_info=True)
+        finally:
+            slots.release()
 
 
 class BFGFactory(FactoryBase):
@@ -165,20 +484,46 @@ class BFGFactory(FactoryBase):
             bfg_config = self.factory_config.get(bfg_name)
             ammo = self.component_factory.get_factory(
                 'ammo', bfg_config.get('ammo'))
-            schedule = self.component_factory.get_factory(
-                'schedule', bfg_config.get('schedule'))
-            lp = (
-                Task(ts, bfg_name, marker, data)
-                for ts, (marker, data) in zip(schedule, ammo))
+            plan_cache = bfg_config.get('plan_cache')
+            if plan_cache:
+                schedule = cached_plan(
+                    plan_cache,
+                    self.config.get('schedule').get(
+                        bfg_config.get('schedule')),
+                    self.config.get('ammo').get(bfg_config.get('ammo')))
+            else:
+                schedule = self.component_factory.get_factory(
+                    'schedule', bfg_config.get('schedule'))
+            aggregator = self.component_factory.get_factory(
+                'aggregator', bfg_config.get('aggregator'))
+            results_mode = bfg_config.get('results', 'samples')
+            if results_mode == 'aggregates' and aggregator.engine != 'histogram':
+                raise ConfigurationError(
+                    "Aggregates from %s workers can only be merged by "
+                    "histogram aggregation engine" % bfg_name)
             return BFG(
                 name=bfg_name,
                 gun=self.component_factory.get_factory(
                     'gun', bfg_config.get('gun')),
-                load_plan=lp,
+                schedule=schedule,
+                ammo=ammo,
                 instances=bfg_config.get('instances'),
-                results=self.component_factory.get_factory(
-                    'aggregator',
-                    bfg_config.get('aggregator')).results_queue,
+                worker_type=bfg_config.get('worker', 'sync'),
+                concurrency=bfg_config.get('concurrency', 1000),
+                chunk_size=bfg_config.get('chunk_size', 100),
+                chunk_window=bfg_config.get('chunk_window', 100),
+                feeder=bfg_config.get('feeder', 'parent'),
+                transport=bfg_config.get('transport', 'queue'),
+                ring_size=bfg_config.get('ring_size', 65536),
+                spin_threshold=bfg_config.get('spin_threshold', 0.2),
+                results_mode=results_mode,
+                worker_raw_file=bfg_config.get('worker_raw_file'),
+                results_block_size=bfg_config.get('results_block_size', 4096),
+                results_block_interval=bfg_config.get(
+                    'results_block_interval', 100),
+                results=aggregator.results_queue,
+                intended_latency=aggregator.intended_latency,
+                late_threshold=aggregator.late_threshold,
                 event_loop=self.event_loop,
             )
         else:
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import random
 import time
@@ -25,6 +26,12 @@ class LoadTest(object):
             time.sleep(random.random())
             raise RuntimeError()
 
+    async def case3(self, task):
+        # coroutine scenarios are awaited by async workers
+        with self.gun.measure(task):
+            log.info("Shoot async case 3: %s", task.data)
+            await asyncio.sleep(random.random())
+
     def default(self, task):
         with self.gun.measure(task):
             log.info("Shoot default case: %s", task.data)
@@ -14,14 +14,17 @@ BFG is a modular tool and framework for load generation.
     url='https://github.com/direvius/bfg',
     packages=find_packages(exclude=["tests", "tmp", "docs", "data"]),
     install_requires=[
-        'hyper',
+        # the HTTP/2 gun relies on hyper internals, see bfg/guns/http2.py
+        'hyper==0.7.0',
         'numpy',
-        'pandas',
         'PyYAML',
         'pytoml',
         'arrow',
         # 'python-spdylay',
     ],
+    extras_require={
+        'pandas': ['pandas'],
+    },
     license='MIT',
     classifiers=[
         'Development Status :: 1 - Planning',
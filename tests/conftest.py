@@ -0,0 +1,35 @@
+import shutil
+import ssl
+import subprocess
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def certificate(tmp_path_factory):
+    '''
+    Self-signed certificate and key files for test servers
+    '''
+    if shutil.which('openssl') is None:
+        pytest.skip("openssl is needed to make a certificate")
+    path = tmp_path_factory.mktemp('tls')
+    cert, key = str(path / 'cert.pem'), str(path / 'key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost',
+    ], check=True, capture_output=True)
+    return cert, key
+
+
+@pytest.fixture
+def server_context(certificate):
+    '''
+    Make a server TLS context with the test certificate
+    '''
+    def make(alpn=None):
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(*certificate)
+        if alpn:
+            context.set_alpn_protocols(alpn)
+        return context
+    return make
@@ -0,0 +1,521 @@
+import asyncio
+import math
+import multiprocessing as mp
+import queue
+import sys
+import threading as th
+
+import pytest
+
+from bfg.aggregator import (
+    CachingAggregator, WorkerAggregator, QueueDrainer, SecondsRing,
+    Breakdown, SampleStats, Aggregate, AggregatorProcess, AggregatorFactory,
+    LoggingListener, QUANTILES, OTHER)
+from bfg.module_exceptions import ConfigurationError
+from bfg.columns import ResultBlock
+from bfg.guns.base import Sample
+
+
+def sample(rt, code=200, error=False, marker='index', ts=100):
+    return Sample(
+        ts, 'bfg', marker, rt, error, code, rt // 10, 'main', 'request', {})
+
+
+SAMPLES = [
+    sample(1000), sample(2000), sample(3000, 404),
+    sample(4000, None, True), sample(5000, marker='other'),
+]
+
+
+@pytest.fixture
+def make_aggregator():
+    loop = asyncio.new_event_loop()
+    aggregators = []
+
+    def make(**options):
+        options.setdefault('raw_filename', None)
+        aggregators.append(CachingAggregator(loop, **options))
+        return aggregators[-1]
+    yield make
+    for aggregator in aggregators:
+        aggregator.cache_depth = 0
+        aggregator.reader.stop()
+        loop.run_until_complete(aggregator.stop())
+    loop.close()
+
+
+@pytest.mark.parametrize('engine', ['histogram', 'pandas'])
+def test_overall_statistics(make_aggregator, engine):
+    if engine == 'pandas':
+        pytest.importorskip('pandas')
+    aggregator = make_aggregator(engine=engine)
+    ts, aggr = aggregator.aggregate(100, list(SAMPLES))
+    overall = aggr['overall']
+    assert ts == 100
+    assert aggr['rps'] == overall['samples'] == 5
+    assert overall['errors'] == 1
+    assert overall['codes'] == {'200': 3, '404': 1, 'None': 1}
+    assert overall['rt']['avg'] == 3000
+    assert overall['rt']['quantiles']['0'] == 1000
+    assert overall['rt']['quantiles']['100'] == 5000
+    assert set(overall['rt']['quantiles']) == {
+        str(int(q * 100)) for q in QUANTILES}
+    assert overall['delay']['avg'] == 300
+
+
+def test_engines_agree(make_aggregator):
+    pytest.importorskip('pandas')
+    samples = SAMPLES + [sample(rt) for rt in range(1000, 101000, 100)]
+    _, histogram = make_aggregator().aggregate(100, list(samples))
+    _, pandas = make_aggregator(engine='pandas').aggregate(
+        100, list(samples))
+    for key in ('samples', 'errors', 'codes'):
+        assert histogram['overall'][key] == pandas['overall'][key]
+    for q, value in pandas['overall']['rt']['quantiles'].items():
+        assert histogram['overall']['rt']['quantiles'][q] == \
+            pytest.approx(value, rel=.02)
+    assert 'tags' in histogram and 'tags' not in pandas
+
+
+def test_histogram_tags(make_aggregator):
+    _, aggr = make_aggregator().aggregate(100, list(SAMPLES))
+    markers = aggr['tags']['marker']
+    assert markers['index']['samples'] == 4
+    assert markers['other']['samples'] == 1
+    assert markers['index']['codes'] == {'200': 2, '404': 1, 'None': 1}
+    assert aggr['tags']['bfg']['bfg']['samples'] == 5
+
+
+def test_codes_without_missing_ones(make_aggregator):
+    pytest.importorskip('pandas')
+    _, aggr = make_aggregator(engine='pandas').aggregate(
+        100, [sample(1000), sample(2000, 503, True)])
+    assert aggr['overall']['codes'] == {'200': 1, '503': 1}
+    assert aggr['overall']['errors'] == 1
+
+
+def drain(results_queue):
+    aggregates = []
+    while not results_queue.empty():
+        aggregates.extend(results_queue.get())
+    return aggregates
+
+
+def test_worker_aggregates():
+    results_queue = queue.Queue()
+    aggregator = WorkerAggregator(results_queue, interval=3600)
+    for item in SAMPLES:
+        aggregator.put(item)
+    assert results_queue.empty()
+    aggregator.close()
+    aggregates = {
+        aggregate.marker: aggregate for aggregate in drain(results_queue)}
+    assert set(aggregates) == {'index', 'other'}
+    index = aggregates['index']
+    assert (index.ts, index.bfg, index.scenario, index.action) == (
+        100, 'bfg', 'main', 'request')
+    assert index.stats.count == 4
+    assert index.stats.errors == 1
+    assert index.stats.codes == {200: 2, 404: 1, None: 1}
+
+
+def test_worker_aggregator_flushes_during_pause():
+    results_queue = queue.Queue()
+    aggregator = WorkerAggregator(results_queue, interval=0.1)
+    for item in SAMPLES:
+        aggregator.put(item)
+    # no more samples come, the aggregates are sent on time anyway
+    aggregates = results_queue.get(timeout=2)
+    assert sum(aggregate.stats.count for aggregate in aggregates) == 5
+    aggregator.close()
+    assert results_queue.empty()
+
+
+def test_worker_aggregator_threads():
+    results_queue = queue.Queue()
+    # every put flushes, so puts and flushes race
+    aggregator = WorkerAggregator(results_queue, interval=0)
+    threads, count = 8, 2000
+
+    def shoot():
+        for rt in range(count):
+            aggregator.put(sample(rt))
+            if rt % 100 == 0:
+                aggregator.flush()
+    shooters = [th.Thread(target=shoot) for _ in range(threads)]
+    # switch threads often to make races likely
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for shooter in shooters:
+            shooter.start()
+        for shooter in shooters:
+            shooter.join()
+    finally:
+        sys.setswitchinterval(interval)
+    aggregator.close()
+    aggregates = drain(results_queue)
+    assert sum(aggregate.stats.count for aggregate in aggregates) == \
+        threads * count
+    assert sum(
+        aggregate.stats.rt.total for aggregate in aggregates) == \
+        threads * sum(range(count))
+
+
+def drained(items, max_batch):
+    results_queue = queue.Queue()
+    for item in items:
+        results_queue.put(item)
+    return drained_queue(results_queue, max_batch)
+
+
+def drained_queue(results_queue, max_batch):
+    loop = asyncio.new_event_loop()
+    batches = []
+    stopped = loop.create_future()
+    drainer = QueueDrainer(
+        results_queue, loop, batches.append,
+        lambda: stopped.set_result(True), max_batch=max_batch)
+    drainer.stop()
+    loop.run_until_complete(asyncio.wait_for(stopped, 10))
+    loop.close()
+    return drainer, batches
+
+
+def test_queue_drained_in_batches():
+    drainer, batches = drained(range(25), max_batch=10)
+    assert [item for batch in batches for item in batch] == list(range(25))
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert (drainer.batches, drainer.items) == (3, 25)
+    assert drainer.max_depth == 15
+    assert drainer.depth == 0
+
+
+def test_queue_drained_after_stop():
+    drainer, batches = drained([], max_batch=10)
+    assert batches == []
+    drainer.thread.join(1)
+    assert not drainer.thread.is_alive()
+
+
+def put_numbers(results_queue, count):
+    for number in range(count):
+        results_queue.put(number)
+
+
+def test_queue_drained_from_other_process():
+    results_queue = mp.Queue()
+    producer = mp.Process(target=put_numbers, args=(results_queue, 1000))
+    producer.start()
+    producer.join()
+    drainer, batches = drained_queue(results_queue, max_batch=100)
+    assert [item for batch in batches for item in batch] == list(range(1000))
+    assert all(len(batch) <= 100 for batch in batches)
+
+
+def test_seconds_ring_order():
+    ring = SecondsRing()
+    for ts in (105, 103, 108, 103):
+        assert ring.add(ts, ts)
+    assert len(ring) == 6
+    popped = [ring.pop() for _ in range(len(ring))]
+    assert popped == [
+        (103, [103, 103]), (104, []), (105, [105]), (106, []), (107, []),
+        (108, [108])]
+    assert not ring.add(108, 'late')
+    assert ring.add(109, 'next')
+    assert ring.pop() == (109, ['next'])
+
+
+def test_seconds_ring_late_after_pop():
+    ring = SecondsRing()
+    ring.add(10, 'a')
+    ring.add(12, 'c')
+    assert ring.pop() == (10, ['a'])
+    assert not ring.add(9, 'late')
+    assert not ring.add(10, 'late')
+    assert ring.add(11, 'b')
+    assert [ring.pop(), ring.pop()] == [(11, ['b']), (12, ['c'])]
+
+
+class Listener(object):
+    def __init__(self):
+        self.published = []
+        self.corrected = []
+
+    def publish(self, ts, data):
+        self.published.append((ts, data))
+
+    def correct(self, ts, data):
+        self.corrected.append((ts, data))
+
+
+def publish_oldest(aggregator):
+    ts, samples = aggregator.results.pop()
+    if samples:
+        aggregator.publish(*aggregator.aggregate(ts, samples))
+
+
+def test_late_samples_are_corrected(make_aggregator):
+    listener = Listener()
+    aggregator = make_aggregator(listeners=[listener], lateness_window=10)
+    aggregator._consume([sample(1000), sample(2000)])
+    publish_oldest(aggregator)
+    aggregator._consume([sample(3000, 500, True)])
+    aggregator._correct_late()
+    assert [ts for ts, _ in listener.published] == [100]
+    assert len(listener.corrected) == 1
+    ts, data = listener.corrected[0]
+    assert ts == 100
+    assert data['rps'] == 3
+    assert data['overall']['errors'] == 1
+    assert data['overall']['codes'] == {'200': 2, '500': 1}
+    assert data['overall']['rt']['quantiles']['100'] == 3000
+    assert aggregator.aggregated_results[100]['samples'] == 3
+    assert aggregator.lost == 0
+
+
+def test_too_late_samples_are_lost(make_aggregator):
+    listener = Listener()
+    aggregator = make_aggregator(listeners=[listener], lateness_window=10)
+    aggregator._consume([sample(1000), sample(1000, ts=111)])
+    for _ in range(12):
+        publish_oldest(aggregator)
+    # second 100 is out of the lateness window of second 111
+    aggregator._consume([sample(2000), sample(2000, ts=111)])
+    aggregator._correct_late()
+    assert [ts for ts, _ in listener.published] == [100, 111]
+    assert aggregator.lost == 1
+    assert [ts for ts, _ in listener.corrected] == [111]
+    assert listener.corrected[0][1]['rps'] == 2
+
+
+def summary(stats):
+    return (
+        stats.count, stats.errors, stats.codes, stats.rt.total,
+        stats.rt.quantiles(QUANTILES))
+
+
+def test_breakdown_of_samples_blocks_and_aggregates():
+    samples = [
+        sample(rt, code, rt % 3 == 0, marker)
+        for rt, code, marker in zip(
+            range(1000, 2000, 10), [200, 404, 500, 200] * 25,
+            ['a', 'b', 'c', 'a', 'b'] * 20)]
+    whole = Breakdown()
+    whole.record(samples, [], [])
+    aggregates = []
+    for marker in 'abc':
+        stats = SampleStats()
+        stats.record([item for item in samples[60:] if item.marker == marker])
+        aggregates.append(
+            Aggregate(100, 'bfg', marker, 'main', 'request', stats))
+    parts = Breakdown()
+    parts.record(samples[:30], [ResultBlock.from_samples(samples[30:60])], [])
+    parts.record([], [], aggregates)
+    assert set(parts.groups) == set(whole.groups) == {
+        ('bfg', marker, 'main', 'request') for marker in 'abc'}
+    for key, stats in whole.groups.items():
+        assert summary(parts.groups[key]) == summary(stats)
+    assert summary(parts.overall()) == summary(whole.overall())
+
+
+def test_breakdown_of_block_with_many_values():
+    # 2 ** 17 values with OTHER, so packing the four ids of a group into
+    # one int64 would overflow and merge the groups of these two rows
+    values = ['value%d' % number for number in range(2 ** 17 - 1)]
+    rows = ResultBlock.empty(2)
+    rows['rt'] = 1000
+    rows['bfg'] = [0, 2 ** 13]
+    breakdown = Breakdown()
+    breakdown.record([], [ResultBlock(rows, values, {})], [])
+    assert {key: stats.count for key, stats in breakdown.groups.items()} == {
+        ('value0', 'value0', 'value0', 'value0'): 1,
+        ('value8192', 'value0', 'value0', 'value0'): 1,
+    }
+
+
+def test_breakdown_by_tag():
+    breakdown = Breakdown()
+    breakdown.record(SAMPLES, [], [])
+    markers = breakdown.by_tag('marker')
+    assert {marker: stats.count for marker, stats in markers.items()} == {
+        'index': 4, 'other': 1}
+    assert markers['index'].errors == 1
+    actions = breakdown.by_tag('action')
+    assert list(actions) == ['request']
+    assert summary(actions['request']) == summary(breakdown.overall())
+
+
+def test_breakdown_folds_rare_markers():
+    frequent = [sample(1000, marker='a')] * 3 + [sample(1000, marker='b')] * 2
+    rare = [sample(1000, marker=marker) for marker in 'cde']
+    breakdown = Breakdown(max_markers=2)
+    breakdown.record(
+        frequent[:2] + rare[:1],
+        [ResultBlock.from_samples(frequent[2:] + rare[1:2])],
+        [Aggregate(100, 'bfg', 'e', 'main', 'request', SampleStats())])
+    counts = {
+        marker: stats.count
+        for marker, stats in breakdown.by_tag('marker').items()}
+    assert counts == {'a': 3, 'b': 2, OTHER: 2}
+
+
+def test_sample_stats_merge():
+    first, second = SampleStats(True, 150), SampleStats(True, 150)
+    first.record(SAMPLES[:2])
+    second.record(SAMPLES[2:])
+    whole = SampleStats(True, 150)
+    whole.record(SAMPLES)
+    first.merge(second)
+    assert summary(first) == summary(whole)
+    assert first.late == whole.late == 4
+    assert first.intended.total == whole.intended.total
+
+
+def test_aggregator_process(tmp_path):
+    listener = Listener()
+    loop = asyncio.new_event_loop()
+    aggregator = AggregatorProcess(
+        loop, listeners=[listener], raw_filename=str(tmp_path / 'raw'),
+        series_filename=None)
+    assert aggregator.process.is_alive()
+    aggregator.results_queue.put(SAMPLES[0])
+    aggregator.results_queue.put(ResultBlock.from_samples(
+        SAMPLES[1:] + [sample(1000, ts=101)]))
+    loop.run_until_complete(aggregator.stop())
+    loop.close()
+    assert aggregator.process.exitcode == 0
+    assert [(ts, data['rps']) for ts, data in listener.published] == [
+        (100, 5), (101, 1)]
+    overall = listener.published[0][1]['overall']
+    assert overall['errors'] == 1
+    assert overall['codes'] == {'200': 3, '404': 1, 'None': 1}
+    assert 'tags' not in listener.published[0][1]
+    assert aggregator.aggregated_results[100]['samples'] == 5
+    assert len((tmp_path / 'raw').read_text().splitlines()) == 7
+
+
+def test_aggregator_process_bad_engine():
+    loop = asyncio.new_event_loop()
+    with pytest.raises(ConfigurationError):
+        AggregatorProcess(loop, engine='spark')
+    loop.close()
+
+
+@pytest.mark.parametrize('engine', ['histogram', 'pandas'])
+def test_intended_latency_and_late_tasks(make_aggregator, engine):
+    if engine == 'pandas':
+        pytest.importorskip('pandas')
+    aggregator = make_aggregator(
+        engine=engine, intended_latency=True, late_threshold=250)
+    _, aggr = aggregator.aggregate(100, list(SAMPLES))
+    overall = aggr['overall']
+    # delays are rt / 10
+    assert overall['intended']['avg'] == pytest.approx(3300)
+    assert overall['intended']['quantiles']['0'] == 1100
+    assert overall['intended']['quantiles']['100'] == 5500
+    assert overall['late'] == 3
+    if engine == 'histogram':
+        assert aggr['tags']['marker']['other']['late'] == 1
+        assert aggr['tags']['marker']['other']['intended']['avg'] == 5500
+
+
+def test_no_intended_latency_by_default(make_aggregator):
+    _, aggr = make_aggregator().aggregate(100, list(SAMPLES))
+    assert 'intended' not in aggr['overall']
+    assert 'late' not in aggr['overall']
+
+
+def test_worker_aggregates_late_tasks():
+    results_queue = queue.Queue()
+    aggregator = WorkerAggregator(
+        results_queue, intended_latency=True, late_threshold=250)
+    for item in SAMPLES:
+        aggregator.put(item)
+    aggregator.close()
+    stats = SampleStats(True, 250)
+    for aggregate in drain(results_queue):
+        stats.merge(aggregate.stats)
+    assert stats.late == 3
+    assert stats.intended.count == 5
+    assert stats.intended.max == 5500
+
+
+def test_late_threshold_in_milliseconds():
+    class Components(object):
+        config = {'aggregator': {'default': {
+            'raw_file': '', 'series_file': '', 'late_threshold': 5,
+            'intended_latency': True}}}
+        event_loop = asyncio.new_event_loop()
+
+    factory = AggregatorFactory(Components())
+    aggregator = factory.get('default')
+    assert aggregator.late_threshold == 5000
+    assert aggregator.intended_latency
+    assert factory.get('default') is aggregator
+    Components.event_loop.run_until_complete(factory.stop())
+    Components.event_loop.close()
+
+
+def test_logging_listener(make_aggregator, caplog):
+    _, data = make_aggregator(
+        intended_latency=True, late_threshold=250).aggregate(
+            100, list(SAMPLES))
+    with caplog.at_level('INFO', logger='bfg.aggregator'):
+        LoggingListener().publish(100, data)
+        LoggingListener().correct(100, data)
+    first, second = caplog.messages
+    assert '5 RPS, mean RT: 3.000 ms, 99% < 5.000 ms' in first
+    assert ', intended 99% < 5.' in first
+    assert first.endswith(', 3 late')
+    assert '(corrected)' in second and '(corrected)' not in first
+
+
+def with_phases(item, **phases):
+    return item._replace(**phases)
+
+
+@pytest.mark.parametrize('engine', ['histogram', 'pandas'])
+def test_phases(make_aggregator, engine):
+    if engine == 'pandas':
+        pytest.importorskip('pandas')
+    samples = [
+        with_phases(sample(1000), connect=100, ttfb=500, body=400),
+        with_phases(sample(2000), ttfb=1500, body=500),
+        sample(3000),
+    ]
+    _, aggr = make_aggregator(engine=engine).aggregate(100, samples)
+    phases = aggr['overall']['phases']
+    assert set(phases) == {'connect', 'ttfb', 'body'}
+    assert phases['connect']['avg'] == 100
+    assert phases['ttfb']['avg'] == 1000
+    assert phases['body']['quantiles']['100'] == 500
+
+
+def test_phases_from_blocks_and_aggregates(make_aggregator):
+    samples = [
+        with_phases(sample(1000), connect=100, ttfb=500),
+        with_phases(sample(2000), ttfb=1500),
+        with_phases(sample(3000), ttfb=2500),
+    ]
+    stats = SampleStats()
+    stats.record(samples[2:])
+    aggregator = make_aggregator()
+    _, aggr = aggregator.aggregate(100, [
+        samples[0], ResultBlock.from_samples(samples[1:2]),
+        Aggregate(100, 'bfg', 'index', 'main', 'request', stats)])
+    aggregator.publish(100, aggr)
+    phases = aggr['overall']['phases']
+    assert phases['connect']['avg'] == 100
+    assert phases['ttfb']['avg'] == 1500
+    assert phases['ttfb']['quantiles']['100'] == 2500
+    assert aggr['tags']['marker']['index']['phases']['ttfb']['avg'] == 1500
+    stored = aggregator.aggregated_results[100]['phases']
+    assert stored['ttfb']['avg'] == 1500
+    assert math.isnan(stored['dns']['avg'])
+
+
+def test_no_phases(make_aggregator):
+    _, aggr = make_aggregator().aggregate(100, list(SAMPLES))
+    assert 'phases' not in aggr['overall']
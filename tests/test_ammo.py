@@ -0,0 +1,154 @@
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+from bfg.ammo import create, LineReader, HttpReader, Group
+from bfg.module_exceptions import AmmoFileError, ConfigurationError
+
+
+@pytest.fixture
+def ammo_file(tmp_path):
+    path = tmp_path / 'ammo.line'
+    path.write_text('/first marker1\n/second\n/third marker3\n')
+    return str(path)
+
+
+def test_random_access_cycles_through_lines(ammo_file):
+    reader = LineReader(ammo_file)
+    assert len(reader) == 3
+    assert [reader[n] for n in range(5)] == [
+        ('marker1', '/first'), ('', '/second'), ('marker3', '/third'),
+        ('marker1', '/first'), ('', '/second')]
+
+
+def test_iteration_is_same_as_random_access(ammo_file):
+    reader = LineReader(ammo_file)
+    missiles = iter(reader)
+    assert [next(missiles) for _ in range(7)] == [reader[n] for n in range(7)]
+
+
+def test_last_line_without_newline(tmp_path):
+    path = tmp_path / 'ammo.line'
+    path.write_text('/a\n/b')
+    reader = LineReader(str(path))
+    assert len(reader) == 2
+    assert reader[1] == ('', '/b')
+
+
+def test_create_indexes_ammo_and_maps_the_index(ammo_file):
+    reader = create({'file': ammo_file})
+    assert os.path.exists(ammo_file + '.idx')
+    # the index is opened before workers fork: they only map it
+    assert isinstance(reader.offsets, np.memmap)
+    assert reader.mmap is not None
+
+
+def test_cached_index_is_used(ammo_file, monkeypatch):
+    LineReader(ammo_file).open()
+
+    def build_index(self, stat):
+        raise AssertionError("index should not be built again")
+
+    monkeypatch.setattr(LineReader, '_build_index', build_index)
+    reader = LineReader(ammo_file)
+    reader.open()
+    assert reader[2] == ('marker3', '/third')
+
+
+def test_stale_index_is_rebuilt(ammo_file):
+    LineReader(ammo_file).open()
+    with open(ammo_file, 'a') as ammo:
+        ammo.write('/fourth\n')
+    reader = LineReader(ammo_file)
+    assert len(reader) == 4
+    assert reader[3] == ('', '/fourth')
+    assert len(LineReader(ammo_file)) == 4
+
+
+def test_index_is_kept_in_memory_if_it_can_not_be_saved(
+        ammo_file, monkeypatch):
+    def replace(source, destination):
+        raise PermissionError("read-only directory")
+
+    monkeypatch.setattr(os, 'replace', replace)
+    reader = LineReader(ammo_file)
+    assert len(reader) == 3
+    assert not isinstance(reader.offsets, np.memmap)
+    assert not os.path.exists(ammo_file + '.idx')
+    assert os.listdir(os.path.dirname(ammo_file)) == ['ammo.line']
+
+
+def test_gzipped_ammo_is_loaded(tmp_path):
+    path = tmp_path / 'ammo.line.gz'
+    with gzip.open(str(path), 'wt') as ammo:
+        ammo.write('/a m\n/b\n')
+    reader = create({'file': str(path)})
+    assert len(reader) == 2
+    assert reader[3] == ('', '/b')
+
+
+def test_empty_ammo(tmp_path):
+    path = tmp_path / 'ammo.line'
+    path.write_text('')
+    with pytest.raises(AmmoFileError):
+        create({'file': str(path)})
+
+
+def test_batches(ammo_file):
+    reader = create({'file': ammo_file, 'batch': 2})
+    assert isinstance(reader, Group)
+    assert reader[1] == (
+        'multi-2', [('marker3', '/third'), ('marker1', '/first')])
+    assert next(iter(reader)) == reader[0]
+
+
+def test_unknown_format(ammo_file):
+    with pytest.raises(ConfigurationError):
+        create({'file': ammo_file, 'format': 'nope'})
+
+
+@pytest.fixture
+def http_ammo(tmp_path):
+    path = tmp_path / 'ammo.http'
+    path.write_text(
+        '{"method": "POST", "uri": "/form", "headers": {"Host": "a.b", '
+        '"Connection": "close"}, "body": "x=1", "marker": "form"}\n'
+        '{"uri": "/index.html"}\n')
+    return str(path)
+
+
+def test_http_requests_are_compiled(http_ammo):
+    reader = create({'file': http_ammo, 'format': 'http'})
+    assert len(reader) == 2
+    marker, request = reader[0]
+    assert marker == 'form'
+    assert request.method == b'POST'
+    assert request.headers == {b'host': b'a.b', b'content-length': b'3'}
+    assert request.wire == (
+        b'POST /form HTTP/1.1\r\nHost: a.b\r\ncontent-length: 3\r\n\r\nx=1')
+    marker, request = reader[3]
+    assert marker == ''
+    assert request.wire == b'GET /index.html HTTP/1.1\r\n\r\n'
+    missiles = iter(reader)
+    assert [next(missiles) for _ in range(3)] == [reader[n] for n in range(3)]
+
+
+def test_compiled_requests_cache_is_bounded(tmp_path, monkeypatch):
+    path = tmp_path / 'ammo.http'
+    path.write_text(''.join('{"uri": "/%d"}\n' % n for n in range(100)))
+    monkeypatch.setattr(HttpReader, 'CACHE_SIZE', 10)
+    reader = HttpReader(str(path))
+    for n in range(300):
+        assert reader[n][1].uri == b'/%d' % (n % 100)
+    assert reader._request.cache_info().currsize == 10
+    assert reader[5] is reader[105]
+
+
+def test_bad_http_request(tmp_path):
+    path = tmp_path / 'ammo.http'
+    path.write_text('{"method": "GET"}\n')
+    reader = create({'file': str(path), 'format': 'http'})
+    with pytest.raises(AmmoFileError):
+        reader[0]
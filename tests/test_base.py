@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from bfg.guns.base import GunBase, StopWatch, Sample, PHASES
+from bfg.worker import Task
+
+
+class Results(list):
+    def put(self, sample):
+        self.append(sample)
+
+
+def task(ts=None):
+    return Task(
+        time.monotonic_ns() if ts is None else ts, 'bfg', 'marker', '/')
+
+
+def test_sample_fields():
+    assert Sample._fields[-len(PHASES):] == PHASES
+    sample = Sample(1, 'bfg', 'marker', 10, False, 200, 0, None, None, {})
+    assert all(getattr(sample, phase) is None for phase in PHASES)
+
+
+def test_phases_in_microseconds():
+    sw = StopWatch(task())
+    sw.set_phase('connect', 1500000)
+    with sw.phase('ttfb'):
+        time.sleep(0.01)
+    sw.stop()
+    sample = sw.as_sample()
+    assert sample.connect == 1500
+    assert 10000 <= sample.ttfb < 1000000
+    assert sample.dns is None and sample.tls is None and sample.body is None
+
+
+def test_phase_measured_on_error():
+    sw = StopWatch(task())
+    with pytest.raises(ValueError):
+        with sw.phase('body'):
+            raise ValueError()
+    assert sw.as_sample().body is not None
+
+
+def test_sample_times():
+    planned = time.monotonic_ns() - 5000000
+    sw = StopWatch(task(planned))
+    time.sleep(0.01)
+    sw.stop()
+    sample = sw.as_sample()
+    assert 5000 <= sample.delay < 1000000
+    assert 10000 <= sample.rt < 1000000
+    assert abs(sample.ts - time.time()) <= 1
+    stopped = sw.end_time
+    sw.stop()
+    assert sw.end_time == stopped
+
+
+def test_measure_marks_errors():
+    gun = GunBase({})
+    gun.results = Results()
+    with pytest.raises(ValueError):
+        with gun.measure(task()) as sw:
+            sw.set_phase('connect', 1000)
+            raise ValueError()
+    with gun.measure(task()) as sw:
+        sw.set_error(500)
+    failed, coded = gun.results
+    assert failed.error and failed.connect == 1
+    assert coded.error and coded.code == 500
@@ -0,0 +1,124 @@
+import queue
+
+import numpy as np
+
+from bfg.columns import ColumnarBuffer, ResultBlock
+from bfg.guns.base import GunBase, Sample, PHASES
+from bfg.worker import Task
+
+
+class SampleList(list):
+    ''' A list that collects samples '''
+
+    def put(self, sample):
+        self.append(sample)
+
+
+class PhaseGun(GunBase):
+    def shoot(self, task):
+        with self.measure(task) as sw:
+            sw.scenario = 'main'
+            sw.action = 'request'
+            sw.set_code(200 + task.data)
+            sw.set_phase('connect', 1000000)
+            if task.data:
+                sw.ext['missile'] = task.data
+
+
+def task(number, ts=0):
+    return Task(ts, 'bfg', 'marker', number)
+
+
+def sample(ts, marker, rt, code=200, ext=None, connect=None):
+    phases = [None] * len(PHASES)
+    if connect is not None:
+        phases[PHASES.index('connect')] = connect
+    return Sample(
+        ts, 'bfg', marker, rt, False, code, 10, 'main', 'request',
+        ext or {}, *phases)
+
+
+def test_measure_into_list_like_sink():
+    gun = PhaseGun({})
+    gun.results = SampleList()
+    gun.shoot(task(0))
+    assert len(gun.results) == 1
+    assert isinstance(gun.results[0], Sample)
+    assert gun.results[0].code == 200
+    assert gun.results[0].connect == 1000
+
+
+def test_measure_into_columnar_buffer():
+    results_queue = queue.Queue()
+    gun = PhaseGun({})
+    gun.results = ColumnarBuffer(results_queue, size=2, flush_interval=60)
+    for number in range(3):
+        gun.shoot(task(number))
+    block = results_queue.get_nowait()
+    assert results_queue.empty()
+    gun.results.close()
+    block = ResultBlock.concatenate([block, results_queue.get_nowait()])
+    samples = list(block)
+    assert [sample.code for sample in samples] == [200, 201, 202]
+    assert [sample.ext for sample in samples] == [
+        {}, {'missile': 1}, {'missile': 2}]
+    assert all(sample.connect == 1000 for sample in samples)
+    assert all(sample.dns is None for sample in samples)
+    assert all(sample.action == 'request' for sample in samples)
+
+
+def test_columnar_buffer_flushes_during_pause():
+    results_queue = queue.Queue()
+    gun = PhaseGun({})
+    gun.results = ColumnarBuffer(results_queue, size=100, flush_interval=0.1)
+    for number in range(3):
+        gun.shoot(task(number))
+    # no more samples come, the block is sent on time anyway
+    block = results_queue.get(timeout=2)
+    assert [sample.code for sample in block] == [200, 201, 202]
+    gun.results.close()
+    assert results_queue.empty()
+
+
+def test_block_round_trip():
+    samples = [
+        sample(100, 'a', 1000, connect=5),
+        sample(100, 'b', 2000, 404, {'x': 1}),
+        sample(101, 'a', 3000, None),
+    ]
+    block = ResultBlock.from_samples(samples)
+    assert len(block) == 3
+    assert list(block) == samples
+
+
+def test_block_split_by_second():
+    samples = [
+        sample(101, 'a', 1000), sample(100, 'b', 2000, ext={'x': 1}),
+        sample(101, 'c', 3000, ext={'y': 2}),
+    ]
+    seconds = ResultBlock.from_samples(samples).split()
+    assert [ts for ts, _ in seconds] == [100, 101]
+    assert list(seconds[0][1]) == [samples[1]]
+    assert list(seconds[1][1]) == [samples[0], samples[2]]
+
+
+def test_concatenate_blocks():
+    first = [sample(100, 'a', 1000), sample(100, 'b', 2000, ext={'x': 1})]
+    second = [sample(100, 'b', 3000, 500), sample(101, 'c', 4000)]
+    block = ResultBlock.concatenate([
+        ResultBlock.from_samples(first), ResultBlock.from_samples(second),
+        ResultBlock.from_samples([])])
+    assert list(block) == first + second
+    assert len(block.values) == len(set(block.values))
+
+
+def test_upgrade_rows_without_phases():
+    old = np.dtype([
+        name_type for name_type in ResultBlock.COLUMNS.descr
+        if name_type[0] not in PHASES])
+    rows = np.zeros(2, dtype=old)
+    rows['rt'] = [1, 2]
+    upgraded = ResultBlock.upgrade(rows)
+    assert upgraded.dtype == ResultBlock.COLUMNS
+    assert upgraded['rt'].tolist() == [1, 2]
+    assert (upgraded['connect'] == ResultBlock.NOT_MEASURED).all()
@@ -0,0 +1,68 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from bfg.histogram import Histogram
+
+
+def test_merged_histograms_equal_one_histogram():
+    values = np.random.RandomState(1).lognormal(8, 2, 30000).astype(np.int64)
+    whole = Histogram()
+    whole.record(values)
+    merged = Histogram()
+    for part in np.array_split(values, 7):
+        histogram = Histogram()
+        histogram.record(part)
+        merged.merge(histogram)
+    assert merged.count == whole.count == len(values)
+    assert (merged.min, merged.max) == (values.min(), values.max())
+    assert merged.mean == pytest.approx(values.mean())
+    assert np.array_equal(merged.counts, whole.counts)
+    qs = [0, .25, .5, .75, .9, .99, 1]
+    assert merged.quantiles(qs) == whole.quantiles(qs)
+
+
+def test_merge_empty_histogram():
+    histogram = Histogram()
+    histogram.record([3, 5])
+    histogram.merge(Histogram())
+    assert (histogram.count, histogram.min, histogram.max) == (2, 3, 5)
+    assert Histogram().merge(histogram).quantiles([0, 1]) == {
+        '0': 3, '100': 5}
+
+
+def test_merge_different_precision():
+    with pytest.raises(ValueError):
+        Histogram(7).merge(Histogram(8))
+
+
+def test_quantiles_are_precise():
+    values = np.random.RandomState(2).randint(0, 10 ** 7, 20000)
+    histogram = Histogram()
+    histogram.record(values)
+    for q in (.1, .5, .9, .99):
+        exact = np.quantile(values, q, method='inverted_cdf')
+        assert abs(histogram.quantile(q) - exact) <= exact * 2 ** -6
+
+
+def test_small_values_are_exact():
+    histogram = Histogram()
+    histogram.record(np.arange(100))
+    assert [histogram.quantile(q) for q in (.01, .5, .99)] == [0, 49, 98]
+
+
+def test_empty_histogram():
+    histogram = Histogram()
+    histogram.record([])
+    assert histogram.count == 0
+    assert histogram.mean is None
+    assert histogram.quantile(.5) is None
+
+
+def test_pickled_histogram():
+    histogram = Histogram()
+    histogram.record([1, 1000, 10 ** 9])
+    restored = pickle.loads(pickle.dumps(histogram))
+    assert np.array_equal(restored.counts, histogram.counts)
+    assert restored.quantiles([0, .5, 1]) == histogram.quantiles([0, .5, 1])
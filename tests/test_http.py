@@ -0,0 +1,231 @@
+import asyncio
+import threading as th
+import time
+
+import pytest
+
+from bfg.ammo import compile_request
+from bfg.guns.http import HttpGun, HttpConnection, NotProcessed
+from bfg.worker import Task
+
+
+RESPONSES = {
+    b'/ok': b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+    b'/chunked':
+        b'HTTP/1.1 201 Created\r\nTransfer-Encoding: chunked\r\n\r\n'
+        b'5\r\nhello\r\n3;x=1\r\nabc\r\n0\r\nX-Trailer: 1\r\n\r\n',
+    b'/close': b'HTTP/1.1 503 Busy\r\nConnection: close\r\n\r\nbye',
+    b'/head': b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n',
+    b'/empty': b'HTTP/1.1 204 No Content\r\n\r\n',
+    b'/old': b'HTTP/1.0 200 OK\r\n\r\nuntil the end',
+    b'/continue':
+        b'HTTP/1.1 100 Continue\r\n\r\n'
+        b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok',
+    b'/hints':
+        b'HTTP/1.1 103 Early Hints\r\nLink: </style.css>; rel=preload\r\n\r\n'
+        b'HTTP/1.1 100 Continue\r\n\r\n'
+        b'HTTP/1.1 202 Accepted\r\nContent-Length: 0\r\n\r\n',
+}
+
+
+class Server(asyncio.Protocol):
+    ''' Answers requests in order, as a pipelining HTTP/1.1 server '''
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.buffer = b''
+        self.stalled = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stats['connections'] += 1
+
+    def data_received(self, data):
+        self.buffer += data
+        while b'\r\n\r\n' in self.buffer and not self.stalled:
+            head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+            self.stats['requests'].append(head)
+            length = [
+                line for line in head.lower().split(b'\r\n')
+                if line.startswith(b'content-length:')]
+            if length:
+                self.buffer = self.buffer[int(length[0][15:]):]
+            path = head.split()[1]
+            if path == b'/slow':
+                # nothing is answered on this connection anymore
+                self.stalled = True
+                return
+            if path == b'/drop':
+                self.transport.close()
+                return
+            self.transport.write(RESPONSES[path])
+            if path in (b'/close', b'/old'):
+                self.transport.close()
+                return
+
+
+@pytest.fixture
+def server():
+    stats = {'connections': 0, 'requests': []}
+    started = th.Event()
+    loop = asyncio.new_event_loop()
+
+    def serve():
+        server = loop.run_until_complete(loop.create_server(
+            lambda: Server(stats), '127.0.0.1', 0))
+        stats['port'] = server.sockets[0].getsockname()[1]
+        started.set()
+        loop.run_forever()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+    thread = th.Thread(target=serve, daemon=True)
+    thread.start()
+    started.wait()
+    yield stats
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+class Results(list):
+    def put(self, sample):
+        self.append(sample)
+
+
+def make_gun(port, **options):
+    options['target'] = 'http://127.0.0.1:%d' % port
+    gun = HttpGun(options)
+    gun.results = Results()
+    return gun
+
+
+def task(data):
+    return Task(time.monotonic_ns(), 'bfg', 'marker', data)
+
+
+def shoot(gun, requests):
+    ''' Shoot requests at once in an async worker way '''
+    async def run():
+        await gun.async_setup()
+        await asyncio.gather(*(
+            gun.async_shoot(task(request)) for request in requests))
+        await gun.async_teardown()
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(run())
+    loop.close()
+    return gun.results
+
+
+def test_keep_alive(server):
+    gun = make_gun(server['port'], pool_size=1)
+    gun.setup()
+    for _ in range(5):
+        gun.shoot(task('/ok'))
+    gun.teardown()
+    assert [sample.code for sample in gun.results] == [200] * 5
+    assert not any(sample.error for sample in gun.results)
+    assert server['connections'] == 1
+    first, second = gun.results[:2]
+    assert first.connect is not None and first.dns is not None
+    assert second.connect is None and second.dns is None
+    assert all(
+        sample.ttfb is not None and sample.body is not None
+        for sample in gun.results)
+    assert server['requests'][0] == \
+        b'GET /ok HTTP/1.1\r\nHost: 127.0.0.1:%d' % server['port']
+
+
+def test_pipelining(server):
+    gun = make_gun(server['port'], pool_size=1, pipeline=4)
+    results = shoot(gun, ['/ok', '/chunked', '/empty', '/ok'] * 3)
+    assert [sample.code for sample in results] == [200, 201, 204, 200] * 3
+    assert server['connections'] == 1
+
+
+def test_interim_responses_are_skipped(server):
+    gun = make_gun(server['port'], pool_size=1, pipeline=4)
+    results = shoot(gun, ['/continue', '/ok', '/hints', '/empty'] * 2)
+    assert [sample.code for sample in results] == [200, 200, 202, 204] * 2
+    assert not any(sample.error for sample in results)
+    assert server['connections'] == 1
+
+
+def test_compiled_requests(server):
+    gun = make_gun(server['port'], pool_size=1, pipeline=2)
+    results = shoot(gun, [
+        compile_request('HEAD', '/head'),
+        compile_request('POST', '/ok', {'Host': 'example.com'}, 'a=1'),
+        '/ok'])
+    assert [sample.code for sample in results] == [200, 200, 200]
+    heads = server['requests']
+    assert heads[0].startswith(b'HEAD /head HTTP/1.1\r\nHost: 127.0.0.1')
+    assert heads[1] == (
+        b'POST /ok HTTP/1.1\r\nHost: example.com\r\ncontent-length: 3')
+    assert server['connections'] == 1
+
+
+@pytest.mark.parametrize('closing', ['/close', '/old'])
+def test_requests_behind_closing_response_are_sent_again(server, closing):
+    gun = make_gun(server['port'], pool_size=1, pipeline=4)
+    results = shoot(gun, [closing, '/ok', '/chunked', '/ok'])
+    assert [(sample.code, sample.action) for sample in results] == [
+        (503 if closing == '/close' else 200, 'request'), (200, 'request'),
+        (201, 'request'), (200, 'request')]
+    assert not any(sample.error for sample in results)
+    assert server['connections'] == 2
+
+
+def test_closed_idle_connection(server):
+    gun = make_gun(server['port'], pool_size=1)
+    gun.setup()
+    gun.shoot(task('/ok'))
+    # the server closes the connection without a response
+    gun.shoot(task('/drop'))
+    gun.teardown()
+    assert [sample.code for sample in gun.results] == [200, None]
+    dropped = gun.results[1]
+    assert dropped.action == 'not_processed'
+    assert not dropped.error
+    # it was sent again once on a new connection
+    assert server['connections'] == 2
+
+
+def test_timeout(server):
+    gun = make_gun(server['port'], pool_size=1, pipeline=2, timeout=0.2)
+
+    async def run():
+        await gun.async_setup()
+        slow = asyncio.ensure_future(gun.async_shoot(task('/slow')))
+        await asyncio.sleep(0.1)
+        await gun.async_shoot(task('/ok'))
+        await slow
+        await gun.async_teardown()
+    asyncio.new_event_loop().run_until_complete(run())
+    other, slow = sorted(gun.results, key=lambda sample: sample.error)
+    assert slow.error and slow.ext['error'] == 'TimeoutError'
+    # it was behind the slow one when that timed out, and was sent again
+    assert (other.code, other.error) == (200, False)
+    assert server['connections'] == 2
+
+
+def test_connection_refused(server):
+    gun = make_gun(1)
+    gun.setup()
+    gun.shoot(task('/ok'))
+    gun.teardown()
+    sample, = gun.results
+    assert sample.error
+    assert sample.action == 'request'
+    assert 'error' in sample.ext
+
+
+def test_close_fails_requests_behind_the_first():
+    async def run():
+        loop = asyncio.get_event_loop()
+        connection = HttpConnection('localhost', 80)
+        responses = [loop.create_future() for _ in range(3)]
+        connection.pending.extend((response, False) for response in responses)
+        connection.close(ValueError("Bad response"))
+        return [response.exception() for response in responses]
+    errors = asyncio.new_event_loop().run_until_complete(run())
+    assert isinstance(errors[0], ValueError)
+    assert all(isinstance(error, NotProcessed) for error in errors[1:])
@@ -0,0 +1,187 @@
+import asyncio
+import threading as th
+import time
+
+import pytest
+
+h2_connection = pytest.importorskip('h2.connection')
+import h2.config  # noqa: E402
+import h2.events  # noqa: E402
+
+from bfg.guns.http2 import HttpMultiGun, ConnectionPool  # noqa: E402
+from bfg.worker import Task  # noqa: E402
+
+
+class Server(asyncio.Protocol):
+    ''' Answers every stream with 'ok', says GOAWAY on /goaway '''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def connection_made(self, transport):
+        self.stats['connections'] += 1
+        self.transport = transport
+        self.conn = h2_connection.H2Connection(
+            config=h2.config.H2Configuration(
+                client_side=False, header_encoding='utf-8'))
+        self.conn.initiate_connection()
+        transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                path = dict(event.headers)[':path']
+                self.stats['paths'].append(path)
+                if path == '/goaway':
+                    self.conn.close_connection()
+                    self.transport.write(self.conn.data_to_send())
+                    self.transport.close()
+                    return
+                self.conn.send_headers(event.stream_id, [
+                    (':status', '200'), ('content-length', '2')])
+                self.conn.send_data(event.stream_id, b'ok', end_stream=True)
+        self.transport.write(self.conn.data_to_send())
+
+
+@pytest.fixture
+def server(server_context):
+    context = server_context(['h2'])
+    stats = {'connections': 0, 'paths': []}
+    started = th.Event()
+    loop = asyncio.new_event_loop()
+
+    def serve():
+        server = loop.run_until_complete(loop.create_server(
+            lambda: Server(stats), '127.0.0.1', 0, ssl=context))
+        stats['port'] = server.sockets[0].getsockname()[1]
+        started.set()
+        loop.run_forever()
+        server.close()
+    thread = th.Thread(target=serve, daemon=True)
+    thread.start()
+    started.wait()
+    yield stats
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+class Results(object):
+    def __init__(self):
+        self.samples = []
+        self.lock = th.Lock()
+
+    def put(self, sample):
+        with self.lock:
+            self.samples.append(sample)
+
+
+def make_gun(port, **options):
+    options['target'] = '127.0.0.1:%d' % port
+    gun = HttpMultiGun(options)
+    gun.results = Results()
+    return gun
+
+
+def task(data):
+    return Task(time.monotonic_ns(), 'bfg', 'marker', data)
+
+
+def actions(gun):
+    return [
+        (sample.action, sample.code, sample.error)
+        for sample in gun.results.samples]
+
+
+def test_requests(server):
+    gun = make_gun(server['port'])
+    gun.shoot(task('/a'))
+    gun.shoot(task([('x', '/b'), ('y', '/c')]))
+    gun.teardown()
+    assert actions(gun) == [
+        ('connect', None, False), ('request', None, False),
+        ('response', '200', False), ('overall', None, False),
+        ('request', None, False), ('request', None, False),
+        ('response', '200', False), ('response', '200', False),
+        ('overall', None, False)]
+    connect, _, response = gun.results.samples[:3]
+    assert connect.connect is not None
+    assert response.ttfb is not None and response.body is not None
+    assert [sample.marker for sample in gun.results.samples[4:8]] == [
+        'x', 'y', 'x', 'y']
+    assert server['paths'] == ['/a', '/b', '/c']
+    assert server['connections'] == 1
+    assert all(connection.streams == 0 for connection in gun.pool.connections)
+
+
+def test_reconnect_after_goaway(server):
+    gun = make_gun(server['port'])
+    gun.shoot(task('/a'))
+    gun.shoot(task('/goaway'))
+    gun.shoot(task('/a'))
+    gun.teardown()
+    assert ('reconnect', None, False) in actions(gun)
+    assert actions(gun)[-2:] == [
+        ('response', '200', False), ('overall', None, False)]
+    assert server['connections'] == 2
+    assert gun.pool.connections[0].connects == 2
+
+
+def test_connect_error():
+    gun = make_gun(1)
+    gun.shoot(task('/a'))
+    gun.teardown()
+    assert actions(gun) == [('connect', 1, True), ('overall', 1, True)]
+    assert gun.pool.connections[0].streams == 0
+
+
+def test_slot_released_on_unexpected_error(server, monkeypatch):
+    gun = make_gun(server['port'])
+
+    def fail(*args):
+        raise RuntimeError("Unexpected")
+    monkeypatch.setattr(gun, '_request', fail)
+    with pytest.raises(RuntimeError):
+        gun.shoot(task([('x', '/a'), ('y', '/b')]))
+    assert gun.pool.connections[0].streams == 0
+    monkeypatch.undo()
+    gun.shoot(task('/a'))
+    gun.teardown()
+    assert actions(gun)[-2:] == [
+        ('response', '200', False), ('overall', None, False)]
+
+
+class FakeConnection(object):
+    def __init__(self, limit):
+        self.limit = limit
+        self.streams = 0
+
+    def max_streams(self, limit):
+        return min(limit, self.limit)
+
+
+def test_pool_takes_least_loaded_connection():
+    pool = ConnectionPool('localhost:1', None, size=2, max_streams=3)
+    pool.connections = [FakeConnection(100), FakeConnection(2)]
+    taken = [pool.acquire() for _ in range(5)]
+    assert [pool.connections.index(c) for c in taken] == [0, 1, 0, 1, 0]
+    assert [c.streams for c in pool.connections] == [3, 2]
+    # a task that holds slots takes one over the limit, not waits
+    assert pool.acquire(wait=False) is pool.connections[1]
+    for connection in taken:
+        pool.release(connection)
+    pool.release(pool.connections[1])
+    assert [c.streams for c in pool.connections] == [0, 0]
+
+
+def test_pool_waits_for_slot():
+    pool = ConnectionPool('localhost:1', None, size=1, max_streams=1)
+    pool.connections = [FakeConnection(100)]
+    connection = pool.acquire()
+    waiter = th.Thread(target=pool.acquire)
+    waiter.start()
+    waiter.join(0.1)
+    assert waiter.is_alive()
+    pool.release(connection)
+    waiter.join(1)
+    assert not waiter.is_alive()
+    assert connection.streams == 1
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+import pytest
+
+from bfg.module_exceptions import PlanFileError
+from bfg.plan import compile_plan, cached_plan, compile_plans, CompiledPlan
+from bfg.schedule import create, US
+
+SCHEDULE = ['line(1, 100, 10s)', 'const(50, 5s)']
+
+
+def test_compiled_plan_is_same_as_schedule(tmp_path):
+    schedule = create(SCHEDULE, US)
+    path = str(tmp_path / 'test.plan')
+    compile_plan(schedule, path)
+    plan = CompiledPlan(path)
+    assert len(plan) == len(schedule)
+    assert plan.resolution == US
+    assert plan.get_duration() == schedule.get_duration()
+    assert not plan.has_ammo_index
+    assert plan.ammo_index is None
+    assert list(plan) == list(schedule)
+    for offset in range(3):
+        assert np.concatenate(list(plan.chunks(100, offset, 3))).tolist() \
+            == list(schedule.stride(offset, 3))
+
+
+def test_ammo_index_cycles_through_ammo(tmp_path):
+    path = str(tmp_path / 'test.plan')
+    compile_plan(create(['const(10, 1s)'], US), path, ammo=['a', 'b', 'c'])
+    plan = CompiledPlan(path)
+    assert plan.has_ammo_index
+    assert plan.ammo_index.tolist() == [0, 1, 2, 0, 1, 2, 0, 1, 2, 0]
+
+
+class BrokenSchedule(object):
+    ''' A schedule that fails after the first chunk '''
+    resolution = US
+
+    def __len__(self):
+        return 10
+
+    def get_duration(self):
+        return 1000
+
+    def chunks(self, size):
+        yield np.arange(5)
+        raise RuntimeError("Broken schedule")
+
+
+def test_failed_compilation_leaves_no_files(tmp_path):
+    path = str(tmp_path / 'test.plan')
+    with pytest.raises(RuntimeError):
+        compile_plan(BrokenSchedule(), path)
+    assert os.listdir(str(tmp_path)) == []
+
+
+class ShortSchedule(BrokenSchedule):
+    ''' A schedule that has fewer timestamps than it says '''
+
+    def chunks(self, size):
+        yield np.arange(5)
+
+
+def test_short_schedule_leaves_no_files(tmp_path):
+    path = str(tmp_path / 'test.plan')
+    with pytest.raises(PlanFileError):
+        compile_plan(ShortSchedule(), path)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_not_a_plan_file(tmp_path):
+    path = tmp_path / 'bad.plan'
+    path.write_bytes(b'x' * 100)
+    with pytest.raises(PlanFileError):
+        CompiledPlan(str(path))
+    path.write_bytes(b'x')
+    with pytest.raises(PlanFileError):
+        CompiledPlan(str(path))
+
+
+def test_cached_plan_is_compiled_once(tmp_path):
+    cache = str(tmp_path / 'cache')
+    ammo = tmp_path / 'ammo.line'
+    ammo.write_text('/a\n/b\n')
+    ammo_config = {'file': str(ammo)}
+    first = cached_plan(cache, ['const(10, 1s)'], ammo_config)
+    mtime = os.stat(first.path).st_mtime_ns
+    second = cached_plan(cache, ['const(10, 1s)'], ammo_config)
+    assert second.path == first.path
+    assert os.stat(second.path).st_mtime_ns == mtime
+    assert second.ammo_index.tolist() == [0, 1] * 5
+
+
+def test_cached_plan_depends_on_schedule_and_ammo(tmp_path):
+    cache = str(tmp_path / 'cache')
+    ammo = tmp_path / 'ammo.line'
+    ammo.write_text('/a\n/b\n')
+    ammo_config = {'file': str(ammo)}
+    first = cached_plan(cache, ['const(10, 1s)'], ammo_config)
+    other_schedule = cached_plan(cache, ['const(20, 1s)'], ammo_config)
+    assert other_schedule.path != first.path
+    ammo.write_text('/a\n/b\n/c\n')
+    other_ammo = cached_plan(cache, ['const(10, 1s)'], ammo_config)
+    assert other_ammo.path != first.path
+    assert other_ammo.ammo_index.tolist()[:4] == [0, 1, 2, 0]
+
+
+def test_compile_plans_from_config(tmp_path):
+    ammo = tmp_path / 'ammo.line'
+    ammo.write_text('/a\n')
+    config = {
+        'bfg': {
+            'cached': {
+                'plan_cache': str(tmp_path / 'cache'),
+                'schedule': 'plan', 'ammo': 'line'},
+            'plain': {'schedule': 'plan', 'ammo': 'line'},
+        },
+        'schedule': {'plan': ['const(5, 1s)']},
+        'ammo': {'line': {'file': str(ammo)}},
+    }
+    plans = compile_plans(config)
+    assert [len(plan) for plan in plans] == [5]
+    assert compile_plans(config, ['plain']) == []
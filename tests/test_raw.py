@@ -0,0 +1,115 @@
+import json
+
+import numpy as np
+import pytest
+
+from bfg.columns import ResultBlock
+from bfg.guns.base import Sample, PHASES
+from bfg.module_exceptions import ConfigurationError
+from bfg.raw import (
+    create_writer, RawReader, convert_to_tsv, MAGIC, LENGTH, CHUNK_HEADER)
+
+
+def sample(ts, marker, rt, code=200, ext=None, connect=None):
+    phases = [None] * len(PHASES)
+    if connect is not None:
+        phases[PHASES.index('connect')] = connect
+    return Sample(
+        ts, 'bfg', marker, rt, code is None, code, 10, 'main', 'request',
+        ext or {}, *phases)
+
+
+FIRST = [sample(100, 'a', 1000, connect=5), sample(100, 'b', 2000, 404)]
+SECOND = [sample(101, 'a', 3000, None, {'error': 'timeout'})]
+
+
+def write(filename, *writes, **options):
+    writer = create_writer(str(filename), **options)
+    for samples in writes:
+        writer.write(samples)
+    writer.write([])
+    writer.close()
+
+
+def test_tsv(tmp_path):
+    filename = tmp_path / 'raw.tsv'
+    write(filename, FIRST, [ResultBlock.from_samples(SECOND)])
+    lines = filename.read_text().splitlines()
+    assert lines[0].split('\t') == list(Sample._fields)
+    assert len(lines) == 4
+    assert lines[1].split('\t')[:10] == [
+        '100', 'bfg', 'a', '1000', 'False', '200', '10', 'main', 'request',
+        '{}']
+    assert lines[1].split('\t')[10:] == [
+        '5' if phase == 'connect' else '' for phase in PHASES]
+    assert lines[3].split('\t')[4:6] == ['True', '']
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'none', None, 'zstd'])
+def test_binary_round_trip(tmp_path, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    filename = tmp_path / 'raw.samples'
+    write(
+        filename, FIRST, [ResultBlock.from_samples(SECOND)] + FIRST,
+        raw_format='binary', compression=compression)
+    reader = RawReader(str(filename))
+    assert reader.header['fields'] == list(Sample._fields)
+    assert [len(block) for block in reader] == [2, 3]
+    assert list(reader.samples()) == FIRST + SECOND + FIRST
+
+
+def test_binary_to_tsv(tmp_path):
+    write(tmp_path / 'raw.samples', FIRST, SECOND, raw_format='binary')
+    write(tmp_path / 'raw.tsv', FIRST, SECOND)
+    count = convert_to_tsv(
+        str(tmp_path / 'raw.samples'), str(tmp_path / 'converted.tsv'))
+    assert count == 3
+    assert (tmp_path / 'converted.tsv').read_text() == \
+        (tmp_path / 'raw.tsv').read_text()
+
+
+def test_file_without_phases(tmp_path):
+    ''' Files written before phases were added '''
+    columns = [
+        column for column in ResultBlock.COLUMNS.descr
+        if column[0] not in PHASES]
+    rows = np.zeros(1, dtype=np.dtype(columns))
+    rows['ts'], rows['rt'] = 100, 1000
+    rows['marker'], rows['code'], rows['scenario'], rows['action'] = \
+        1, 2, 3, 4
+    meta = json.dumps({
+        'values': ['bfg', 'a', 200, 'main', 'request'],
+        'ext': {}}).encode('utf-8')
+    header = json.dumps({
+        'fields': Sample._fields[:10], 'columns': columns,
+        'compression': 'none'}).encode('utf-8')
+    payload = CHUNK_HEADER.pack(1, len(meta)) + meta + rows.tobytes()
+    filename = tmp_path / 'old.samples'
+    filename.write_bytes(
+        MAGIC + LENGTH.pack(len(header)) + header +
+        LENGTH.pack(len(payload)) + payload)
+    assert list(RawReader(str(filename)).samples()) == [Sample(
+        100, 'bfg', 'a', 1000, False, 200, 0, 'main', 'request', {})]
+
+
+def test_truncated_file(tmp_path):
+    filename = tmp_path / 'raw.samples'
+    write(filename, FIRST, SECOND, raw_format='binary')
+    filename.write_bytes(filename.read_bytes()[:-10])
+    assert list(RawReader(str(filename)).samples()) == FIRST
+
+
+def test_not_raw_file(tmp_path):
+    filename = tmp_path / 'raw.tsv'
+    write(filename, FIRST)
+    with pytest.raises(ValueError):
+        RawReader(str(filename))
+
+
+def test_bad_options(tmp_path):
+    with pytest.raises(ConfigurationError):
+        create_writer(str(tmp_path / 'raw'), raw_format='csv')
+    with pytest.raises(ConfigurationError):
+        create_writer(
+            str(tmp_path / 'raw'), raw_format='binary', compression='lz4')
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from bfg.schedule import create, Const, Line, MS, US, NS, ScheduleFactory
+from bfg.util import take
+
+
+@pytest.mark.parametrize('resolution', [MS, US, NS])
+def test_const_timestamps_are_in_resolution_units(resolution):
+    plan = create(['const(4, 1s)'], resolution)
+    assert list(plan) == [
+        0, resolution // 4, resolution // 2, 3 * resolution // 4]
+
+
+def test_high_rps_is_not_rounded_away_at_microseconds():
+    plan = create(['const(100000, 1s)'], US)
+    timestamps = np.array(list(plan))
+    assert len(timestamps) == 100000
+    # at millisecond resolution 100 tasks would share every timestamp
+    assert len(np.unique(timestamps)) == 100000
+    assert np.all(np.diff(timestamps) == 10)
+
+
+def test_composite_steps_are_offset_in_resolution_units():
+    plan = create(['const(1, 2s)', 'line(1, 5, 2s)'], US)
+    assert plan.resolution == US
+    assert take(4, plan) == [0, 1000000, 2000000, 2618033]
+
+
+def test_factory_plans_in_microseconds():
+    class Components(object):
+        config = {'schedule': {'plan': ['const(10, 1s)']}}
+        event_loop = None
+
+    plan = ScheduleFactory(Components()).get('plan')
+    assert plan.resolution == US
+    assert take(2, plan) == [0, 100000]
+
+
+def test_line_at_nanoseconds():
+    assert take(3, Line(1, 5, 2000, NS)) == [0, 618033988, 1000000000]
+
+
+def test_const_duration_is_in_milliseconds_whatever_resolution():
+    assert len(Const(10, 1500, US)) == len(Const(10, 1500, MS)) == 15
+
+
+@pytest.mark.parametrize('steps', [
+    ['line(1, 5, 2s)'],
+    ['line(5, 1, 2s)'],
+    ['line(1.1, 5.8, 2s)'],
+    ['line(5, 5, 2s)'],
+    ['step(1, 50, 3, 2s)', 'line(1, 500, 10s)', 'const(7, 3s)'],
+])
+def test_chunks_are_same_as_stride(steps):
+    plan = create(steps, US)
+    for step in (1, 3):
+        for offset in range(step):
+            chunked = np.concatenate(
+                list(plan.chunks(16, offset, step))).tolist()
+            assert chunked == list(plan.stride(offset, step))
+
+
+def test_flat_line_is_constant_rate():
+    plan = create(['line(5, 5, 2s)'], US)
+    expected = (np.arange(10) * 200000).tolist()
+    assert list(plan) == expected
+    assert np.concatenate(list(plan.chunks(4))).tolist() == expected
+    assert all(chunk.dtype == np.int64 for chunk in plan.chunks(4))
@@ -0,0 +1,123 @@
+import asyncio
+import socket
+import ssl
+import time
+
+import pytest
+
+spdylay = pytest.importorskip('spdylay')
+
+from bfg.guns.spdy import SpdyMultiGun, SpdyTask  # noqa: E402
+from bfg.worker import Task  # noqa: E402
+
+
+class Results(list):
+    def put(self, sample):
+        self.append(sample)
+
+
+def task(count):
+    return Task(
+        time.monotonic_ns(), 'bfg', 'scenario',
+        [('m%d' % number, '/%d' % number) for number in range(count)])
+
+
+def actions(results):
+    return [(sample.action, sample.code, sample.error) for sample in results]
+
+
+def respond(handler, stream_id, status='200', length=5):
+    handler.on_start(stream_id)
+    handler.on_request_sent()
+    handler.on_header([(':status', status)])
+    handler.on_data(length)
+    handler.on_response_end()
+
+
+def test_task_streams():
+    results, done = Results(), []
+    spdy_task = SpdyTask(task(2), results, lambda: done.append(True))
+    first, second = spdy_task.handlers
+    assert (first.task.marker, first.task.data) == ('m0', '/0')
+    respond(first, 1)
+    assert not done
+    respond(second, 3, '404', 7)
+    assert done == [True]
+    assert actions(results) == [
+        ('request', None, False), ('response_start', None, False),
+        ('response', 200, False),
+        ('request', None, False), ('response_start', None, False),
+        ('response', 404, False),
+        ('overall', None, False)]
+    assert results[2].ext['length'] == 5
+    assert results[-1].marker == 'scenario'
+    assert {sample.scenario for sample in results[:-1]} == {'scenario'}
+
+
+def test_failed_stream_fails_task():
+    results, done = Results(), []
+    spdy_task = SpdyTask(task(3), results, lambda: done.append(True))
+    first, second, third = spdy_task.handlers
+    respond(first, 1)
+    # failed before it was sent
+    second.on_error()
+    third.on_start(5)
+    third.on_error(7)
+    # errors of finished streams are ignored
+    first.on_error()
+    third.on_error()
+    assert done == [True]
+    assert actions(results)[3:] == [
+        ('request', None, True), ('request', 7, True), ('overall', None, True)]
+
+
+def test_empty_task():
+    results, done = Results(), []
+    SpdyTask(task(0), results, lambda: done.append(True))
+    assert done == [True]
+    assert actions(results) == [('overall', None, False)]
+
+
+needs_npn = pytest.mark.skipif(
+    not getattr(ssl, 'HAS_NPN', False), reason="NPN is not supported")
+
+
+@pytest.fixture
+def refused(monkeypatch):
+    ''' Nothing listens at the target '''
+    connect = socket.create_connection
+    monkeypatch.setattr(
+        socket, 'create_connection',
+        lambda address, *args, **kwargs: connect(
+            ('127.0.0.1', 1), *args, **kwargs))
+
+
+@needs_npn
+def test_connection_failure_fails_streams(refused):
+    gun = SpdyMultiGun({'target': 'localhost'})
+    gun.results = Results()
+    gun.setup()
+    gun.shoot(task(2))
+    gun.shoot(task(1))
+    gun.teardown()
+    assert actions(gun.results) == [
+        ('request', None, True), ('request', None, True),
+        ('overall', None, True), ('request', None, True),
+        ('overall', None, True)]
+
+
+@needs_npn
+def test_async_tasks_do_not_hang(refused):
+    gun = SpdyMultiGun({'target': 'localhost'})
+    gun.results = Results()
+
+    async def run():
+        await gun.async_setup()
+        await asyncio.wait_for(
+            asyncio.gather(*(gun.async_shoot(task(2)) for _ in range(10))),
+            10)
+        await gun.async_teardown()
+    asyncio.new_event_loop().run_until_complete(run())
+    overall = [sample for sample in gun.results if sample.action == 'overall']
+    assert len(overall) == 10
+    assert all(sample.error for sample in overall)
@@ -0,0 +1,106 @@
+import math
+
+import numpy as np
+import pytest
+
+from bfg.storage import SeriesStorage, read_series
+
+
+def aggr(samples, rt, errors=0, late=None, connect=None):
+    overall = {
+        "samples": samples, "errors": errors,
+        "rt": {"avg": rt, "quantiles": {"50": rt, "100": rt * 2}},
+        "delay": {"avg": 1, "quantiles": {"50": 1, "100": 2}},
+    }
+    if late is not None:
+        overall["late"] = late
+    if connect is not None:
+        overall["phases"] = {"connect": {
+            "avg": connect, "quantiles": {"50": connect, "100": connect}}}
+    return {"rps": samples, "overall": overall}
+
+
+def test_recent_seconds():
+    storage = SeriesStorage([.5, 1], phases=('connect',))
+    storage[100] = aggr(10, 1000, errors=2, late=3, connect=50)
+    stat = storage[100]
+    assert (stat["samples"], stat["errors"], stat["late"]) == (10, 2, 3)
+    assert stat["rt"] == {
+        "avg": 1000.0, "quantiles": {"50": 1000.0, "100": 2000.0}}
+    assert stat["phases"]["connect"]["avg"] == 50
+    assert math.isnan(stat["intended"]["avg"])
+    assert 101 not in storage
+    with pytest.raises(KeyError):
+        storage[101]
+
+
+def test_correction_replaces_second():
+    storage = SeriesStorage([.5, 1])
+    storage[100] = aggr(10, 1000)
+    storage[100] = aggr(15, 1200)
+    assert storage[100]["samples"] == 15
+    coarse, recent = storage.series()
+    assert len(coarse) == 0
+    assert recent['ts'].tolist() == [100]
+
+
+def test_memory_is_bounded():
+    storage = SeriesStorage([.5, 1], recent=10, interval=5, coarse=3)
+    for ts in range(1000, 1100):
+        storage[ts] = aggr(ts - 999, ts)
+    coarse, recent = storage.series()
+    assert recent['ts'].tolist() == list(range(1090, 1100))
+    assert coarse['ts'].tolist() == [1075, 1080, 1085]
+    assert coarse['seconds'].tolist() == [5, 5, 5]
+    interval = coarse[-1]
+    counts = np.arange(1085, 1090) - 999
+    assert interval['samples'] == counts.sum()
+    assert interval['rt_avg'] == pytest.approx(
+        (counts * np.arange(1085, 1090)).sum() / counts.sum())
+    assert interval['rt_quantiles'].tolist() == [1089, 2178]
+    # too old to be stored
+    storage[1000] = aggr(1, 1)
+    assert storage.series()[0]['ts'].tolist() == [1075, 1080, 1085]
+
+
+def test_averages_skip_seconds_without_stat():
+    storage = SeriesStorage(
+        [.5, 1], recent=1, interval=10, phases=('connect',))
+    storage[100] = aggr(10, 1000, connect=100)
+    storage[101] = aggr(10, 3000)
+    phases = aggr(30, 1000, connect=400)
+    # a phase measured for a part of the samples of a second
+    phases["overall"]["phases"]["connect"]["samples"] = 10
+    storage[102] = phases
+    storage[103] = aggr(1, 1)
+    interval, = storage.series()[0]
+    assert interval['samples'] == 50
+    assert interval['rt_avg'] == 1400
+    assert interval['connect_samples'] == 20
+    assert interval['connect_avg'] == 250
+    assert interval['intended_samples'] == 0
+    assert math.isnan(interval['intended_avg'])
+
+
+def test_series_file(tmp_path):
+    filename = str(tmp_path / 'result.series')
+    storage = SeriesStorage([.5, 1], filename, recent=2, phases=('connect',))
+    for ts in range(100, 110):
+        storage[ts] = aggr(ts, ts, connect=ts)
+    storage[105] = aggr(1, 5)
+    storage.close()
+    records = read_series(filename)
+    assert records['ts'].tolist() == list(range(100, 110))
+    assert records['samples'].tolist() == [
+        1 if ts == 105 else ts for ts in range(100, 110)]
+    assert records['connect_avg'].tolist()[:2] == [100, 101]
+    window = read_series(filename, 103, 106)
+    assert window['ts'].tolist() == [103, 104, 105, 106]
+    assert window['rt_avg'].tolist() == [103, 104, 5, 106]
+
+
+def test_not_series_file(tmp_path):
+    filename = tmp_path / 'result.samples'
+    filename.write_bytes(b'ts\tbfg\n')
+    with pytest.raises(ValueError):
+        read_series(str(filename))
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from bfg.timer import (
+    wait_until, async_wait_until, wall_time, JitterHistogram)
+
+
+def test_wait_until_is_never_early():
+    for delay in (0, 100000, 2000000):
+        deadline = time.monotonic_ns() + delay
+        late = wait_until(deadline, spin_ns=500000)
+        assert time.monotonic_ns() >= deadline
+        assert late >= 0
+
+
+def test_wait_until_spins_close_to_deadline():
+    lateness = []
+    for _ in range(20):
+        deadline = time.monotonic_ns() + 2000000
+        lateness.append(wait_until(deadline, spin_ns=1000000))
+    # spinning for the last millisecond makes dispatch precise
+    assert sorted(lateness)[10] < 200000
+
+
+def test_past_deadline_returns_lateness():
+    deadline = time.monotonic_ns() - 5000000
+    assert wait_until(deadline) >= 5000000
+
+
+def test_async_wait_until_is_never_early():
+    async def wait(delay):
+        deadline = time.monotonic_ns() + delay
+        late = await async_wait_until(deadline, spin_ns=500000)
+        return time.monotonic_ns() - deadline, late
+
+    loop = asyncio.new_event_loop()
+    try:
+        for delay in (0, 3000000):
+            elapsed, late = loop.run_until_complete(wait(delay))
+            assert elapsed >= 0
+            assert late >= 0
+    finally:
+        loop.close()
+
+
+def test_wall_time_follows_wall_clock():
+    assert abs(wall_time(time.monotonic_ns()) - time.time()) < 0.01
+
+
+def test_jitter_histogram_buckets():
+    histogram = JitterHistogram()
+    assert histogram.quantile(.5) == 0
+    for ns in [1000] * 90 + [1000000] * 10:
+        histogram.record(ns)
+    assert histogram.total == 100
+    assert histogram.quantile(.5) == 2
+    assert histogram.quantile(.99) == 1024
+    assert '100 tasks' in str(histogram)
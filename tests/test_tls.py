@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import socket
+import threading as th
+import time
+
+import pytest
+
+from bfg.guns.http import HttpGun
+from bfg.guns.tls import SessionContext
+from bfg.module_exceptions import ConfigurationError
+from bfg.worker import Task
+
+
+RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+
+
+class Server(asyncio.Protocol):
+    ''' Answers every request with 'ok' '''
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stats['reused'].append(
+            transport.get_extra_info('ssl_object').session_reused)
+
+    def data_received(self, data):
+        self.buffer += data
+        count = self.buffer.count(b'\r\n\r\n')
+        self.buffer = self.buffer.rsplit(b'\r\n\r\n', 1)[-1]
+        self.transport.write(RESPONSE * count)
+
+
+@pytest.fixture
+def server(server_context):
+    context = server_context()
+    stats = {'reused': []}
+    started = th.Event()
+    loop = asyncio.new_event_loop()
+
+    def serve():
+        server = loop.run_until_complete(loop.create_server(
+            lambda: Server(stats), '127.0.0.1', 0, ssl=context))
+        stats['port'] = server.sockets[0].getsockname()[1]
+        started.set()
+        loop.run_forever()
+        server.close()
+    thread = th.Thread(target=serve, daemon=True)
+    thread.start()
+    started.wait()
+    yield stats
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def exchange(context, port):
+    ''' Make a request over a new connection, as guns do '''
+    with socket.create_connection(('127.0.0.1', port), 5) as sock:
+        with context.wrap_socket(sock, server_hostname='localhost') as tls:
+            tls.sendall(b'GET / HTTP/1.1\r\n\r\n')
+            assert tls.recv(1024) == RESPONSE
+            context.remember(tls)
+            return tls.session_reused
+
+
+def test_unknown_mode():
+    with pytest.raises(ConfigurationError):
+        SessionContext('sometimes')
+
+
+def test_certificates_are_not_verified(server):
+    context = SessionContext('full')
+    assert exchange(context, server['port']) is False
+
+
+def test_resume(server):
+    context = SessionContext('resume')
+    assert [exchange(context, server['port']) for _ in range(3)] == [
+        False, True, True]
+    assert list(context.sessions) == ['localhost']
+    assert server['reused'] == [False, True, True]
+
+
+def test_full_handshakes(server):
+    context = SessionContext('full')
+    assert [exchange(context, server['port']) for _ in range(3)] == [
+        False, False, False]
+    assert context.sessions == {}
+
+
+def test_shared_session(server):
+    context = SessionContext('shared')
+    context.prime('localhost', server['port'])
+    assert 'localhost' in context.sessions
+    assert exchange(context, server['port']) is True
+
+
+def test_prime_failure(caplog):
+    context = SessionContext('shared')
+    with caplog.at_level(logging.WARNING):
+        context.prime('localhost', 1, timeout=1)
+    assert context.sessions == {}
+    assert 'Failed to make a TLS session' in caplog.text
+
+
+class Results(list):
+    def put(self, sample):
+        self.append(sample)
+
+
+@pytest.mark.parametrize('mode,reused', [
+    ('resume', [False, True, True]),
+    ('full', [False, False, False]),
+])
+def test_http_gun_resumes_sessions(server, mode, reused):
+    gun = HttpGun({
+        'target': 'https://localhost:%d' % server['port'],
+        'pool_size': 1, 'tls_sessions': mode})
+    gun.results = Results()
+    gun.setup()
+    for _ in range(3):
+        gun.shoot(Task(time.monotonic_ns(), 'bfg', 'marker', '/'))
+        # a new connection for every request
+        gun.pool.close()
+    gun.teardown()
+    assert [sample.code for sample in gun.results] == [200] * 3
+    assert all(sample.tls is not None for sample in gun.results)
+    assert server['reused'] == reused
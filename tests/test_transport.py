@@ -0,0 +1,87 @@
+import multiprocessing as mp
+import time
+
+import numpy as np
+import pytest
+
+from bfg.transport import TaskRing
+
+
+@pytest.fixture
+def ring():
+    ring = TaskRing(16)
+    yield ring
+    ring.destroy()
+
+
+def test_records_come_out_in_order_across_wrap(ring):
+    taken = []
+    for start in range(0, 100, 10):
+        numbers = np.arange(start, start + 10)
+        assert ring.put(numbers * 1000, numbers) == 10
+        taken.extend(ring.get(7, 0).tolist())
+        taken.extend(ring.get(7, 0).tolist())
+    assert taken == [(number * 1000, number) for number in range(100)]
+
+
+def test_put_writes_only_what_fits(ring):
+    numbers = np.arange(20)
+    assert ring.put(numbers, numbers) == 16
+    assert len(ring) == 16
+    assert ring.put(numbers, numbers) == 0
+    assert len(ring.get(4, 0)) == 4
+    assert ring.put(numbers[16:], numbers[16:]) == 4
+
+
+def test_get_waits_for_timeout_then_returns_empty(ring):
+    started = time.monotonic()
+    batch = ring.get(10, 0.1)
+    assert len(batch) == 0
+    assert time.monotonic() - started >= 0.1
+
+
+def test_get_deadline_does_not_follow_wall_clock(ring, monkeypatch):
+    # a wall clock step back must not make get() wait longer
+    wall = iter(range(1000000, 0, -1))
+    monkeypatch.setattr(time, 'time', lambda: next(wall))
+    started = time.monotonic()
+    ring.get(10, 0.05)
+    assert time.monotonic() - started < 1
+
+
+def test_closed_empty_ring_returns_none(ring):
+    ring.put(np.arange(3), np.arange(3))
+    ring.close()
+    assert len(ring.get(10, 0)) == 3
+    assert ring.get(10, 0) is None
+
+
+def _consume(ring, results):
+    taken = []
+    while True:
+        batch = ring.get(5, 1)
+        if batch is None:
+            break
+        taken.extend(batch['ammo'].tolist())
+    results.put(taken)
+
+
+def test_round_trip_across_processes(ring):
+    results = mp.Queue()
+    consumers = [
+        mp.Process(target=_consume, args=(ring, results)) for _ in range(3)]
+    for consumer in consumers:
+        consumer.start()
+    numbers = np.arange(1000)
+    written = 0
+    while written < len(numbers):
+        written += ring.put(numbers[written:] * 10, numbers[written:])
+        time.sleep(0.0001)
+    ring.close()
+    taken = []
+    for _ in consumers:
+        taken.extend(results.get(timeout=10))
+    for consumer in consumers:
+        consumer.join()
+    assert sorted(taken) == list(range(1000))
+
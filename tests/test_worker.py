@@ -0,0 +1,182 @@
+import asyncio
+import multiprocessing as mp
+import threading as th
+import time
+from queue import Empty
+
+from bfg.guns.base import GunBase
+from bfg.schedule import create, US
+from bfg.worker import BFG, Task
+
+
+class NumberGun(GunBase):
+    ''' Sends a sample with the missile in ext for every task '''
+
+    def shoot(self, task):
+        with self.measure(task) as sw:
+            sw.ext['missile'] = task.data
+
+    async def async_shoot(self, task):
+        self.shoot(task)
+
+
+class Results(object):
+    def __init__(self):
+        self.samples = []
+
+    def put(self, sample):
+        self.samples.append(sample)
+
+
+class BlockingGun(GunBase):
+    ''' Counts how many shots are in flight at once '''
+
+    def __init__(self, duration=0.2):
+        super().__init__({})
+        self.duration = duration
+        self.lock = th.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.shots = 0
+
+    def shoot(self, task):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.duration)
+        with self.lock:
+            self.in_flight -= 1
+            self.shots += 1
+
+
+class AsyncGun(BlockingGun):
+
+    async def async_shoot(self, task):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.duration)
+        self.in_flight -= 1
+        self.shots += 1
+
+
+def make_bfg(gun, concurrency):
+    bfg = BFG(
+        gun=gun, schedule=create(['const(1, 1s)'], US), ammo=[],
+        results=Results(), name='test', instances=1, event_loop=None,
+        worker_type='async', concurrency=concurrency)
+    bfg.start_time = time.monotonic_ns()
+    return bfg
+
+
+def run_async_worker(bfg, tasks):
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(bfg._async_worker(iter([tasks])))
+    finally:
+        loop.close()
+
+
+def tasks(count):
+    return [Task(0, 'test', 'marker', None) for _ in range(count)]
+
+
+def test_blocking_gun_is_not_capped_by_default_executor():
+    gun = BlockingGun()
+    run_async_worker(make_bfg(gun, 100), tasks(100))
+    assert gun.shots == 100
+    assert gun.max_in_flight == 100
+
+
+def test_concurrency_limits_tasks_in_flight():
+    gun = AsyncGun(0.05)
+    run_async_worker(make_bfg(gun, 10), tasks(50))
+    assert gun.shots == 50
+    assert gun.max_in_flight == 10
+
+
+def test_failed_shot_does_not_stop_worker():
+    class FailingGun(AsyncGun):
+        async def async_shoot(self, task):
+            await super().async_shoot(task)
+            raise RuntimeError("shot failed")
+
+    gun = FailingGun(0)
+    run_async_worker(make_bfg(gun, 5), tasks(20))
+    assert gun.shots == 20
+
+
+def run_bfg(count, ammo=None, **options):
+    '''
+    Shoot count tasks planned at 1000 rps with two worker processes and
+    return the missiles of the samples sent
+    '''
+    if ammo is None:
+        ammo = [('marker', number) for number in range(count)]
+    loop = asyncio.new_event_loop()
+    results = mp.Queue()
+    bfg = BFG(
+        gun=NumberGun({}),
+        schedule=create(['const(1000, %gs)' % (count / 1000)], US),
+        ammo=ammo, results=results, name='test', instances=2,
+        event_loop=loop, **options)
+
+    async def wait():
+        while bfg.running():
+            await asyncio.sleep(0.05)
+
+    try:
+        bfg.start()
+        loop.run_until_complete(wait())
+        missiles = []
+        while True:
+            try:
+                missiles.append(results.get(timeout=1).ext['missile'])
+            except Empty:
+                return missiles
+    finally:
+        bfg.close()
+        loop.close()
+
+
+def test_chunks_of_tasks_are_shot_once():
+    missiles = run_bfg(500, chunk_size=7, chunk_window=20)
+    assert sorted(missiles) == list(range(500))
+
+
+def test_ammo_without_random_access_is_sent_by_value():
+    missiles = run_bfg(
+        300, ammo=(('marker', number) for number in range(300)),
+        chunk_size=10)
+    assert sorted(missiles) == list(range(300))
+
+
+def test_chunk_size_and_window_bound_chunks():
+    bfg = make_bfg(NumberGun({}), 1)
+    bfg.schedule = create(['const(100, 10s)'], US)
+    bfg.chunk_size = 50
+    bfg.chunk_window = 200000
+    chunks = list(bfg._plan_chunks())
+    assert sum(len(timestamps) for timestamps, _ in chunks) == 1000
+    for timestamps, numbers in chunks:
+        assert len(timestamps) <= 50
+        assert timestamps[-1] - timestamps[0] < 200000
+        assert len(numbers) == len(timestamps)
+    assert [
+        number for _, numbers in chunks for number in numbers.tolist()
+    ] == list(range(1000))
+
+
+def test_workers_feed_themselves_with_their_share():
+    missiles = run_bfg(500, feeder='worker', chunk_size=7)
+    assert sorted(missiles) == list(range(500))
+
+
+def test_workers_feed_themselves_async():
+    missiles = run_bfg(
+        500, feeder='worker', worker_type='async', concurrency=10)
+    assert sorted(missiles) == list(range(500))
+
+
+def test_bfg_shoots_tasks_from_ring():
+    missiles = run_bfg(500, transport='shm', ring_size=64)
+    assert sorted(missiles) == list(range(500))